@@ -0,0 +1,37 @@
+"""
+Affinité numéro -> device par hachage de rendez-vous pondéré (HRW) : sans stockage,
+stable, et un ajout / retrait de device ne déplace que les numéros qui
+le concernent. Utilisé par l'allocation des lots et le routage des réponses.
+"""
+import math
+import hashlib
+
+_SCALE = float(1 << 64)
+
+
+def _unit(number, device_id):
+    # hash uniforme dans ]0, 1[
+    h = hashlib.blake2b(f"{device_id}:{number}".encode("utf-8"), digest_size=8).digest()
+    return (int.from_bytes(h, "big") + 0.5) / _SCALE
+
+
+def score(number, device_id, weight=1.0):
+    if weight <= 0:
+        return float("-inf")
+    return -weight / math.log(_unit(number, device_id))
+
+
+def pick(number, weights):
+    """Device préféré du numéro parmi {device: poids} (poids <= 0 exclus), None si aucun."""
+    best, best_score = None, float("-inf")
+    for device_id, weight in weights.items():
+        s = score(number, device_id, weight)
+        if s > best_score:
+            best, best_score = device_id, s
+    return best
+
+
+def ranking(number, weights):
+    """Devices par ordre de préférence (repli successif si le premier tombe)."""
+    live = [(score(number, d, w), d) for d, w in weights.items() if w > 0]
+    return [d for _, d in sorted(live, reverse=True)]
@@ -0,0 +1,251 @@
+"""
+Allocation des lots aux devices : round-robin pondéré (smooth WRR) selon la
+capacité configurée et l'état live de chaque device (circuit, taux d'erreur,
+backlog). Chaque device reçoit sa sous-liste de positions (nl:batch:dev:<id>:<device>),
+consommée par send_device_chunk ; rebalance() redistribue la sous-liste d'un
+device tombé en cours de campagne.
+
+ALLOC_AFFINITY : les numéros connus vont à leur device d'affinité (affinity.py,
+rendez-vous pondéré par la capacité configurée, stable) -> même SIM d'un lot à
+l'autre ; l'état live n'exclut que les devices au circuit ouvert, comme le repli
+des réponses.
+"""
+import os
+import json
+
+from logger import log
+from keyspace import (
+    lazy_main_redis,
+    device_stat_key,
+    batch_device_key,
+    ALLOC_BACKLOG_PREFIX,
+    ALLOC_RUN_PREFIX,
+    BATCH_ITEMS_PREFIX,
+    HEALTH_PREFIX,
+)
+from device_health import STATE_OPEN, STATE_HALF_OPEN
+import affinity
+
+# capacité relative par device : "12:3,14:1" (défaut ALLOC_DEFAULT_CAPACITY)
+ALLOC_DEFAULT_CAPACITY = float(os.getenv("ALLOC_DEFAULT_CAPACITY", "1"))
+ALLOC_CAPACITY = {
+    k.strip(): float(v)
+    for k, _, v in (part.partition(":") for part in os.getenv("DEVICE_CAPACITY", "").split(","))
+    if k.strip() and v.strip()
+}
+# backlog (envois déjà alloués) à partir duquel un device voit son poids divisé par 2
+ALLOC_BACKLOG_SCALE = float(os.getenv("ALLOC_BACKLOG_SCALE", "500"))
+ALLOC_HALF_OPEN_FACTOR = float(os.getenv("ALLOC_HALF_OPEN_FACTOR", "0.25"))
+ALLOC_AFFINITY = os.getenv("ALLOC_AFFINITY", "true").lower() == "true"
+ALLOC_PUSH_CHUNK = 1000
+
+ALLOC_RUN_TTL = int(os.getenv("ALLOC_RUN_TTL", "86400"))
+
+redis_conn = lazy_main_redis()
+
+
+def capacity(device_id):
+    return ALLOC_CAPACITY.get(str(device_id), ALLOC_DEFAULT_CAPACITY)
+
+
+def device_weights(device_ids):
+    """
+    Poids effectif par device (un seul pipeline) :
+    capacité × état du circuit × (1 - taux d'erreur) / (1 + backlog / ALLOC_BACKLOG_SCALE).
+    """
+    ids = [str(d) for d in device_ids]
+    pipe = redis_conn.pipeline(transaction=False)
+    for did in ids:
+        pipe.hget(HEALTH_PREFIX + did, "state")
+        pipe.get(device_stat_key(did, "sent"))
+        pipe.get(device_stat_key(did, "errors"))
+        pipe.get(ALLOC_BACKLOG_PREFIX + did)
+    res = pipe.execute()
+
+    weights = {}
+    for i, did in enumerate(ids):
+        state, sent, errors, backlog = res[i * 4:i * 4 + 4]
+        state = (state or b"").decode("utf-8")
+        sent, errors, backlog = int(sent or 0), int(errors or 0), max(0, int(backlog or 0))
+        w = capacity(did)
+        if state == STATE_OPEN:
+            w = 0.0
+        elif state == STATE_HALF_OPEN:
+            w *= ALLOC_HALF_OPEN_FACTOR
+        # lissage : un device neuf n'est pas pénalisé par ses premières erreurs
+        w *= 1.0 - errors / float(sent + errors + 10)
+        w /= 1.0 + backlog / ALLOC_BACKLOG_SCALE
+        weights[did] = max(0.0, w)
+    return weights
+
+
+def smooth_wrr(weights, count):
+    """Séquence de `count` devices, entrelacée et proportionnelle aux poids (nginx smooth WRR)."""
+    live = {d: w for d, w in weights.items() if w > 0}
+    if not live:
+        return []
+    total = sum(live.values())
+    current = {d: 0.0 for d in live}
+    out = []
+    for _ in range(count):
+        for d, w in live.items():
+            current[d] += w
+        best = max(current, key=current.get)
+        current[best] -= total
+        out.append(best)
+    return out
+
+
+def allocate(batch_id, positions, device_ids, weights=None, backlog=False, numbers=None):
+    """
+    Répartit les positions d'items du lot entre les devices et écrit les sous-listes.
+    numbers : numéro de chaque position (affinité) ; sinon / numéro vide -> WRR.
+    backlog=True : lot déjà en cours d'envoi (rebalance), compté dans le backlog.
+    Retourne {device: nombre}.
+    """
+    weights = weights if weights is not None else device_weights(device_ids)
+    # hachage sur la capacité (pas les poids live, qui bougent à chaque envoi) ;
+    # poids live nul = circuit ouvert -> device exclu
+    stable = {d: capacity(d) for d, w in weights.items() if w > 0 and capacity(d) > 0}
+    if ALLOC_AFFINITY and numbers and stable:
+        wrr = iter(smooth_wrr(weights, sum(1 for n in numbers if not n)))
+        order = [affinity.pick(n, stable) if n else next(wrr) for n in numbers]
+    else:
+        order = smooth_wrr(weights, len(positions))
+    if not order:
+        # tous les devices KO : répartition égale, les envois seront retenus
+        order = [str(device_ids[i % len(device_ids)]) for i in range(len(positions))]
+
+    per_device = {}
+    for pos, did in zip(positions, order):
+        per_device.setdefault(did, []).append(pos)
+    _push(batch_id, per_device, backlog)
+    return {d: len(p) for d, p in per_device.items()}
+
+
+def _push(batch_id, per_device, backlog):
+    pipe = redis_conn.pipeline(transaction=False)
+    for did, positions in per_device.items():
+        for i in range(0, len(positions), ALLOC_PUSH_CHUNK):
+            pipe.rpush(batch_device_key(batch_id, did), *positions[i:i + ALLOC_PUSH_CHUNK])
+        if backlog:
+            pipe.incrby(ALLOC_BACKLOG_PREFIX + did, len(positions))
+    pipe.execute()
+
+
+def add_backlog(allocation):
+    """Lancement d'un lot : ses sous-listes entrent dans le backlog des devices."""
+    pipe = redis_conn.pipeline(transaction=False)
+    for did, n in allocation.items():
+        pipe.incrby(ALLOC_BACKLOG_PREFIX + str(did), int(n))
+    pipe.execute()
+
+
+def take(batch_id, device_id, count):
+    """Retire jusqu'à `count` positions de la sous-liste du device."""
+    key = batch_device_key(batch_id, device_id)
+    pipe = redis_conn.pipeline()
+    pipe.lrange(key, 0, count - 1)
+    pipe.ltrim(key, count, -1)
+    raws, _ = pipe.execute()
+    positions = [int(p) for p in raws]
+    if positions:
+        redis_conn.decrby(ALLOC_BACKLOG_PREFIX + str(device_id), len(positions))
+    return positions
+
+
+def give_back(batch_id, device_id, positions):
+    """Remet des positions en tête de sous-liste (device indisponible)."""
+    if not positions:
+        return
+    pipe = redis_conn.pipeline()
+    pipe.lpush(batch_device_key(batch_id, device_id), *reversed(positions))
+    pipe.incrby(ALLOC_BACKLOG_PREFIX + str(device_id), len(positions))
+    pipe.execute()
+
+
+def drop(batch_id, device_ids, backlog=True):
+    """
+    Supprime les sous-listes du lot (compaction). backlog=True (lot lancé) : leurs
+    positions restantes sortent aussi du backlog des devices.
+    """
+    device_ids = [str(d) for d in device_ids]
+    pipe = redis_conn.pipeline()
+    for did in device_ids:
+        pipe.llen(batch_device_key(batch_id, did))
+        pipe.delete(batch_device_key(batch_id, did))
+    res = pipe.execute()
+    left = {did: int(res[i * 2] or 0) for i, did in enumerate(device_ids)}
+    if backlog and any(left.values()):
+        pipe = redis_conn.pipeline(transaction=False)
+        for did, n in left.items():
+            if n:
+                pipe.decrby(ALLOC_BACKLOG_PREFIX + did, n)
+        pipe.execute()
+    return left
+
+
+def pending(batch_id, device_id):
+    return int(redis_conn.llen(batch_device_key(batch_id, device_id)) or 0)
+
+
+# -----------------------
+# CHAÎNES D'ENVOI (une seule par device et par lot)
+# -----------------------
+def start_chain(batch_id, device_id):
+    """True si l'appelant doit lancer la chaîne (aucune en cours)."""
+    return bool(redis_conn.set(f"{ALLOC_RUN_PREFIX}{batch_id}:{device_id}", 1, nx=True, ex=ALLOC_RUN_TTL))
+
+
+def end_chain(batch_id, device_id, restart=True):
+    """
+    Fin de chaîne. True si des positions sont arrivées entretemps (rebalance) :
+    l'appelant relance alors la chaîne (qu'il possède de nouveau).
+    """
+    redis_conn.delete(f"{ALLOC_RUN_PREFIX}{batch_id}:{device_id}")
+    return restart and pending(batch_id, device_id) > 0 and start_chain(batch_id, device_id)
+
+
+def remaining(batch_id, device_ids):
+    pipe = redis_conn.pipeline(transaction=False)
+    for did in device_ids:
+        pipe.llen(batch_device_key(batch_id, did))
+    return {str(d): int(n or 0) for d, n in zip(device_ids, pipe.execute())}
+
+
+def numbers_at(batch_id, positions, number_col):
+    """Numéros des items aux positions données (un pipeline)."""
+    if not number_col or not positions:
+        return None
+    pipe = redis_conn.pipeline(transaction=False)
+    for pos in positions:
+        pipe.lindex(BATCH_ITEMS_PREFIX + str(batch_id), pos)
+    out = []
+    for raw in pipe.execute():
+        try:
+            out.append(str(json.loads(raw.decode("utf-8")).get(number_col) or "").strip())
+        except Exception:
+            out.append("")
+    return out
+
+
+def rebalance(batch_id, dropped, device_ids, number_col=None):
+    """
+    Device tombé en cours de campagne : ses positions restantes sont réparties
+    entre les autres devices du lot selon leurs poids live (avec affinité : chaque
+    numéro va à son device suivant dans l'ordre de rendez-vous).
+    Retourne {device: nombre ajouté} ({} si aucun device de repli).
+    """
+    dropped = str(dropped)
+    others = [str(d) for d in device_ids if str(d) != dropped]
+    weights = {d: w for d, w in device_weights(others).items() if w > 0}
+    if not weights:
+        return {}
+
+    left = take(batch_id, dropped, 1 << 30)
+    if not left:
+        return {}
+    numbers = numbers_at(batch_id, left, number_col) if ALLOC_AFFINITY else None
+    moved = allocate(batch_id, left, others, weights=weights, backlog=True, numbers=numbers)
+    log(f"⚖️ Lot #{batch_id} : {len(left)} envoi(s) du device {dropped} réparti(s) → {moved}")
+    return moved
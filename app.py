@@ -8,14 +8,48 @@ import random
 import time
 import io
 import csv
+import tempfile
+import itertools
 
-from flask import Flask, request, Response, redirect, url_for, session, render_template_string
-from redis import Redis
+from flask import Flask, request, Response, redirect, url_for, session, render_template, jsonify, stream_with_context
+from flask_compress import Compress
 
 from logger import log
-from tasks import process_message
-
-from openpyxl import load_workbook
+from numlist import render_message, iter_batch_items, batch_columns, load_batch_meta
+from cold_storage import iter_gzip_jsonl
+from nl_import import import_files
+from device_health import fetch_gateway_devices, device_state
+from ingest import INGEST_MODE, enqueue as ingest_enqueue
+from dashboard import hub as dashboard_hub, sse_stream, publish_pool
+from allocation import allocate, device_weights, capacity, remaining as allocation_remaining
+import affinity
+from sweeper import CONV_TTL
+import history
+import attribution
+import nl_pool
+import scheduler
+import delivery
+from keyspace import (
+    CONFIG_KEY,
+    NL_META_KEY,
+    NL_ARCHIVE_LIST,
+    NL_MESSAGE_KEY,
+    NL_TYPE_KEY,
+    BATCH_INDEX,
+    BATCH_ZINDEX,
+    BATCH_META_PREFIX,
+    BATCH_ITEMS_PREFIX,
+    BATCH_POS_PREFIX,
+    BATCH_PROGRESS_PREFIX,
+    BATCH_DISPATCHED_PREFIX,
+    TASK_STATUS_PREFIX,
+    NL_UPLOAD_PREFIX,
+    NL_IMPORT_PREFIX,
+    lazy_main_redis,
+    device_stat_key,
+    device_cycle_key,
+    get_many,
+)
 
 
 # -----------------------
@@ -25,29 +59,55 @@ API_KEY = os.getenv("API_KEY")
 DEBUG_MODE = os.getenv("DEBUG_MODE", "false").lower() == "true"
 LOG_FILE = "/tmp/log.txt"
 
+# import numlist dans la file Celery "imports" (gros fichiers)
+NL_IMPORT_ASYNC = os.getenv("NL_IMPORT_ASYNC", "false").lower() == "true"
+NL_UPLOAD_TTL = 3600
+
+# délai aléatoire avant réponse (secondes)
+REPLY_DELAY_MIN = int(os.getenv("REPLY_DELAY_MIN", "60"))
+REPLY_DELAY_MAX = int(os.getenv("REPLY_DELAY_MAX", "180"))
+
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "")
 APP_SECRET_KEY = os.getenv("APP_SECRET_KEY", "")
 
 SERVER = os.getenv("SERVER")
-REDIS_URL = os.getenv("REDIS_URL")
-redis_conn = Redis.from_url(REDIS_URL)
-
-CONFIG_KEY = "config:autoreply"
-
-# Numlist keys
-NL_META_KEY = "nl:meta"              # json meta
-NL_POOL_LIST = "nl:pool"             # Redis LIST of JSON records (remaining)
-NL_ARCHIVE_LIST = "nl:archive"       # optional: consumed history
-NL_MESSAGE_KEY = "nl:message"        # message template (UI)
-NL_TYPE_KEY = "nl:type"              # sms|mms (UI)
+# config + numlist + stats device : nœud désigné (voir keyspace.py)
+redis_conn = lazy_main_redis()
 
-BATCH_INDEX = "nl:batch:index"       # incr counter
-BATCH_META_PREFIX = "nl:batch:meta:" # +id -> json
-BATCH_ITEMS_PREFIX = "nl:batch:items:"  # +id -> LIST of JSON records
 
+# 🗜️ assets statiques : cache long (URL versionnée par mtime) ; HTML/JSON/CSS/JS compressés
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE", str(365 * 86400)))
 
 app = Flask(__name__)
 app.secret_key = APP_SECRET_KEY or os.urandom(32)
+app.config.update(
+    SEND_FILE_MAX_AGE_DEFAULT=STATIC_MAX_AGE,
+    COMPRESS_MIMETYPES=["text/html", "text/css", "application/javascript", "text/javascript", "application/json"],
+    COMPRESS_MIN_SIZE=500,
+)
+Compress(app)
+
+_asset_versions = {}
+
+
+@app.context_processor
+def _asset_helpers():
+    def asset_url(filename):
+        version = _asset_versions.get(filename)
+        if version is None:
+            try:
+                version = str(int(os.path.getmtime(os.path.join(app.static_folder, filename))))
+            except OSError:
+                version = "0"
+            _asset_versions[filename] = version
+        return url_for("static", filename=filename, v=version)
+    return {"asset_url": asset_url}
+
+
+def _tasks():
+    # Celery + tasks chargés au premier enqueue, pas à l'import du web
+    import tasks
+    return tasks
 
 
 # -----------------------
@@ -63,6 +123,20 @@ def _require_login():
     return None
 
 
+def _require_login_api():
+    if not _is_logged_in():
+        return _json_response({"error": "login requis"}, status=401)
+    return None
+
+
+def _json_response(data, status=200):
+    resp = jsonify(data)
+    resp.status_code = status
+    # données d'exploitation : jamais en cache (la compression reste active)
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+
 # -----------------------
 # CONFIG (autoreply)
 # -----------------------
@@ -73,6 +147,9 @@ def _get_config_defaults():
         "step1_type": "sms",
         "step0_text": "",
         "step1_text": "",
+        "conv_ttl_hours": CONV_TTL / 3600,
+        "reply_windows": "",
+        "reply_tz": "",
     }
 
 
@@ -112,153 +189,40 @@ def _redis_int(key: str) -> int:
         return 0
 
 
-def _device_stats(device_id: str):
-    base = f"stats:device:{device_id}:"
-    return {
-        "device_id": device_id,
-        "received": _redis_int(base + "received"),
-        "sent": _redis_int(base + "sent"),
-        "errors": _redis_int(base + "errors"),
-        "cycle": _redis_int(f"cycle:device:{device_id}:index"),
-        "cycle_sent": _redis_int(f"cycle:device:{device_id}:sent"),
-        "cycle_received": _redis_int(f"cycle:device:{device_id}:received"),
-    }
-
-
-def fetch_gateway_devices():
-    import requests
-    if not SERVER or not API_KEY:
-        return []
-    url = f"{SERVER}/services/get-devices.php"
-    try:
-        r = requests.get(url, params={"key": API_KEY}, timeout=12)
-        data = r.json()
-        if not data.get("success"):
-            return []
-        devices = (data.get("data") or {}).get("devices") or []
-        return devices
-    except Exception as e:
-        log(f"❌ fetch_gateway_devices error: {e}")
-        return []
-
-
-# -----------------------
-# NUM LIST PARSING
-# -----------------------
-def _norm_col(name: str) -> str:
-    return (name or "").strip().lower()
-
-
-def _pick_number_column(columns):
-    if not columns:
-        return None
-    candidates = {"number", "num", "phone", "telephone", "tel", "mobile", "msisdn", "numero", "numéro"}
-    for c in columns:
-        if _norm_col(c) in candidates:
-            return c
-    return columns[0]
-
-
-def _read_csv(file_bytes: bytes):
-    text = None
-    for enc in ("utf-8-sig", "utf-8", "latin-1"):
-        try:
-            text = file_bytes.decode(enc)
-            break
-        except Exception:
-            continue
-    if text is None:
-        raise Exception("Encodage CSV non supporté")
-
-    sample = text[:4096]
-    try:
-        dialect = csv.Sniffer().sniff(sample, delimiters=";,|\t,")
-        delimiter = dialect.delimiter
-    except Exception:
-        delimiter = ","
-
-    reader = csv.reader(io.StringIO(text), delimiter=delimiter)
-    rows = list(reader)
-    if not rows:
-        return [], []
-
-    header = rows[0]
-    data_rows = rows[1:] if any(h.strip() for h in header) else rows
-
-    if not any(h.strip() for h in header):
-        max_len = max(len(r) for r in rows)
-        header = [f"col{i+1}" for i in range(max_len)]
-        data_rows = rows
-
-    cleaned = []
-    for r in data_rows:
-        rr = list(r) + [""] * (len(header) - len(r))
-        cleaned.append(rr[:len(header)])
-
-    return header, cleaned
-
-
-def _read_xlsx(file_bytes: bytes):
-    wb = load_workbook(filename=io.BytesIO(file_bytes), read_only=True, data_only=True)
-    ws = wb.active
+DEVICE_STAT_FIELDS = (
+    ("received", device_stat_key, "received"),
+    ("sent", device_stat_key, "sent"),
+    ("errors", device_stat_key, "errors"),
+    ("delivered", device_stat_key, "delivered"),
+    ("failed", device_stat_key, "failed"),
+    ("cycle", device_cycle_key, "index"),
+    ("cycle_sent", device_cycle_key, "sent"),
+    ("cycle_received", device_cycle_key, "received"),
+)
+
+
+def _device_rows(gw_devices):
+    """Stats de tous les devices en un aller-retour (au lieu d'un GET par compteur)."""
+    ids = [str(d.get("id")) for d in gw_devices]
+    keys = [fn(did, field) for did in ids for _name, fn, field in DEVICE_STAT_FIELDS]
+    values = get_many(redis_conn, keys)
+    n = len(DEVICE_STAT_FIELDS)
     rows = []
-    for row in ws.iter_rows(values_only=True):
-        rows.append([("" if v is None else str(v)) for v in row])
-
-    if not rows:
-        return [], []
-
-    header = rows[0]
-    data_rows = rows[1:]
-
-    if not any(str(h).strip() for h in header):
-        max_len = max(len(r) for r in rows)
-        header = [f"col{i+1}" for i in range(max_len)]
-        data_rows = rows
-
-    header = [str(h).strip() if str(h).strip() else f"col{i+1}" for i, h in enumerate(header)]
-
-    cleaned = []
-    for r in data_rows:
-        rr = list(r) + [""] * (len(header) - len(r))
-        cleaned.append(rr[:len(header)])
-
-    return header, cleaned
-
-
-def _dedupe_header(header):
-    seen = {}
-    final_header = []
-    for h in header:
-        base = (h or "").strip() or "col"
-        if base in seen:
-            seen[base] += 1
-            base = f"{base}_{seen[base]}"
-        else:
-            seen[base] = 1
-        final_header.append(base)
-    return final_header
-
-
-def _build_records(header, rows, number_col):
-    idx = header.index(number_col)
-    records = []
-    for r in rows:
-        if idx >= len(r):
-            continue
-        number = str(r[idx]).strip()
-        if not number:
-            continue
-        rec = {}
-        for i, col in enumerate(header):
-            rec[col] = str(r[i]).strip() if i < len(r) else ""
-        records.append(rec)
-    return records
+    for i, (did, d) in enumerate(zip(ids, gw_devices)):
+        row = {"device_id": did, "name": d.get("name") or "", "model": d.get("model") or ""}
+        for j, (name, _fn, _field) in enumerate(DEVICE_STAT_FIELDS):
+            try:
+                row[name] = int(values[i * n + j] or 0)
+            except (TypeError, ValueError):
+                row[name] = 0
+        row["health"] = device_state(did).get("state")
+        rows.append(row)
+    return rows
 
 
-def _nl_remaining_count():
+def _nl_remaining_count(filters=None):
     try:
-        return int(redis_conn.llen(NL_POOL_LIST) or 0)
+        return nl_pool.count(redis_conn, filters)
     except Exception:
         return 0
 
@@ -273,10 +237,6 @@ def _load_nl_meta():
         return None
 
 
-def _save_nl_meta(meta: dict):
-    redis_conn.set(NL_META_KEY, json.dumps(meta, ensure_ascii=False))
-
-
 def _load_message_draft():
     msg = (redis_conn.get(NL_MESSAGE_KEY) or b"").decode("utf-8", errors="ignore")
     msg_type = (redis_conn.get(NL_TYPE_KEY) or b"sms").decode("utf-8", errors="ignore")
@@ -299,31 +259,20 @@ def _template_vars_from_meta(nl_meta):
 # -----------------------
 # BATCH RESERVATION (consume from pool)
 # -----------------------
-def _reserve_from_pool(count: int):
+def _reserve_from_pool(count: int, filters=None):
     """
     Prend 'count' éléments du pool (remaining) et les retourne (liste de dict).
-    ✅ Consommation réelle : on retire du pool.
+    ✅ Consommation réelle : on retire du pool (filtré par segment si filters).
     """
     if count <= 0:
         return []
 
-    items = []
-    pipe = redis_conn.pipeline()
-    for _ in range(count):
-        pipe.lpop(NL_POOL_LIST)
-    raw_items = pipe.execute()
-
-    for raw in raw_items:
-        if not raw:
-            continue
-        try:
-            items.append(json.loads(raw.decode("utf-8")))
-        except Exception:
-            continue
+    items = nl_pool.reserve(redis_conn, count, filters, number_col=(_load_nl_meta() or {}).get("number_col"))
+    publish_pool(redis_conn)
     return items
 
 
-def _create_batch(selected_device_ids, per_device: int):
+def _create_batch(selected_device_ids, per_device: int, filters=None, schedule=None):
     selected_device_ids = [str(x) for x in (selected_device_ids or []) if str(x).strip()]
     per_device = int(per_device or 0)
     if per_device < 0:
@@ -334,15 +283,18 @@ def _create_batch(selected_device_ids, per_device: int):
     if total <= 0:
         return None, "Total à 0"
 
-    remaining = _nl_remaining_count()
+    filters = nl_pool.normalize_filters(filters)
+    # pool legacy (LIST) migré avant de compter le segment
+    nl_pool.ensure_migrated(redis_conn, (_load_nl_meta() or {}).get("number_col"))
+    remaining = _nl_remaining_count(filters)
     if remaining <= 0:
-        return None, "Numlist vide"
+        return None, "Aucun numéro pour ce segment" if filters else "Numlist vide"
 
     # si pas assez, on prend ce qu’on peut
     to_take = min(total, remaining)
 
     batch_id = str(redis_conn.incr(BATCH_INDEX))
-    reserved = _reserve_from_pool(to_take)
+    reserved = _reserve_from_pool(to_take, filters)
 
     # archive (optionnel) -> garder trace de ce qui a été consommé
     if reserved:
@@ -351,12 +303,24 @@ def _create_batch(selected_device_ids, per_device: int):
             pipe.rpush(NL_ARCHIVE_LIST, json.dumps(rec, ensure_ascii=False))
         pipe.execute()
 
-    # stock batch items
+    # stock batch items + index numéro -> position (recherche)
+    nl_meta = _load_nl_meta() or {}
+    number_col = nl_meta.get("number_col")
+    message, msg_type = _load_message_draft()
     pipe = redis_conn.pipeline()
-    for rec in reserved:
+    for pos, rec in enumerate(reserved):
         pipe.rpush(BATCH_ITEMS_PREFIX + batch_id, json.dumps(rec, ensure_ascii=False))
+        number = str(rec.get(number_col) or "").strip() if number_col else ""
+        if number:
+            pipe.hsetnx(BATCH_POS_PREFIX + batch_id, number, pos)
     pipe.execute()
 
+    # ⚖️ répartition pondérée des items entre devices (sous-listes par device)
+    weights = device_weights(selected_device_ids)
+    numbers = [str(rec.get(number_col) or "").strip() if number_col else "" for rec in reserved]
+    alloc = allocate(batch_id, list(range(len(reserved))), selected_device_ids,
+                     weights=weights, numbers=numbers) if reserved else {}
+
     meta = {
         "batch_id": batch_id,
         "created_at": int(time.time()),
@@ -365,36 +329,170 @@ def _create_batch(selected_device_ids, per_device: int):
         "requested_total": total,
         "taken_total": len(reserved),
         "remaining_after": _nl_remaining_count(),
+        "filters": filters,
+        "schedule": schedule,
+        "number_col": number_col,
+        "columns": list(nl_meta.get("columns") or []),
+        "message": message,
+        "type": msg_type,
+        "allocation": alloc,
+        "weights": {d: round(w, 3) for d, w in weights.items()},
+        "template_id": hashlib.sha1((message or "").encode("utf-8")).hexdigest()[:10],
     }
-    redis_conn.set(BATCH_META_PREFIX + batch_id, json.dumps(meta, ensure_ascii=False))
+    # 🎯 index numéro -> lot (attribution des réponses), écrit en masse
+    try:
+        attribution.index_batch(redis_conn, batch_id, numbers)
+    except Exception as e:
+        log(f"❌ Attribution lot {batch_id} : {e}")
+
+    pipe = redis_conn.pipeline()
+    pipe.set(BATCH_META_PREFIX + batch_id, json.dumps(meta, ensure_ascii=False))
+    pipe.zadd(BATCH_ZINDEX, {batch_id: meta["created_at"]})
+    pipe.execute()
 
     return meta, None
 
 
-def _list_last_batches(limit=10):
-    # on prend les derniers batch_ids via incr index
+# -----------------------
+# BATCH HISTORY / BROWSER
+# -----------------------
+def _decode_json(raw):
+    if not raw:
+        return None
+    try:
+        return json.loads(raw.decode("utf-8"))
+    except Exception:
+        return None
+
+
+def _load_batch_meta(batch_id: str):
+    return load_batch_meta(batch_id, redis_conn)
+
+
+def _backfill_batch_index(chunk=500):
+    """
+    Une seule fois : reconstruit nl:batch:zindex depuis les anciens ids (compteur).
+    """
     idx = _redis_int(BATCH_INDEX)
+    added = 0
+    for hi in range(idx, 0, -chunk):
+        ids = [str(i) for i in range(hi, max(0, hi - chunk), -1)]
+        raws = get_many(redis_conn, [BATCH_META_PREFIX + i for i in ids])
+        mapping = {}
+        for batch_id, raw in zip(ids, raws):
+            meta = _decode_json(raw)
+            if meta:
+                mapping[batch_id] = int(meta.get("created_at") or 0)
+        if mapping:
+            redis_conn.zadd(BATCH_ZINDEX, mapping)
+            added += len(mapping)
+    return added
+
+
+def _list_last_batches(limit=10, offset=0):
+    if not redis_conn.exists(BATCH_ZINDEX) and _redis_int(BATCH_INDEX) > 0:
+        _backfill_batch_index()
+
+    ids = [b.decode("utf-8") for b in redis_conn.zrevrange(BATCH_ZINDEX, offset, offset + limit - 1)]
+    if not ids:
+        return []
+
+    raws = get_many(redis_conn, [BATCH_META_PREFIX + i for i in ids])
     out = []
-    for i in range(idx, max(0, idx - limit), -1):
-        raw = redis_conn.get(BATCH_META_PREFIX + str(i))
-        if not raw:
-            continue
-        try:
-            out.append(json.loads(raw.decode("utf-8")))
-        except Exception:
+    stale = []
+    for batch_id, raw in zip(ids, raws):
+        meta = _decode_json(raw)
+        if meta is None:
+            stale.append(batch_id)
             continue
+        out.append(meta)
+
+    # meta supprimée -> on nettoie l'index
+    if stale:
+        redis_conn.zrem(BATCH_ZINDEX, *stale)
     return out
 
 
-def _load_batch_items(batch_id: str, limit=50):
-    raw_items = redis_conn.lrange(BATCH_ITEMS_PREFIX + str(batch_id), 0, max(0, limit - 1))
+def _count_batches():
+    try:
+        return int(redis_conn.zcard(BATCH_ZINDEX) or 0)
+    except Exception:
+        return 0
+
+
+def _load_batch_items(batch_id: str, cursor=0, limit=50):
+    """
+    Page d'items (cursor = position de départ). Retourne (items, next_cursor|None).
+    Chaque item : {"pos": int, "rec": dict}.
+    """
+    cursor = max(0, int(cursor or 0))
+    raw_items = redis_conn.lrange(BATCH_ITEMS_PREFIX + str(batch_id), cursor, cursor + max(1, limit) - 1)
     items = []
-    for raw in raw_items:
-        try:
-            items.append(json.loads(raw.decode("utf-8")))
-        except Exception:
-            continue
-    return items
+    for i, raw in enumerate(raw_items):
+        rec = _decode_json(raw)
+        if rec is not None:
+            items.append({"pos": cursor + i, "rec": rec})
+    next_cursor = cursor + len(raw_items) if len(raw_items) >= limit else None
+    return items, next_cursor
+
+
+def _ensure_batch_positions(batch_id: str, number_col, chunk=1000):
+    """Lots créés avant l'index numéro -> position : on le construit à la demande."""
+    pos_key = BATCH_POS_PREFIX + str(batch_id)
+    if redis_conn.exists(pos_key) or not number_col:
+        return
+    items_key = BATCH_ITEMS_PREFIX + str(batch_id)
+    start = 0
+    while True:
+        raws = redis_conn.lrange(items_key, start, start + chunk - 1)
+        if not raws:
+            break
+        pipe = redis_conn.pipeline()
+        for i, raw in enumerate(raws):
+            rec = _decode_json(raw) or {}
+            number = str(rec.get(number_col) or "").strip()
+            if number:
+                pipe.hsetnx(pos_key, number, start + i)
+        pipe.execute()
+        start += len(raws)
+
+
+def _search_batch_items(batch_id: str, query: str, number_col, cursor=0, limit=50, max_rounds=20):
+    """
+    Recherche par numéro : exact via HGET, sinon HSCAN MATCH *query* paginé.
+    Retourne (items, next_cursor|None) comme _load_batch_items.
+    """
+    query = (query or "").strip()
+    _ensure_batch_positions(batch_id, number_col)
+    pos_key = BATCH_POS_PREFIX + str(batch_id)
+
+    positions = []
+    if not cursor:
+        exact = redis_conn.hget(pos_key, query)
+        if exact is not None:
+            positions.append(int(exact))
+
+    next_cursor = None
+    if not positions:
+        scan_cursor = int(cursor or 0)
+        pattern = "*" + query.replace("*", "").replace("?", "") + "*"
+        for _ in range(max_rounds):
+            scan_cursor, found = redis_conn.hscan(pos_key, scan_cursor, match=pattern, count=limit * 10)
+            positions.extend(int(v) for v in found.values())
+            if scan_cursor == 0 or len(positions) >= limit:
+                break
+        next_cursor = scan_cursor or None
+
+    items_key = BATCH_ITEMS_PREFIX + str(batch_id)
+    pipe = redis_conn.pipeline()
+    for pos in positions:
+        pipe.lindex(items_key, pos)
+    items = []
+    for pos, raw in zip(positions, pipe.execute()):
+        rec = _decode_json(raw)
+        if rec is not None:
+            items.append({"pos": pos, "rec": rec})
+    return items, next_cursor
 
 
 # -----------------------
@@ -409,43 +507,7 @@ def admin_login():
             return redirect(url_for("admin_settings"))
         return Response("Mot de passe incorrect", status=401, mimetype="text/plain")
 
-    return render_template_string("""
-<!doctype html>
-<html>
-<head>
-  <meta charset="utf-8">
-  <title>Login</title>
-  <meta name="viewport" content="width=device-width, initial-scale=1">
-  <style>
-    :root{--bg:#070a12;--card:#121a2a;--line:#22304a;--txt:#e8eefc;--muted:#8aa0c7;--btn:#2d6cdf;}
-    body{margin:0;background:linear-gradient(180deg,#070a12 0%, #0b0f1a 100%);color:var(--txt);font-family:Arial;}
-    .wrap{max-width:520px;margin:0 auto;padding:22px;}
-    .card{background:var(--card);border:1px solid var(--line);border-radius:16px;padding:18px;margin-top:34px;}
-    label{display:block;font-size:12px;color:var(--muted);margin-bottom:6px}
-    input{
-      width:100%;box-sizing:border-box;background:#0e1626;border:1px solid var(--line);
-      color:var(--txt);padding:12px;border-radius:12px;outline:none;
-    }
-    .btn{background:var(--btn);border:0;color:white;padding:12px 14px;border-radius:12px;cursor:pointer;font-weight:800;margin-top:12px;width:100%}
-    h2{margin:0 0 8px 0}
-    .muted{color:var(--muted);font-size:12px}
-  </style>
-</head>
-<body>
-  <div class="wrap">
-    <div class="card">
-      <h2>Connexion</h2>
-      <div class="muted">Accès au panneau</div>
-      <form method="post" style="margin-top:14px">
-        <label>Mot de passe</label>
-        <input type="password" name="password" autocomplete="current-password">
-        <button class="btn" type="submit">Se connecter</button>
-      </form>
-    </div>
-  </div>
-</body>
-</html>
-""")
+    return render_template("login.html")
 
 
 @app.route("/admin/logout")
@@ -473,83 +535,80 @@ def admin_nl_clear():
 
     # clear pool + meta + message draft
     redis_conn.delete(NL_META_KEY)
-    redis_conn.delete(NL_POOL_LIST)
+    nl_pool.clear(redis_conn)
+    publish_pool(redis_conn)
     # on ne touche pas l'archive ni les batchs
     return redirect(url_for("admin_settings"))
 
 
-@app.route("/admin/nl/upload", methods=["POST"])
-def admin_nl_upload():
-    guard = _require_login()
-    if guard:
-        return guard
+def _stash_upload(files):
+    """Dépose les fichiers dans Redis (TTL) pour la tâche import_numlist."""
+    import_id = uuid.uuid4().hex[:12]
+    upload_key = NL_UPLOAD_PREFIX + import_id
+    pipe = redis_conn.pipeline()
+    for i, f in enumerate(files):
+        pipe.hset(upload_key, f"{i}:name", f.filename or "")
+        pipe.hset(upload_key, f"{i}:data", f.read())
+    pipe.expire(upload_key, NL_UPLOAD_TTL)
+    pipe.hset(NL_IMPORT_PREFIX + import_id, mapping={"status": "queued", "files": len(files)})
+    pipe.expire(NL_IMPORT_PREFIX + import_id, NL_UPLOAD_TTL)
+    pipe.execute()
+    return import_id
 
-    files = request.files.getlist("files")
-    if not files:
-        return Response("Fichier manquant", status=400)
 
-    all_records = []
-    all_columns = None
-    number_col_global = None
+def _load_import_status(import_id):
+    raw = redis_conn.hgetall(NL_IMPORT_PREFIX + str(import_id))
+    return {k.decode("utf-8"): v.decode("utf-8", errors="ignore") for k, v in raw.items()}
 
-    try:
-        for f in files:
-            filename = (f.filename or "").lower().strip()
-            file_bytes = f.read()
-            if not file_bytes:
-                continue
-
-            if filename.endswith(".csv"):
-                header, rows = _read_csv(file_bytes)
-            elif filename.endswith(".xlsx"):
-                header, rows = _read_xlsx(file_bytes)
-            else:
-                continue
 
-            header = _dedupe_header(header)
-            number_col = _pick_number_column(header)
-            if not number_col:
-                continue
+def _load_task_status(name):
+    raw = redis_conn.hgetall(TASK_STATUS_PREFIX + name)
+    return {k.decode("utf-8"): v.decode("utf-8", errors="ignore") for k, v in raw.items()}
 
-            records = _build_records(header, rows, number_col)
 
-            if all_columns is None:
-                all_columns = header
-                number_col_global = number_col
-            else:
-                for c in header:
-                    if c not in all_columns:
-                        all_columns.append(c)
+def _load_batch_progress(batch_id):
+    raw = redis_conn.hgetall(BATCH_PROGRESS_PREFIX + str(batch_id))
+    return {k.decode("utf-8"): int(v or 0) for k, v in raw.items()}
 
-            # normalise records sur all_columns
-            for rec in records:
-                for c in all_columns:
-                    rec.setdefault(c, "")
-                all_records.append(rec)
 
-        if not all_records or not all_columns:
-            return Response("Aucun numéro importé", status=400)
+def _reply_rates(batch_ids):
+    """{batch_id: {replies, repliers, last_at, sent, rate}} — deux pipelines pour la page."""
+    batch_ids = [str(i) for i in batch_ids]
+    if not batch_ids:
+        return {}
+    stats = attribution.reply_stats(redis_conn, batch_ids)
+    pipe = redis_conn.pipeline(transaction=False)
+    for batch_id in batch_ids:
+        pipe.hget(BATCH_PROGRESS_PREFIX + batch_id, "sent")
+    for batch_id, sent in zip(batch_ids, pipe.execute()):
+        st = stats[batch_id]
+        st["sent"] = int(sent or 0)
+        st["rate"] = attribution.reply_rate(st, st["sent"])
+    return stats
 
-        if number_col_global not in all_columns:
-            number_col_global = _pick_number_column(all_columns)
 
-        # push into pool (remaining) WITHOUT clearing existing (tu peux importer plusieurs fois)
-        pipe = redis_conn.pipeline()
-        for rec in all_records:
-            pipe.rpush(NL_POOL_LIST, json.dumps(rec, ensure_ascii=False))
-        pipe.execute()
+@app.route("/admin/nl/upload", methods=["POST"])
+def admin_nl_upload():
+    guard = _require_login()
+    if guard:
+        return guard
 
-        variables = [c for c in all_columns if c != number_col_global]
-        meta = {
-            "columns": all_columns,
-            "number_col": number_col_global,
-            "variables": variables,
-            "updated_at": int(time.time()),
-        }
-        _save_nl_meta(meta)
+    files = request.files.getlist("files")
+    if not files:
+        return Response("Fichier manquant", status=400)
 
+    try:
+        if NL_IMPORT_ASYNC:
+            # gros fichiers : parsing + push dans la file "imports"
+            import_id = _stash_upload(files)
+            _tasks().import_numlist.delay(import_id)
+            return redirect(url_for("admin_settings", import_id=import_id))
+
+        import_files([(f.filename, f.read()) for f in files], redis_conn)
         return redirect(url_for("admin_settings"))
 
+    except ValueError as e:
+        return Response(str(e), status=400)
     except Exception as e:
         log(f"❌ NL upload error: {e}")
         return Response(f"Erreur import: {e}", status=400)
@@ -567,6 +626,31 @@ def admin_nl_message():
     return redirect(url_for("admin_settings"))
 
 
+def _segment_filters(source):
+    """Champs seg_<colonne>=<valeur> (formulaire d'envoi / query string)."""
+    return {k[4:]: v for k, v in source.items() if k.startswith("seg_") and (v or "").strip()}
+
+
+def _campaign_schedule(form):
+    """Début / fin (heure locale du fuseau), plages horaires, plafond par device ; None si rien."""
+    tz = (form.get("sched_tz") or "").strip() or scheduler.SCHED_TZ
+    try:
+        cap = max(0, int(form.get("sched_daily_cap") or 0))
+    except ValueError:
+        cap = 0
+    sched = {
+        "start_at": scheduler.parse_local(form.get("sched_start"), tz),
+        "end_at": scheduler.parse_local(form.get("sched_end"), tz),
+        "windows": scheduler.format_windows(form.get("sched_windows")),
+        "daily_cap": cap,
+    }
+    sched = {k: v for k, v in sched.items() if v}
+    if not sched:
+        return None
+    sched["tz"] = tz
+    return sched
+
+
 @app.route("/admin/nl/send", methods=["POST"])
 def admin_nl_send():
     """
@@ -580,13 +664,164 @@ def admin_nl_send():
     per_device = int(request.form.get("per_device") or 0)
     device_ids = request.form.getlist("device_ids")
 
-    meta, err = _create_batch(device_ids, per_device)
+    meta, err = _create_batch(device_ids, per_device, filters=_segment_filters(request.form),
+                              schedule=_campaign_schedule(request.form))
     if err:
         return Response(err, status=400, mimetype="text/plain")
 
     return redirect(url_for("admin_settings", batch=meta["batch_id"]))
 
 
+# -----------------------
+# ROUTES: BATCH EXPORT (streaming)
+# -----------------------
+EXPORT_CHUNK = 1000
+
+
+def _iter_export_items(meta):
+    # lot compacté -> lecture directe du fichier gzip (la copie Redis n'existe plus)
+    if meta.get("cold"):
+        return iter_gzip_jsonl(meta["cold_path"])
+    return iter_batch_items(meta["batch_id"], chunk=EXPORT_CHUNK, redis_conn=redis_conn)
+
+
+def _export_rows(items, columns, template):
+    for rec in items:
+        row = [rec.get(c, "") for c in columns]
+        if template is not None:
+            row.append(render_message(template, rec))
+        yield row
+
+
+def _csv_stream(rows, header):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    buf.write("\ufeff")  # BOM -> Excel lit l'UTF-8
+    writer.writerow(header)
+    n = 0
+    for row in rows:
+        writer.writerow(row)
+        n += 1
+        if n % EXPORT_CHUNK == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate(0)
+    yield buf.getvalue()
+
+
+def _xlsx_stream(rows, header, sheet_title):
+    # write_only : les lignes partent dans un fichier temporaire, pas en mémoire
+    tmp = tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False)
+    tmp.close()
+    try:
+        from openpyxl import Workbook
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet(sheet_title)
+        ws.append(header)
+        for row in rows:
+            ws.append(row)
+        wb.save(tmp.name)
+        with open(tmp.name, "rb") as f:
+            while True:
+                chunk = f.read(64 * 1024)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        try:
+            os.remove(tmp.name)
+        except OSError:
+            pass
+
+
+@app.route("/admin/nl/batch/<batch_id>/export", methods=["GET"])
+def admin_nl_batch_export(batch_id):
+    guard = _require_login()
+    if guard:
+        return guard
+
+    meta = _load_batch_meta(batch_id)
+    if not meta:
+        return Response("Lot introuvable", status=404, mimetype="text/plain")
+
+    if meta.get("cold") and not (meta.get("cold_path") and os.path.exists(meta["cold_path"])):
+        # fichier d'archive absent de ce process (volume non partagé / perdu) : pas d'export vide
+        return Response("Archive du lot introuvable sur ce serveur", status=409, mimetype="text/plain")
+
+    fmt = (request.args.get("format") or "csv").strip().lower()
+    with_message = request.args.get("message") == "1"
+
+    # un seul passage sur les items (chunks Redis ou gzip) : colonnes du lot / nl:meta,
+    # sinon premier record lu puis remis en tête du flux
+    items = _iter_export_items(meta)
+    columns = batch_columns(meta, _load_nl_meta())
+    if not columns:
+        first = next(items, None)
+        columns = batch_columns(meta, None, first)
+        if first is not None:
+            items = itertools.chain([first], items)
+
+    template = None
+    header = list(columns)
+    if with_message:
+        template = meta.get("message")
+        if template is None:
+            template, _ = _load_message_draft()
+        header.append("message")
+
+    rows = _export_rows(items, columns, template)
+    filename = f"lot-{meta['batch_id']}"
+
+    if fmt == "xlsx":
+        return Response(
+            stream_with_context(_xlsx_stream(rows, header, filename)),
+            mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.xlsx"'},
+        )
+
+    return Response(
+        stream_with_context(_csv_stream(rows, header)),
+        mimetype="text/csv; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="{filename}.csv"'},
+    )
+
+
+@app.route("/admin/nl/batch/<batch_id>/dispatch", methods=["POST"])
+def admin_nl_batch_dispatch(batch_id):
+    """Lance l'envoi du lot via le gateway (file Celery "campaigns")."""
+    guard = _require_login()
+    if guard:
+        return guard
+    meta = _load_batch_meta(batch_id)
+    if not meta:
+        return Response("Lot introuvable", status=404, mimetype="text/plain")
+    if meta.get("dispatched_at") or redis_conn.exists(BATCH_DISPATCHED_PREFIX + str(batch_id)):
+        return Response("Lot déjà lancé", status=409, mimetype="text/plain")
+    _tasks().dispatch_batch.delay(str(batch_id))
+    return redirect(url_for("admin_settings", batch=batch_id))
+
+
+# -----------------------
+# ROUTES: COLD STORAGE
+# -----------------------
+@app.route("/admin/nl/batch/<batch_id>/restore", methods=["POST"])
+def admin_nl_batch_restore(batch_id):
+    guard = _require_login()
+    if guard:
+        return guard
+    _tasks().restore_batch.delay(str(batch_id))
+    return redirect(url_for("admin_settings", batch=batch_id))
+
+
+@app.route("/admin/nl/compact", methods=["POST"])
+def admin_nl_compact():
+    guard = _require_login()
+    if guard:
+        return guard
+    _tasks().compact_archives.delay()
+    return redirect(url_for("admin_settings"))
+
+
 # -----------------------
 # ROUTES: SETTINGS / UI
 # -----------------------
@@ -604,6 +839,12 @@ def admin_settings():
         step1_type = (request.form.get("step1_type") or "sms").strip().lower()
         step0_text = (request.form.get("step0_text") or "").strip()
         step1_text = (request.form.get("step1_text") or "").strip()
+        try:
+            conv_ttl_hours = max(0.0, float(request.form.get("conv_ttl_hours") or 0))
+        except ValueError:
+            conv_ttl_hours = 0
+        reply_windows = scheduler.format_windows(request.form.get("reply_windows"))
+        reply_tz = (request.form.get("reply_tz") or "").strip()
 
         if reply_mode not in (1, 2):
             reply_mode = 2
@@ -620,452 +861,303 @@ def admin_settings():
             "step1_type": step1_type,
             "step0_text": step0_text,
             "step1_text": step1_text,
+            "conv_ttl_hours": conv_ttl_hours,
+            "reply_windows": reply_windows,
+            "reply_tz": reply_tz,
         })
         save_config(cfg)
         return redirect(url_for("admin_settings"))
 
+    # page "coquille" : appareils, lots et items arrivent par /admin/api/* (settings.js)
     nl_meta = _load_nl_meta()
     remaining = _nl_remaining_count()
     nl_message, nl_type = _load_message_draft()
-
-    # devices from gateway
-    gw_devices = fetch_gateway_devices()
-    rows = []
-    for d in gw_devices:
-        did = str(d.get("id"))
-        s = _device_stats(did)
-        s.update({"name": d.get("name") or "", "model": d.get("model") or ""})
-        rows.append(s)
-
     vars_list = _template_vars_from_meta(nl_meta)
 
-    # last batches + optional selected batch
-    batches = _list_last_batches(limit=8)
-    selected_batch = request.args.get("batch")
-    selected_meta = None
-    selected_items = []
-    if selected_batch:
-        raw = redis_conn.get(BATCH_META_PREFIX + str(selected_batch))
-        if raw:
-            try:
-                selected_meta = json.loads(raw.decode("utf-8"))
-            except Exception:
-                selected_meta = None
-        if selected_meta:
-            selected_items = _load_batch_items(selected_batch, limit=25)
-
-    return render_template_string("""
-<!doctype html>
-<html>
-<head>
-  <meta charset="utf-8">
-  <title>Control</title>
-  <meta name="viewport" content="width=device-width, initial-scale=1">
-  <style>
-    :root{
-      --bg:#070a12; --card:#121a2a; --line:#22304a; --txt:#e8eefc; --muted:#8aa0c7;
-      --btn:#2d6cdf; --good:#24d18f;
-    }
-    body{margin:0;background:linear-gradient(180deg,#070a12 0%, #0b0f1a 100%);color:var(--txt);font-family:Arial;}
-    .wrap{max-width:1200px;margin:0 auto;padding:18px;}
-    .top{display:flex;justify-content:space-between;align-items:center;margin-bottom:12px;}
-    .top h2{margin:0;font-size:18px;}
-    a{color:#9bc1ff;text-decoration:none;font-weight:700}
-    .card{background:var(--card);border:1px solid var(--line);border-radius:16px;padding:16px;margin-top:12px;}
-    .muted{color:var(--muted);font-size:12px}
-    .title{font-weight:900;margin-bottom:10px}
-    .row{display:flex;gap:12px;flex-wrap:wrap;align-items:flex-end}
-    label{display:block;font-size:12px;color:var(--muted);margin-bottom:6px}
-    textarea, select, input[type="file"], input[type="number"]{
-      width:100%;box-sizing:border-box;background:#0e1626;border:1px solid var(--line);
-      color:var(--txt);padding:12px;border-radius:12px;outline:none;
-    }
-    textarea{min-height:90px;resize:vertical}
-    select{appearance:none;background-image:
-      linear-gradient(45deg,transparent 50%,#9bc1ff 50%),
-      linear-gradient(135deg,#9bc1ff 50%,transparent 50%);
-      background-position: calc(100% - 18px) calc(50% - 3px), calc(100% - 12px) calc(50% - 3px);
-      background-size: 6px 6px, 6px 6px;
-      background-repeat:no-repeat;
-    }
-    .actions{display:flex;gap:10px;flex-wrap:wrap;margin-top:10px}
-    .btn{
-      height:42px; display:inline-flex; align-items:center; justify-content:center;
-      padding:0 16px; border-radius:12px; cursor:pointer; font-weight:900;
-      border:1px solid var(--line); text-decoration:none;
-    }
-    .btn-primary{background:var(--btn); color:white; border:0}
-    .btn-secondary{background:#0e1626; color:#cfe0ff}
-    .btn-danger{background:#2a1220; color:#ffb6c6; border:1px solid #4a22304a}
-    .pill{display:inline-flex;gap:8px;align-items:center;background:#0e1626;border:1px solid var(--line);padding:10px 12px;border-radius:14px}
-    .dot{width:9px;height:9px;border-radius:99px;background:var(--good)}
-    table{width:100%;border-collapse:collapse}
-    th,td{padding:10px;border-bottom:1px solid var(--line);text-align:left;font-size:13px}
-    th{color:var(--muted);font-weight:900}
-    code{background:#0e1626;padding:2px 6px;border-radius:10px;border:1px solid var(--line)}
-    .chips{display:flex;gap:8px;flex-wrap:wrap;margin-top:8px}
-    .chip{
-      border:1px solid var(--line); background:#0e1626; color:#cfe0ff;
-      padding:8px 10px; border-radius:999px; cursor:pointer; font-weight:900; font-size:12px;
-    }
-    .chip:hover{filter:brightness(1.15)}
-    .grid2{display:grid;grid-template-columns:1fr;gap:12px}
-    @media(min-width:900px){ .grid2{grid-template-columns:1fr 1fr} }
-  </style>
-</head>
-<body>
-  <div class="wrap">
-    <div class="top">
-      <h2>Panneau de contrôle</h2>
-      <div style="display:flex;gap:12px;align-items:center">
-        <a href="/logs" target="_blank">Logs</a>
-        <a href="/admin/logout">Logout</a>
-      </div>
-    </div>
-
-    <!-- DEVICES -->
-    <div class="card">
-      <div class="title">Appareils</div>
-      <table>
-        <thead>
-          <tr>
-            <th>Device</th>
-            <th>Nom / Modèle</th>
-            <th>Reçus</th>
-            <th>Envoyés</th>
-            <th>Erreurs</th>
-            <th>Cycle</th>
-            <th>Reçus cycle</th>
-            <th>Envoyés cycle</th>
-          </tr>
-        </thead>
-        <tbody>
-          {% if rows|length == 0 %}
-            <tr><td colspan="8" class="muted">Aucun device (vérifie SERVER/API_KEY).</td></tr>
-          {% endif %}
-          {% for r in rows %}
-            <tr>
-              <td><div class="pill"><span class="dot"></span><span style="font-weight:900">#{{ r.device_id }}</span></div></td>
-              <td><div style="font-weight:900">{{ r.name }}</div><div class="muted">{{ r.model }}</div></td>
-              <td>{{ r.received }}</td>
-              <td>{{ r.sent }}</td>
-              <td>{{ r.errors }}</td>
-              <td>{{ r.cycle }}</td>
-              <td>{{ r.cycle_received }}</td>
-              <td>{{ r.cycle_sent }}</td>
-            </tr>
-          {% endfor %}
-        </tbody>
-      </table>
-    </div>
-
-    <!-- NUMLIST + MESSAGE -->
-    <div class="card">
-      <div class="title">Numlist + Message</div>
-
-      <div class="row">
-        <div class="pill" style="min-width:260px">
-          <div>
-            <div class="muted">Numéros restants</div>
-            <div style="font-size:26px;font-weight:900">{{ remaining }}</div>
-          </div>
-        </div>
-
-        {% if nl_meta %}
-          <div class="pill" style="min-width:260px">
-            <div>
-              <div class="muted">Colonne numéro</div>
-              <div style="font-weight:900"><code>{{ nl_meta.number_col }}</code></div>
-            </div>
-          </div>
-        {% endif %}
-      </div>
-
-      <div class="grid2" style="margin-top:12px">
-        <div>
-          <form method="post" action="/admin/nl/upload" enctype="multipart/form-data">
-            <label>Importer des fichiers (.xlsx ou .csv)</label>
-            <input type="file" name="files" accept=".xlsx,.csv" multiple required>
-            <div class="actions">
-              <button class="btn btn-secondary" type="submit">Importer</button>
-              <a class="btn btn-danger" href="/admin/nl/clear">Vider</a>
-            </div>
-          </form>
-
-          {% if vars_list|length > 0 %}
-            <div class="muted" style="margin-top:12px">Variables détectées :</div>
-            <div class="chips">
-              {% for v in vars_list %}
-                <div class="chip" onclick="insertVar('{{ v }}')">{{'{{'}}{{ v }}{{'}}'}}</div>
-              {% endfor %}
-            </div>
-          {% else %}
-            <div class="muted" style="margin-top:12px">Aucune variable (fichier 1 colonne ou seulement numéro)</div>
-          {% endif %}
-        </div>
-
-        <div>
-          <form method="post" action="/admin/nl/message">
-            <div class="row">
-              <div style="min-width:220px;flex:1;max-width:320px">
-                <label>Type</label>
-                <select name="nl_type">
-                  <option value="sms" {% if nl_type == 'sms' %}selected{% endif %}>sms</option>
-                  <option value="mms" {% if nl_type == 'mms' %}selected{% endif %}>mms</option>
-                </select>
-              </div>
-            </div>
-
-            <div style="margin-top:10px">
-              <label>Message</label>
-              <textarea id="nl_message" name="nl_message">{{ nl_message }}</textarea>
-            </div>
-
-            <div class="actions">
-              <button class="btn btn-primary" type="submit">Enregistrer message</button>
-            </div>
-          </form>
-        </div>
-      </div>
-
-      <form method="post" action="/admin/nl/send" style="margin-top:14px">
-        <div class="row">
-          <div style="min-width:260px;max-width:320px;flex:1">
-            <label>Nombre par appareil</label>
-            <input type="number" min="0" name="per_device" value="0">
-          </div>
-        </div>
-
-        <div class="muted" style="margin-top:10px">Appareils sélectionnés :</div>
-        <div class="chips" style="margin-top:8px">
-          {% for r in rows %}
-            <label class="chip" style="display:inline-flex;align-items:center;gap:8px">
-              <input type="checkbox" name="device_ids" value="{{ r.device_id }}" style="accent-color:#2d6cdf">
-              #{{ r.device_id }}
-            </label>
-          {% endfor %}
-        </div>
-
-        <div class="actions" style="margin-top:12px">
-          <button class="btn btn-primary" type="submit">Envoyer (prépare le lot)</button>
-        </div>
-
-        <div class="muted" style="margin-top:8px">
-          Ce bouton prépare un lot (consomme des numéros) et affiche un payload prêt à envoyer via ton gateway.
-        </div>
-      </form>
-    </div>
-
-    <!-- BATCH RESULT -->
-    {% if selected_meta %}
-      <div class="card">
-        <div class="title">Lot #{{ selected_meta.batch_id }}</div>
-        <div class="muted">
-          Pris: <b>{{ selected_meta.taken_total }}</b> / demandé: {{ selected_meta.requested_total }} •
-          Restants: <b>{{ selected_meta.remaining_after }}</b>
-        </div>
-
-        <div style="margin-top:10px" class="muted">Payload (extrait 25 lignes max) :</div>
-        <div style="margin-top:6px;max-height:260px;overflow:auto;border:1px solid var(--line);border-radius:12px">
-          <table>
-            <thead>
-              <tr>
-                <th>number</th>
-                <th>data</th>
-              </tr>
-            </thead>
-            <tbody>
-              {% for rec in selected_items %}
-                <tr>
-                  <td>{{ rec.get(nl_meta.number_col, '') if nl_meta else '' }}</td>
-                  <td class="muted">{{ rec }}</td>
-                </tr>
-              {% endfor %}
-            </tbody>
-          </table>
-        </div>
-
-        <div class="muted" style="margin-top:10px">
-          Type: <code>{{ nl_type }}</code> • Message: enregistré (variables possible).
-        </div>
-      </div>
-    {% endif %}
-
-    <!-- LAST BATCHES -->
-    {% if batches|length > 0 %}
-      <div class="card">
-        <div class="title">Derniers lots</div>
-        <table>
-          <thead>
-            <tr>
-              <th>ID</th>
-              <th>Pris</th>
-              <th>Demandé</th>
-              <th>Appareils</th>
-              <th>Restants après</th>
-              <th>Voir</th>
-            </tr>
-          </thead>
-          <tbody>
-            {% for b in batches %}
-              <tr>
-                <td>#{{ b.batch_id }}</td>
-                <td>{{ b.taken_total }}</td>
-                <td>{{ b.requested_total }}</td>
-                <td class="muted">{{ b.devices }}</td>
-                <td>{{ b.remaining_after }}</td>
-                <td><a href="/admin/settings?batch={{ b.batch_id }}">ouvrir</a></td>
-              </tr>
-            {% endfor %}
-          </tbody>
-        </table>
-      </div>
-    {% endif %}
-
-    <!-- AUTOREPLY (optionnel) -->
-    <div class="card">
-      <div class="title">Auto-reply</div>
-      <form method="post">
-        <input type="hidden" name="form_name" value="autoreply">
-
-        <div class="row">
-          <div style="min-width:260px;flex:1;max-width:320px">
-            <label>Mode</label>
-            <select id="reply_mode" name="reply_mode">
-              <option value="1" {% if cfg.reply_mode == 1 %}selected{% endif %}>1 réponse (puis stop)</option>
-              <option value="2" {% if cfg.reply_mode == 2 %}selected{% endif %}>2 réponses (puis stop)</option>
-            </select>
-          </div>
-        </div>
-
-        <div class="card" style="padding:12px;margin-top:10px">
-          <div class="title">Step 1</div>
-          <div class="row">
-            <div style="min-width:220px;flex:1;max-width:320px">
-              <label>Type</label>
-              <select name="step0_type">
-                <option value="sms" {% if cfg.step0_type == 'sms' %}selected{% endif %}>sms</option>
-                <option value="mms" {% if cfg.step0_type == 'mms' %}selected{% endif %}>mms</option>
-              </select>
-            </div>
-          </div>
-          <div style="margin-top:10px">
-            <label>Message</label>
-            <textarea name="step0_text">{{ cfg.step0_text }}</textarea>
-          </div>
-        </div>
-
-        <div id="step2_block" class="card" style="padding:12px;margin-top:10px">
-          <div class="title">Step 2</div>
-          <div class="row">
-            <div style="min-width:220px;flex:1;max-width:320px">
-              <label>Type</label>
-              <select name="step1_type">
-                <option value="sms" {% if cfg.step1_type == 'sms' %}selected{% endif %}>sms</option>
-                <option value="mms" {% if cfg.step1_type == 'mms' %}selected{% endif %}>mms</option>
-              </select>
-            </div>
-          </div>
-          <div style="margin-top:10px">
-            <label>Message</label>
-            <textarea name="step1_text">{{ cfg.step1_text }}</textarea>
-          </div>
-        </div>
-
-        <div class="actions">
-          <button class="btn btn-primary" type="submit">Sauvegarder réponses</button>
-        </div>
-      </form>
-    </div>
-
-  </div>
-
-  <script>
-    function insertVar(name){
-      const el = document.getElementById("nl_message");
-      if(!el) return;
-      const token = "{{" + name + "}}";
-      const start = el.selectionStart || 0;
-      const end = el.selectionEnd || 0;
-      const before = el.value.substring(0, start);
-      const after = el.value.substring(end);
-      el.value = before + token + after;
-      el.focus();
-      const pos = start + token.length;
-      el.setSelectionRange(pos, pos);
-    }
+    import_id = request.args.get("import_id")
+    import_status = _load_import_status(import_id) if import_id else None
 
-    function toggleStep2() {
-      const mode = document.getElementById("reply_mode").value;
-      const block = document.getElementById("step2_block");
-      if (mode === "1") block.style.display = "none";
-      else block.style.display = "block";
-    }
-    document.getElementById("reply_mode").addEventListener("change", toggleStep2);
-    toggleStep2();
-  </script>
-</body>
-</html>
-""",
+    return render_template(
+        "settings.html",
         cfg=cfg,
-        rows=rows,
+        sweep_status=_load_task_status("sweep_conversations"),
+        sched_tz=scheduler.SCHED_TZ,
         nl_meta=nl_meta,
         remaining=remaining,
         nl_message=nl_message,
         nl_type=nl_type,
         vars_list=vars_list,
-        batches=batches,
-        selected_meta=selected_meta,
-        selected_items=selected_items,
+        import_id=import_id,
+        import_status=import_status,
+        selected_batch=(request.args.get("batch") or "").strip(),
     )
 
 
 # -----------------------
-# WEBHOOK (inchangé)
+# ROUTES: API JSON (sections du panneau)
 # -----------------------
-@app.route("/sms_auto_reply", methods=["POST"])
-def sms_auto_reply():
-    request_id = str(uuid.uuid4())[:8]
-    log(f"\n📩 [{request_id}] Nouvelle requête POST reçue")
+BATCHES_PAGE_SIZE = 8
+REPLY_RATES_BATCHES = int(os.getenv("REPLY_RATES_BATCHES", "100"))  # lots agrégés par template
+ITEMS_PAGE_SIZE = 25
 
-    messages_raw = request.form.get("messages")
-    if not messages_raw:
-        log(f"[{request_id}] ❌ Champ 'messages' manquant")
-        return "messages manquants", 400
 
+@app.route("/admin/api/devices", methods=["GET"])
+def admin_api_devices():
+    guard = _require_login_api()
+    if guard:
+        return guard
+    return _json_response({"devices": _device_rows(fetch_gateway_devices())})
+
+
+@app.route("/admin/api/batches", methods=["GET"])
+def admin_api_batches():
+    guard = _require_login_api()
+    if guard:
+        return guard
+    page = max(0, int(request.args.get("page") or 0))
+    batches = _list_last_batches(limit=BATCHES_PAGE_SIZE, offset=page * BATCHES_PAGE_SIZE)
+    return _json_response({
+        "batches": batches,
+        "replies": _reply_rates([b.get("batch_id") for b in batches]),
+        "page": page,
+        "page_size": BATCHES_PAGE_SIZE,
+        "total": _count_batches(),
+        "compact_status": _load_task_status("compact_archives"),
+    })
+
+
+@app.route("/admin/api/segments", methods=["GET"])
+def admin_api_segments():
+    """Colonnes indexées du pool + nombre de numéros restants pour le segment demandé."""
+    guard = _require_login_api()
+    if guard:
+        return guard
+    filters = nl_pool.normalize_filters(_segment_filters(request.args))
+    return _json_response({
+        "columns": nl_pool.segments(redis_conn),
+        "filters": filters,
+        "count": _nl_remaining_count(filters),
+    })
+
+
+@app.route("/admin/api/reply-rates", methods=["GET"])
+def admin_api_reply_rates():
+    """Taux de réponse par template (message du lot) sur les derniers lots."""
+    guard = _require_login_api()
+    if guard:
+        return guard
+    batches = _list_last_batches(limit=REPLY_RATES_BATCHES)
+    rates = _reply_rates([b.get("batch_id") for b in batches])
+    templates = {}
+    for b in batches:
+        tid = b.get("template_id") or hashlib.sha1((b.get("message") or "").encode("utf-8")).hexdigest()[:10]
+        t = templates.setdefault(tid, {"template_id": tid, "message": (b.get("message") or "")[:120],
+                                       "batches": 0, "sent": 0, "replies": 0, "repliers": 0})
+        st = rates.get(str(b.get("batch_id"))) or {}
+        t["batches"] += 1
+        for field in ("sent", "replies", "repliers"):
+            t[field] += int(st.get(field) or 0)
+    for t in templates.values():
+        t["rate"] = attribution.reply_rate(t, t["sent"])
+    return _json_response({
+        "templates": sorted(templates.values(), key=lambda t: t["sent"], reverse=True),
+        "batches": len(batches),
+    })
+
+
+@app.route("/admin/api/history", methods=["GET"])
+def admin_api_history():
+    """Historique d'un numéro (plus récent d'abord) ; before = id du dernier reçu."""
+    guard = _require_login_api()
+    if guard:
+        return guard
+    number = (request.args.get("number") or "").strip()
+    if not number:
+        return _json_response({"error": "number requis"}, status=400)
+    limit = min(200, max(1, int(request.args.get("limit") or 50)))
+    events = history.read(number, limit=limit, before=(request.args.get("before") or "").strip() or None)
+    return _json_response({
+        "number": number,
+        "events": events,
+        "next": events[-1]["id"] if len(events) >= limit else None,
+    })
+
+
+@app.route("/admin/api/affinity", methods=["GET"])
+def admin_api_affinity():
+    """Device d'affinité d'un numéro (ordre de repli) sur la flotte connue."""
+    guard = _require_login_api()
+    if guard:
+        return guard
+    number = (request.args.get("number") or "").strip()
+    if not number:
+        return _json_response({"error": "number requis"}, status=400)
+    devices = [str(d.get("id")) for d in fetch_gateway_devices()]
+    return _json_response({
+        "number": number,
+        "capacity_ranking": affinity.ranking(number, {d: capacity(d) for d in devices}),
+        "live_ranking": affinity.ranking(number, device_weights(devices)),
+    })
+
+
+@app.route("/admin/api/events", methods=["GET"])
+def admin_api_events():
+    """SSE : deltas (compteurs devices, pool, progression des lots) du hub du process."""
+    guard = _require_login_api()
+    if guard:
+        return guard
+    client = dashboard_hub().subscribe()
+    resp = Response(stream_with_context(sse_stream(client)), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-store"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+
+@app.route("/admin/api/batch/<batch_id>", methods=["GET"])
+def admin_api_batch(batch_id):
+    guard = _require_login_api()
+    if guard:
+        return guard
+    meta = _load_batch_meta(batch_id)
+    if not meta:
+        return _json_response({"meta": None}, status=404)
+
+    cursor = max(0, int(request.args.get("cursor") or 0))
+    query = (request.args.get("q") or "").strip()
+    number_col = meta.get("number_col") or (_load_nl_meta() or {}).get("number_col")
+    if query:
+        items, next_cursor = _search_batch_items(batch_id, query, number_col, cursor=cursor, limit=ITEMS_PAGE_SIZE)
+    else:
+        items, next_cursor = _load_batch_items(batch_id, cursor=cursor, limit=ITEMS_PAGE_SIZE)
+
+    return _json_response({
+        "meta": meta,
+        "number_col": number_col,
+        "progress": _load_batch_progress(batch_id),
+        "replies": _reply_rates([batch_id]).get(str(batch_id)),
+        "allocation_left": allocation_remaining(batch_id, list(meta.get("allocation") or {})),
+        "restore_status": _load_task_status(f"restore_batch:{batch_id}"),
+        "items": items,
+        "cursor": cursor,
+        "next": next_cursor,
+        "query": query,
+    })
+
+
+# -----------------------
+# WEBHOOKS (gateway)
+# -----------------------
+def _signed_messages(request_id, messages_raw):
+    """Vérifie X-SG-SIGNATURE (HMAC-SHA256 du champ messages) -> (liste, None) | (None, réponse)."""
     if not DEBUG_MODE:
         signature = request.headers.get("X-SG-SIGNATURE")
         if not signature:
             log(f"[{request_id}] ❌ Signature manquante")
-            return "Signature requise", 403
+            return None, ("Signature requise", 403)
 
         expected_hash = base64.b64encode(
             hmac.new(API_KEY.encode(), messages_raw.encode(), hashlib.sha256).digest()
         ).decode()
 
-        if signature != expected_hash:
+        if not hmac.compare_digest(signature, expected_hash):
             log(f"[{request_id}] ❌ Signature invalide")
-            return "Signature invalide", 403
+            return None, ("Signature invalide", 403)
 
     try:
         messages = json.loads(messages_raw)
     except json.JSONDecodeError as e:
         log(f"[{request_id}] ❌ JSON invalide : {e}")
-        return "Format JSON invalide", 400
+        return None, ("Format JSON invalide", 400)
 
     if not isinstance(messages, list):
-        return "Liste attendue", 400
+        return None, ("Liste attendue", 400)
+    return messages, None
+
+
+_reply_windows_cache = {"at": 0.0, "value": ("", "")}
+REPLY_WINDOWS_CACHE = int(os.getenv("REPLY_WINDOWS_CACHE", "30"))
+
+
+def _reply_windows():
+    """Plages de réponse de l'auto-reply (config relue au plus toutes les REPLY_WINDOWS_CACHE s)."""
+    now = time.time()
+    if now - _reply_windows_cache["at"] > REPLY_WINDOWS_CACHE:
+        cfg = load_config()
+        _reply_windows_cache.update(at=now, value=(cfg.get("reply_windows") or "", cfg.get("reply_tz") or ""))
+    return _reply_windows_cache["value"]
+
+
+def _reply_delay(windows, tz):
+    """Délai aléatoire habituel, repoussé à l'ouverture de la plage de réponse si besoin."""
+    delay = random.randint(REPLY_DELAY_MIN, max(REPLY_DELAY_MIN, REPLY_DELAY_MAX))
+    if not windows:
+        return delay
+    now = time.time()
+    return int(scheduler.next_allowed(now + delay, tz, windows) - now)
+
+
+@app.route("/sms_auto_reply", methods=["POST"])
+def sms_auto_reply():
+    request_id = str(uuid.uuid4())[:8]
+    log(f"\n📩 [{request_id}] Nouvelle requête POST reçue")
+
+    messages_raw = request.form.get("messages")
+    if not messages_raw:
+        log(f"[{request_id}] ❌ Champ 'messages' manquant")
+        return "messages manquants", 400
+
+    messages, error = _signed_messages(request_id, messages_raw)
+    if error:
+        return error
+
+    windows, tz = _reply_windows()
+
+    if INGEST_MODE == "stream":
+        try:
+            ingest_enqueue(redis_conn, [(msg, _reply_delay(windows, tz)) for msg in messages])
+        except Exception as e:
+            log(f"[{request_id}] ❌ Erreur ingestion : {e}")
+            return "Erreur ingestion", 503
+        return "OK", 200
 
     for msg in messages:
         try:
-            delay = random.randint(60, 180)
-            process_message.apply_async(args=[json.dumps(msg)], countdown=delay)
+            delay = _reply_delay(windows, tz)
+            if delay > REPLY_DELAY_MAX:
+                # hors plage de réponse : l'ordonnanceur relâche le message à l'ouverture
+                # (pas de countdown Celery de plusieurs heures)
+                scheduler.add_job(redis_conn, "reply:" + json.dumps(msg), time.time() + delay)
+            else:
+                _tasks().process_message.apply_async(args=[json.dumps(msg)], countdown=delay)
         except Exception as e:
             log(f"[{request_id}] ❌ Erreur Celery : {e}")
 
     return "OK", 200
 
 
+@app.route("/delivery_status", methods=["POST"])
+def delivery_status():
+    """Statuts de livraison du gateway (en masse) -> compteurs delivered/failed, deux pipelines."""
+    request_id = str(uuid.uuid4())[:8]
+    messages_raw = request.form.get("messages")
+    if not messages_raw:
+        log(f"[{request_id}] ❌ Champ 'messages' manquant (statuts)")
+        return "messages manquants", 400
+
+    messages, error = _signed_messages(request_id, messages_raw)
+    if error:
+        return error
+
+    updates = [(m.get("ID"), m.get("status")) for m in messages if isinstance(m, dict)]
+    try:
+        result = delivery.apply_statuses(redis_conn, updates)
+    except Exception as e:
+        log(f"[{request_id}] ❌ Erreur statuts : {e}")
+        return "Erreur statuts", 503
+    log(f"📬 [{request_id}] {len(updates)} statut(s) : {result}")
+    return "OK", 200
+
+
 @app.route("/logs")
 def logs():
     if not os.path.exists(LOG_FILE):
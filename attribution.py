@@ -0,0 +1,105 @@
+"""
+Attribution des réponses aux campagnes : index numéro -> lot écrit en masse à la
+création du lot, lu en O(1) à la réception (dans le pipeline des stats reçus).
+
+Mémoire : l'index est réparti en petits HASH (ATTR_BUCKETS par génération) qui
+restent en encodage compact (listpack) côté Redis, au lieu d'une clé par numéro.
+Expiration : une génération par ATTR_GEN_DAYS jours, chacune expire après
+ATTR_TTL_DAYS ; la lecture consulte les générations encore vivantes.
+"""
+import os
+import time
+import zlib
+
+from keyspace import ATTR_PREFIX, BATCH_REPLIES_PREFIX, BATCH_REPLIERS_PREFIX
+from dashboard import publish_batch
+
+ATTR_ENABLED = os.getenv("ATTR_ENABLED", "true").lower() == "true"
+ATTR_BUCKETS = int(os.getenv("ATTR_BUCKETS", "16384"))
+ATTR_GEN_DAYS = max(1, int(os.getenv("ATTR_GEN_DAYS", "7")))
+ATTR_TTL_DAYS = max(ATTR_GEN_DAYS, int(os.getenv("ATTR_TTL_DAYS", "30")))
+ATTR_WRITE_CHUNK = 1000
+
+
+def _generation(ts=None):
+    return int((ts or time.time()) // (ATTR_GEN_DAYS * 86400))
+
+
+def _live_generations():
+    cur = _generation()
+    n = -(-ATTR_TTL_DAYS // ATTR_GEN_DAYS)  # arrondi supérieur
+    return [cur - i for i in range(n + 1)]
+
+
+def _key(gen, number):
+    return f"{ATTR_PREFIX}{gen}:{zlib.crc32(str(number).encode('utf-8')) % ATTR_BUCKETS}"
+
+
+def index_batch(redis_conn, batch_id, numbers):
+    """Écrit numéro -> lot pour tous les numéros du lot (pipelines par paquets)."""
+    if not ATTR_ENABLED:
+        return 0
+    gen = _generation()
+    ttl = ATTR_TTL_DAYS * 86400 + ATTR_GEN_DAYS * 86400
+    numbers = [n for n in numbers if n]
+    touched = set()
+    for i in range(0, len(numbers), ATTR_WRITE_CHUNK):
+        pipe = redis_conn.pipeline(transaction=False)
+        for number in numbers[i:i + ATTR_WRITE_CHUNK]:
+            key = _key(gen, number)
+            pipe.hset(key, number, batch_id)
+            if key not in touched:
+                touched.add(key)
+                pipe.expire(key, ttl)
+        pipe.execute()
+    return len(numbers)
+
+
+def queue_lookup(pipe, number):
+    """Ajoute la lecture au pipeline ; nombre de commandes = len(_live_generations())."""
+    if not ATTR_ENABLED:
+        return
+    for gen in _live_generations():
+        pipe.hget(_key(gen, number), number)
+
+
+def lookup_size():
+    return len(_live_generations()) if ATTR_ENABLED else 0
+
+
+def resolve(results):
+    """Résultats de queue_lookup -> batch_id (génération la plus récente) ou None."""
+    for raw in results:
+        if raw:
+            return raw.decode("utf-8")
+    return None
+
+
+def queue_reply(pipe, batch_id, number):
+    pipe.hincrby(BATCH_REPLIES_PREFIX + batch_id, "replies", 1)
+    pipe.hset(BATCH_REPLIES_PREFIX + batch_id, "last_at", int(time.time()))
+    pipe.pfadd(BATCH_REPLIERS_PREFIX + batch_id, number)
+    publish_batch(pipe, batch_id, replies=1)
+
+
+def reply_stats(redis_conn, batch_ids):
+    """{batch_id: {"replies", "repliers", "last_at"}} en un pipeline."""
+    pipe = redis_conn.pipeline(transaction=False)
+    for batch_id in batch_ids:
+        pipe.hgetall(BATCH_REPLIES_PREFIX + str(batch_id))
+        pipe.pfcount(BATCH_REPLIERS_PREFIX + str(batch_id))
+    res = pipe.execute()
+    out = {}
+    for i, batch_id in enumerate(batch_ids):
+        raw, repliers = res[i * 2], res[i * 2 + 1]
+        out[str(batch_id)] = {
+            "replies": int(raw.get(b"replies") or 0),
+            "repliers": int(repliers or 0),
+            "last_at": int(raw.get(b"last_at") or 0),
+        }
+    return out
+
+
+def reply_rate(stats, sent):
+    return round(stats.get("repliers", 0) / float(sent), 4) if sent else 0.0
+
@@ -0,0 +1,224 @@
+"""
+Bench du pipeline d'import numlist (nl_import.py) : read_csv / read_xlsx,
+dedupe_header, build_records et le push vers le pool indexé (nl_pool.py).
+
+    python -m bench.bench_import --rows 100000 --cols 8
+    python -m bench.bench_import --rows 1000000 --formats csv --profile cprofile
+    python -m bench.bench_import --save-baseline      # écrit bench/baselines/import.json
+    python -m bench.bench_import --compare            # compare à la baseline (exit 1 si régression)
+
+Mesures par étape : durée, lignes/s, pic mémoire (tracemalloc).
+"""
+import os
+import io
+import csv
+import sys
+import json
+import time
+import random
+import argparse
+import tracemalloc
+
+from bench.common import use_fake_redis, dump_json
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "import.json")
+
+CITIES = ["Paris", "Lyon", "Marseille", "Lille", "Nantes", "Bordeaux", "Toulouse", "Nice"]
+SEGMENTS = ["VIP", "standard", "prospect", "inactif"]
+
+
+# -----------------------
+# GÉNÉRATION
+# -----------------------
+def _synthetic_rows(rows, cols, seed=42):
+    rnd = random.Random(seed)
+    header = ["numero", "prenom", "ville", "segment"] + [f"extra_{i}" for i in range(max(0, cols - 4))]
+    header = header[:max(1, cols)]
+    yield header
+    for i in range(rows):
+        row = [f"+3361{i:07d}", f"Prénom{i % 997}", rnd.choice(CITIES), rnd.choice(SEGMENTS)]
+        row += [f"v{rnd.randint(0, 9999)}" for _ in range(max(0, cols - 4))]
+        yield row[:len(header)]
+
+
+def make_csv(rows, cols, encoding="utf-8", delimiter=","):
+    buf = io.StringIO()
+    writer = csv.writer(buf, delimiter=delimiter)
+    for row in _synthetic_rows(rows, cols):
+        writer.writerow(row)
+    return buf.getvalue().encode(encoding, errors="replace")
+
+
+def make_xlsx(rows, cols):
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("numlist")
+    for row in _synthetic_rows(rows, cols):
+        ws.append(row)
+    out = io.BytesIO()
+    wb.save(out)
+    return out.getvalue()
+
+
+# -----------------------
+# MESURE
+# -----------------------
+def _stage(name, fn, rows, results):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    out = fn()
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results[name] = {
+        "seconds": round(elapsed, 4),
+        "rows_per_s": round(rows / elapsed, 1) if elapsed else 0.0,
+        "peak_mb": round(peak / (1024 * 1024), 2),
+    }
+    return out
+
+
+def run_case(nl_import, redis_client, fmt, rows, cols, encoding, delimiter):
+    if fmt == "xlsx":
+        data = make_xlsx(rows, cols)
+        reader = nl_import.read_xlsx
+    else:
+        data = make_csv(rows, cols, encoding, delimiter)
+        reader = nl_import.read_csv
+
+    results = {}
+    header, data_rows = _stage("read", lambda: reader(data), rows, results)
+    header = _stage("dedupe_header", lambda: nl_import.dedupe_header(header), rows, results)
+    number_col = nl_import.pick_number_column(header)
+    records = _stage("build_records", lambda: nl_import.build_records(header, data_rows, number_col), rows, results)
+
+    nl_import.nl_pool.clear(redis_client)
+    _stage("redis_push", lambda: nl_import.push_records(records, redis_client, number_col), rows, results)
+    nl_import.nl_pool.clear(redis_client)
+
+    results["total_seconds"] = round(sum(v["seconds"] for v in results.values()), 4)
+    results["file_mb"] = round(len(data) / (1024 * 1024), 2)
+    return results
+
+
+def case_name(fmt, rows, cols, encoding, delimiter):
+    if fmt == "xlsx":
+        return f"xlsx-{rows}r-{cols}c"
+    d = {",": "comma", ";": "semicolon", "|": "pipe", "\t": "tab"}.get(delimiter, "delim")
+    return f"csv-{rows}r-{cols}c-{encoding}-{d}"
+
+
+def _profile(kind, fn, out_path):
+    if kind == "pyinstrument":
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+        fn()
+        profiler.stop()
+        with open(out_path + ".html", "w", encoding="utf-8") as f:
+            f.write(profiler.output_html())
+        return out_path + ".html"
+
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    profiler.runcall(fn)
+    profiler.dump_stats(out_path + ".prof")
+    pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+    return out_path + ".prof"
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, stages in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for stage, m in stages.items():
+            if not isinstance(m, dict) or stage not in base:
+                continue
+            before = base[stage]["seconds"]
+            after = m["seconds"]
+            if before > 0 and after > before * (1 + tolerance):
+                regressions.append(f"{name}/{stage}: {before:.4f}s → {after:.4f}s (+{(after / before - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bench du pipeline d'import")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--cols", type=int, nargs="+", default=[2, 8])
+    parser.add_argument("--formats", nargs="+", default=["csv", "xlsx"], choices=["csv", "xlsx"])
+    parser.add_argument("--encodings", nargs="+", default=["utf-8"], choices=["utf-8", "utf-8-sig", "latin-1"])
+    parser.add_argument("--delimiters", nargs="+", default=[","], help="ex: , ';' '|' tab")
+    parser.add_argument("--redis", default="fake", help="'fake' ou URL Redis (pool numlist vidé)")
+    parser.add_argument("--profile", choices=["cprofile", "pyinstrument"])
+    parser.add_argument("--profile-out", default="/tmp/bench_import")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="régression tolérée (0.25 = +25%%)")
+    parser.add_argument("--json", help="écrit les résultats JSON dans ce fichier")
+    args = parser.parse_args(argv)
+
+    delimiters = ["\t" if d == "tab" else d for d in args.delimiters]
+
+    if args.redis == "fake":
+        redis_client = use_fake_redis()
+    else:
+        os.environ["REDIS_URL"] = args.redis
+        from redis import Redis
+        redis_client = Redis.from_url(args.redis)
+
+    import nl_import
+
+    results = {}
+    for fmt in args.formats:
+        encodings = args.encodings if fmt == "csv" else ["-"]
+        seps = delimiters if fmt == "csv" else ["-"]
+        for rows in args.rows:
+            for cols in args.cols:
+                for enc in encodings:
+                    for sep in seps:
+                        name = case_name(fmt, rows, cols, enc, sep)
+                        if args.profile:
+                            path = _profile(args.profile, lambda: run_case(nl_import, redis_client, fmt, rows, cols, enc, sep),
+                                            f"{args.profile_out}-{name}")
+                            print(f"profil {name} → {path}")
+                        res = run_case(nl_import, redis_client, fmt, rows, cols, enc, sep)
+                        results[name] = res
+                        stages = " | ".join(
+                            f"{k} {v['seconds']:.3f}s {v['peak_mb']}Mo"
+                            for k, v in res.items() if isinstance(v, dict)
+                        )
+                        print(f"{name:40s} total {res['total_seconds']:.3f}s | {stages}")
+
+    if args.json:
+        dump_json(args.json, results)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(BASELINE_FILE), exist_ok=True)
+        baseline = {}
+        if os.path.exists(BASELINE_FILE):
+            with open(BASELINE_FILE, encoding="utf-8") as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        dump_json(BASELINE_FILE, baseline)
+        print(f"baseline → {BASELINE_FILE}")
+
+    if args.compare:
+        if not os.path.exists(BASELINE_FILE):
+            print("pas de baseline (lancer --save-baseline)")
+            return 1
+        with open(BASELINE_FILE, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print(f"❌ {line}")
+        if regressions:
+            return 1
+        print("✅ aucune régression")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
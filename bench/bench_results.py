@@ -0,0 +1,111 @@
+"""
+Bench des écritures du backend de résultats Celery : ops Redis par message
+process_message, avant (CELERY_TASK_RESULTS=on : track_started + résultats stockés)
+et après (défaut : tâches fire-and-forget).
+
+    python -m bench.bench_results --messages 2000
+    python -m bench.bench_results --messages 2000 --json /tmp/results.json
+
+Chaque mode tourne dans un sous-process (la config Celery est lue à l'import).
+Exécution eager avec task_store_eager_result : le backend écrit comme un worker,
+branché sur le même Redis en mémoire (fakeredis) que l'app.
+"""
+import sys
+import json
+import argparse
+import subprocess
+
+from bench.common import (
+    RedisOpCounter,
+    use_fake_redis,
+    start_fake_gateway,
+    spawn,
+    stop,
+    dump_json,
+)
+
+API_KEY = "bench-key"
+MODES = {"before": "on", "after": "off"}
+
+
+def run_child(messages, devices):
+    redis_client = use_fake_redis()
+
+    from keyspace import CONFIG_KEY
+    redis_client.set(CONFIG_KEY, json.dumps({
+        "enabled": True, "reply_mode": 2,
+        "step0_text": "bench step0", "step1_text": "bench step1",
+    }))
+
+    from celery_worker import celery
+    celery.conf.task_store_eager_result = True
+    celery.backend.client = redis_client
+
+    import tasks
+    counter = RedisOpCounter().install()
+    for i in range(messages):
+        msg = {"ID": f"1{i:08d}", "number": f"+3361{i:07d}", "message": "bench", "deviceID": str(1 + i % devices)}
+        tasks.process_message.apply_async(args=[json.dumps(msg)])
+    ops, round_trips = counter.snapshot()
+
+    meta_keys = sum(1 for _ in redis_client.scan_iter(match="celery-task-meta-*", count=1000))
+    print(json.dumps({
+        "messages": messages,
+        "ops": ops,
+        "round_trips": round_trips,
+        "ops_per_message": round(ops / float(messages or 1), 2),
+        "round_trips_per_message": round(round_trips / float(messages or 1), 2),
+        "result_keys_left": meta_keys,
+    }))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ops Redis par message avec / sans backend de résultats")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--devices", type=int, default=4)
+    parser.add_argument("--gateway-port", type=int, default=8097)
+    parser.add_argument("--json", help="écrit le rapport JSON dans ce fichier")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        run_child(args.messages, args.devices)
+        return 0
+
+    gateway_url = f"http://127.0.0.1:{args.gateway_port}"
+    gateway = start_fake_gateway(args.gateway_port, latency_ms=0, devices=args.devices)
+    report = {}
+    try:
+        for label, results in MODES.items():
+            proc = spawn([sys.executable, "-m", "bench.bench_results", "--child",
+                          "--messages", str(args.messages), "--devices", str(args.devices)],
+                         env={
+                             "API_KEY": API_KEY,
+                             "SERVER": gateway_url,
+                             "CELERY_EAGER": "true",
+                             "CELERY_TASK_RESULTS": results,
+                         },
+                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+            out, _ = proc.communicate()
+            if proc.returncode:
+                raise RuntimeError(f"mode {label} : sous-process en échec ({proc.returncode})")
+            report[label] = json.loads(out.strip().splitlines()[-1])
+    finally:
+        stop(gateway)
+
+    before, after = report["before"], report["after"]
+    report["saved_ops_per_message"] = round(before["ops_per_message"] - after["ops_per_message"], 2)
+
+    print(f"{'mode':<8} {'ops/msg':>9} {'A/R/msg':>9} {'clés meta':>10}")
+    for label in MODES:
+        r = report[label]
+        print(f"{label:<8} {r['ops_per_message']:>9} {r['round_trips_per_message']:>9} {r['result_keys_left']:>10}")
+    print(f"→ {report['saved_ops_per_message']} op(s) Redis en moins par message")
+
+    if args.json:
+        dump_json(args.json, report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+"""
+Bench de démarrage à froid : temps d'import de app (web) et de tasks (worker),
+mesuré dans des process Python neufs, + modules lourds chargés à l'import.
+
+    python -m bench.bench_startup --runs 10
+    python -m bench.bench_startup --importtime app    # top des imports (-X importtime)
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+from bench.common import ROOT, percentile
+
+HEAVY = ["openpyxl", "celery", "requests", "redis", "aiohttp", "kombu", "tasks"]
+
+PROBE = """
+import sys, time, json
+t0 = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - t0
+print(json.dumps({{"s": elapsed, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def _env():
+    env = dict(os.environ)
+    env.setdefault("REDIS_URL", "redis://localhost:6379/0")
+    env.setdefault("API_KEY", "bench")
+    env["PYTHONPATH"] = ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    return env
+
+
+def measure(module, runs):
+    timings = []
+    loaded = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY)],
+            cwd=ROOT, env=_env(), capture_output=True, text=True, check=True,
+        )
+        data = json.loads(out.stdout.strip().splitlines()[-1])
+        timings.append(data["s"])
+        loaded = data["loaded"]
+    return {
+        "median_ms": round(statistics.median(timings) * 1000, 1),
+        "p90_ms": round(percentile(timings, 90) * 1000, 1),
+        "min_ms": round(min(timings) * 1000, 1),
+        "heavy_loaded": loaded,
+    }
+
+
+def importtime(module, top):
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, env=_env(), capture_output=True, text=True, check=True,
+    )
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumul_us, name = line[len("import time:"):].split("|", 2)
+        rows.append((int(cumul_us), int(self_us), name.strip()))
+    rows.sort(reverse=True)
+    for cumul, self_us, name in rows[:top]:
+        print(f"{cumul / 1000:9.1f} ms cumul  {self_us / 1000:8.1f} ms self  {name}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bench de démarrage (imports à froid)")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--modules", nargs="+", default=["app", "tasks"])
+    parser.add_argument("--importtime", metavar="MODULE", help="affiche le top -X importtime")
+    parser.add_argument("--top", type=int, default=25)
+    parser.add_argument("--json", help="écrit les résultats JSON dans ce fichier")
+    args = parser.parse_args(argv)
+
+    if args.importtime:
+        importtime(args.importtime, args.top)
+        return
+
+    results = {}
+    for module in args.modules:
+        res = measure(module, args.runs)
+        results[module] = res
+        print(f"import {module:8s} médiane {res['median_ms']} ms | p90 {res['p90_ms']} ms | "
+              f"min {res['min_ms']} ms | lourds chargés: {', '.join(res['heavy_loaded']) or '-'}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
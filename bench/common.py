@@ -0,0 +1,184 @@
+"""
+Outils partagés des benchs : signature webhook, comptage des ops Redis,
+Redis en mémoire (fakeredis), RSS, percentiles, faux gateway en sous-process.
+"""
+import os
+import sys
+import time
+import hmac
+import json
+import base64
+import socket
+import hashlib
+import resource
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def sign(api_key: str, messages_raw: str) -> str:
+    return base64.b64encode(
+        hmac.new(api_key.encode(), messages_raw.encode(), hashlib.sha256).digest()
+    ).decode()
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * (p / 100.0)
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+# -----------------------
+# REDIS
+# -----------------------
+class RedisOpCounter:
+    """
+    Compte les commandes Redis émises par ce process (client redis-py) :
+    ops = commandes, round_trips = allers-retours (un pipeline = 1).
+    """
+
+    def __init__(self):
+        self.ops = 0
+        self.round_trips = 0
+        self._installed = False
+
+    def install(self):
+        if self._installed:
+            return self
+        from redis.client import Redis, Pipeline
+        counter = self
+        orig_execute_command = Redis.execute_command
+        orig_pipeline_execute = Pipeline.execute
+
+        def execute_command(client, *args, **kwargs):
+            counter.ops += 1
+            counter.round_trips += 1
+            return orig_execute_command(client, *args, **kwargs)
+
+        def pipeline_execute(pipe, *args, **kwargs):
+            n = len(pipe.command_stack)
+            if n:
+                counter.ops += n
+                counter.round_trips += 1
+            return orig_pipeline_execute(pipe, *args, **kwargs)
+
+        Redis.execute_command = execute_command
+        Pipeline.execute = pipeline_execute
+        self._installed = True
+        return self
+
+    def snapshot(self):
+        return self.ops, self.round_trips
+
+
+def server_commands(redis_client) -> int:
+    """Commandes traitées par le serveur (inclut broker Celery & workers)."""
+    return int(redis_client.info("stats").get("total_commands_processed") or 0)
+
+
+def use_fake_redis():
+    """
+    Branche un Redis en mémoire (fakeredis) derrière keyspace, avant l'import
+    de app/tasks. Retourne le client.
+    """
+    import fakeredis
+    import keyspace
+    os.environ.setdefault("REDIS_URL", "redis://fake:6379/0")
+    keyspace.REDIS_URL = os.environ["REDIS_URL"]
+    client = fakeredis.FakeRedis()
+    keyspace.set_client(keyspace.REDIS_URL, client)
+    for url in keyspace.REDIS_SHARD_URLS:
+        keyspace.set_client(url, client)
+    return client
+
+
+# -----------------------
+# PROCESS
+# -----------------------
+def self_peak_rss_mb() -> float:
+    # ru_maxrss en Ko sous Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _proc_children(pid):
+    out = []
+    task_dir = f"/proc/{pid}/task"
+    try:
+        for tid in os.listdir(task_dir):
+            with open(f"{task_dir}/{tid}/children") as f:
+                out.extend(int(x) for x in f.read().split())
+    except OSError:
+        pass
+    return out
+
+
+def _proc_hwm_mb(pid) -> float:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return 0.0
+
+
+def tree_peak_rss_mb(pid):
+    """Pic RSS (VmHWM) du process et de ses enfants : {"max": Mo, "sum": Mo}."""
+    pids = [pid]
+    i = 0
+    while i < len(pids):
+        pids.extend(_proc_children(pids[i]))
+        i += 1
+    values = [_proc_hwm_mb(p) for p in pids]
+    return {"max": max(values or [0.0]), "sum": sum(values)}
+
+
+def wait_port(host, port, timeout=20.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{host}:{port} ne répond pas")
+
+
+def spawn(cmd, env=None, **kwargs):
+    full_env = dict(os.environ)
+    full_env.update(env or {})
+    full_env["PYTHONPATH"] = ROOT + os.pathsep + full_env.get("PYTHONPATH", "")
+    return subprocess.Popen(cmd, cwd=ROOT, env=full_env, **kwargs)
+
+
+def start_fake_gateway(port, latency_ms=50, error_rate=0.0, http_error_rate=0.0, devices=4):
+    proc = spawn([
+        sys.executable, "-m", "bench.fake_gateway",
+        "--port", str(port),
+        "--latency-ms", str(latency_ms),
+        "--error-rate", str(error_rate),
+        "--http-error-rate", str(http_error_rate),
+        "--devices", str(devices),
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_port("127.0.0.1", port)
+    return proc
+
+
+def stop(proc, timeout=10):
+    if proc is None or proc.poll() is not None:
+        return
+    proc.terminate()
+    try:
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def dump_json(path, data):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
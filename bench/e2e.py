@@ -0,0 +1,255 @@
+"""
+Bench bout-en-bout : webhook signé → Celery → process_message → send_request → faux gateway.
+
+Mode eager (tout dans ce process, Redis en mémoire possible) :
+    python -m bench.e2e --mode eager --redis fake --messages 2000
+
+Mode worker (gunicorn + worker Celery réels, Redis local requis) :
+    python -m bench.e2e --mode worker --redis redis://localhost:6379/15 --messages 5000 --rate 200
+
+Rapport : msg/s, latence réponse p50/p99 (hors countdown), ops Redis / message, pic RSS.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+from bench.common import (
+    sign,
+    percentile,
+    RedisOpCounter,
+    server_commands,
+    use_fake_redis,
+    self_peak_rss_mb,
+    tree_peak_rss_mb,
+    start_fake_gateway,
+    spawn,
+    stop,
+    wait_port,
+    dump_json,
+)
+
+API_KEY = "bench-key"
+
+
+# -----------------------
+# SCÉNARIOS
+# -----------------------
+def build_rounds(scenario, messages, devices):
+    """
+    Liste de rounds ; un round = (messages à poster, envois attendus au gateway).
+    Un round attend que le précédent soit envoyé (step0 avant step1).
+    """
+    def msg(i, rnd):
+        return {
+            "ID": f"{rnd}{i:08d}",
+            "number": f"+3361{i:07d}",
+            "message": f"bench {rnd}",
+            "deviceID": str(1 + i % devices),
+        }
+
+    if scenario == "conversation":
+        return [([msg(i, 1) for i in range(messages)], messages),
+                ([msg(i, 2) for i in range(messages)], messages)]
+    if scenario == "duplicates":
+        batch = [msg(i, 1) for i in range(messages)]
+        return [(batch + batch, messages)]
+    return [([msg(i, 1) for i in range(messages)], messages)]
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# -----------------------
+# POSTERS
+# -----------------------
+class EagerPoster:
+    def __init__(self):
+        import app as web_app
+        self.client = web_app.app.test_client()
+
+    def post(self, messages_raw):
+        r = self.client.post("/sms_auto_reply", data={"messages": messages_raw},
+                             headers={"X-SG-SIGNATURE": sign(API_KEY, messages_raw)})
+        return r.status_code
+
+
+class HttpPoster:
+    def __init__(self, base_url):
+        import requests
+        self.session = requests.Session()
+        self.url = f"{base_url}/sms_auto_reply"
+
+    def post(self, messages_raw):
+        r = self.session.post(self.url, data={"messages": messages_raw},
+                              headers={"X-SG-SIGNATURE": sign(API_KEY, messages_raw)})
+        return r.status_code
+
+
+def _gateway_sent(session, gateway_url, since):
+    data = session.get(f"{gateway_url}/sent", params={"since": since}).json()
+    return data["sent"], data["next"]
+
+
+def run_round(poster, http, gateway_url, batch, expected, rate, batch_size, delay, timeout):
+    posted_at = {}
+    interval = (batch_size / float(rate)) if rate > 0 else 0.0
+    start = time.perf_counter()
+    next_at = time.time()
+
+    _, cursor = _gateway_sent(http, gateway_url, 0)
+
+    for group in chunks(batch, batch_size):
+        now = time.time()
+        for m in group:
+            posted_at.setdefault(m["number"], now)
+        poster.post(json.dumps(group))
+        if interval:
+            next_at += interval
+            pause = next_at - time.time()
+            if pause > 0:
+                time.sleep(pause)
+
+    latencies = []
+    received = 0
+    deadline = time.time() + timeout + delay
+    while received < expected and time.time() < deadline:
+        sent, cursor = _gateway_sent(http, gateway_url, cursor)
+        for number, _device, t in sent:
+            t0 = posted_at.get(number)
+            if t0 is not None:
+                latencies.append(max(0.0, t - t0 - delay))
+        received += len(sent)
+        if received < expected:
+            time.sleep(0.05)
+
+    elapsed = time.perf_counter() - start
+    return received, elapsed, latencies
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bench bout-en-bout webhook → gateway")
+    parser.add_argument("--mode", choices=["eager", "worker"], default="eager")
+    parser.add_argument("--redis", default="fake", help="'fake' (fakeredis, eager) ou URL Redis")
+    parser.add_argument("--scenario", choices=["steady", "conversation", "duplicates"], default="steady")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=0, help="messages/s postés (0 = max)")
+    parser.add_argument("--batch-size", type=int, default=1, help="messages par POST webhook")
+    parser.add_argument("--devices", type=int, default=4)
+    parser.add_argument("--delay", type=int, default=0, help="countdown fixe (s), déduit des latences")
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--http-error-rate", type=float, default=0.0)
+    parser.add_argument("--gateway-port", type=int, default=8099)
+    parser.add_argument("--web-port", type=int, default=8098)
+    parser.add_argument("--web-workers", type=int, default=2)
+    parser.add_argument("--worker-concurrency", type=int, default=4)
+    parser.add_argument("--worker-args", default="", help="arguments Celery en plus (mode worker)")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--json", help="écrit le rapport JSON dans ce fichier")
+    args = parser.parse_args(argv)
+
+    if args.mode == "worker" and args.redis == "fake":
+        parser.error("le mode worker demande un vrai Redis (--redis redis://...)")
+
+    gateway_url = f"http://127.0.0.1:{args.gateway_port}"
+    env = {
+        "API_KEY": API_KEY,
+        "SERVER": gateway_url,
+        "REPLY_DELAY_MIN": str(args.delay),
+        "REPLY_DELAY_MAX": str(args.delay),
+        "CELERY_EAGER": "true" if args.mode == "eager" else "false",
+    }
+    if args.redis != "fake":
+        env["REDIS_URL"] = args.redis
+    os.environ.update(env)
+
+    import requests
+    http = requests.Session()
+    gateway = start_fake_gateway(args.gateway_port, args.latency_ms, args.error_rate,
+                                 args.http_error_rate, args.devices)
+    web = worker = None
+    counter = RedisOpCounter()
+    try:
+        if args.redis == "fake":
+            redis_client = use_fake_redis()
+        else:
+            from redis import Redis
+            redis_client = Redis.from_url(args.redis)
+            redis_client.flushdb()
+
+        from keyspace import CONFIG_KEY
+        redis_client.set(CONFIG_KEY, json.dumps({
+            "enabled": True, "reply_mode": 2,
+            "step0_text": "bench step0", "step1_text": "bench step1",
+        }))
+
+        if args.mode == "eager":
+            poster = EagerPoster()
+            counter.install()
+        else:
+            web = spawn([sys.executable, "-m", "gunicorn", "-b", f"127.0.0.1:{args.web_port}",
+                         "-w", str(args.web_workers), "app:app"], env=env,
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            worker = spawn([sys.executable, "-m", "celery", "-A", "celery_worker", "worker",
+                            "--loglevel=warning", "-c", str(args.worker_concurrency)]
+                           + args.worker_args.split(), env=env,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            wait_port("127.0.0.1", args.web_port)
+            time.sleep(3)  # worker prêt
+            poster = HttpPoster(f"http://127.0.0.1:{args.web_port}")
+
+        ops_before = counter.snapshot()
+        server_before = server_commands(redis_client) if args.redis != "fake" else 0
+
+        total_received = 0
+        total_elapsed = 0.0
+        latencies = []
+        posted = 0
+        for batch, expected in build_rounds(args.scenario, args.messages, args.devices):
+            received, elapsed, lat = run_round(poster, http, gateway_url, batch, expected,
+                                               args.rate, max(1, args.batch_size), args.delay, args.timeout)
+            total_received += received
+            total_elapsed += elapsed
+            latencies.extend(lat)
+            posted += len(batch)
+
+        ops_after = counter.snapshot()
+        report = {
+            "mode": args.mode,
+            "redis": "fake" if args.redis == "fake" else "server",
+            "scenario": args.scenario,
+            "messages_posted": posted,
+            "replies_sent": total_received,
+            "elapsed_s": round(total_elapsed, 3),
+            "msg_per_s": round(posted / total_elapsed, 1) if total_elapsed else 0.0,
+            "latency_p50_ms": round(percentile(latencies, 50) * 1000, 1),
+            "latency_p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        }
+        if args.mode == "eager":
+            report["redis_ops_per_msg"] = round((ops_after[0] - ops_before[0]) / max(1, posted), 2)
+            report["redis_round_trips_per_msg"] = round((ops_after[1] - ops_before[1]) / max(1, posted), 2)
+            report["peak_rss_mb"] = round(self_peak_rss_mb(), 1)
+        else:
+            cmds = server_commands(redis_client) - server_before
+            report["redis_ops_per_msg"] = round(cmds / max(1, posted), 2)
+            report["web_peak_rss_mb"] = {k: round(v, 1) for k, v in tree_peak_rss_mb(web.pid).items()}
+            report["worker_peak_rss_mb"] = {k: round(v, 1) for k, v in tree_peak_rss_mb(worker.pid).items()}
+
+        for k, v in report.items():
+            print(f"{k:28s} {v}")
+        if args.json:
+            dump_json(args.json, report)
+        return report
+    finally:
+        stop(web)
+        stop(worker)
+        stop(gateway)
+
+
+if __name__ == "__main__":
+    main()
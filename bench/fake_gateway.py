@@ -0,0 +1,137 @@
+"""
+Faux gateway local (send.php / get-devices.php) pour les tests de charge.
+
+    python -m bench.fake_gateway --port 8099 --latency-ms 200 --devices 4 --error-rate 0.02
+
+Puis SERVER=http://127.0.0.1:8099 pour le worker ou les benchs.
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import time
+
+from aiohttp import web
+
+
+class FakeGateway:
+    def __init__(self, latency_ms=200, jitter_ms=0, devices=4, error_rate=0.0,
+                 http_error_rate=0.0, devices_latency_ms=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.devices = devices
+        self.error_rate = error_rate              # success=false dans la réponse
+        self.http_error_rate = http_error_rate    # HTTP 500 non-JSON
+        self.devices_latency_ms = devices_latency_ms
+        self.ids = itertools.count(1)
+        self.reset()
+
+    def reset(self):
+        self.started_at = time.time()
+        self.received = 0
+        self.errors = 0
+        self.inflight = 0
+        self.max_inflight = 0
+        self.per_device = {}
+        self.sent = []   # (number, device, t_received)
+
+    async def _sleep(self):
+        delay = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000.0)
+
+    async def send(self, request):
+        form = await request.post()
+        self.received += 1
+        self.inflight += 1
+        self.max_inflight = max(self.max_inflight, self.inflight)
+        device = str(form.get("devices") or "")
+        self.per_device[device] = self.per_device.get(device, 0) + 1
+        self.sent.append((form.get("number"), device, time.time()))
+        try:
+            await self._sleep()
+        finally:
+            self.inflight -= 1
+
+        roll = random.random()
+        if roll < self.http_error_rate:
+            self.errors += 1
+            return web.Response(status=500, text="Internal Server Error")
+        if roll < self.http_error_rate + self.error_rate:
+            self.errors += 1
+            return web.json_response({"success": False, "data": None, "error": {"code": 500, "message": "fake error"}})
+
+        return web.json_response({
+            "success": True,
+            "data": {"messages": [{
+                "ID": next(self.ids),
+                "number": form.get("number"),
+                "deviceID": device,
+                "status": "Pending",
+            }]},
+            "error": None,
+        })
+
+    async def get_devices(self, request):
+        if self.devices_latency_ms > 0:
+            await asyncio.sleep(self.devices_latency_ms / 1000.0)
+        devices = [
+            {"id": i, "name": f"fake-{i}", "model": "FakePhone", "enabled": 1}
+            for i in range(1, self.devices + 1)
+        ]
+        return web.json_response({"success": True, "data": {"devices": devices}, "error": None})
+
+    async def stats(self, request):
+        elapsed = max(time.time() - self.started_at, 1e-6)
+        return web.json_response({
+            "received": self.received,
+            "errors": self.errors,
+            "inflight": self.inflight,
+            "max_inflight": self.max_inflight,
+            "per_device": self.per_device,
+            "rate": round(self.received / elapsed, 2),
+        })
+
+    async def sent_log(self, request):
+        since = int(request.query.get("since") or 0)
+        return web.json_response({"sent": self.sent[since:], "next": len(self.sent)})
+
+    async def do_reset(self, request):
+        self.reset()
+        return web.json_response({"ok": True})
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post("/services/send.php", self.send)
+        app.router.add_get("/services/get-devices.php", self.get_devices)
+        app.router.add_get("/stats", self.stats)
+        app.router.add_get("/sent", self.sent_log)
+        app.router.add_post("/reset", self.do_reset)
+        return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Faux gateway SMS")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency-ms", type=float, default=200)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--devices", type=int, default=4)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="part de réponses success=false")
+    parser.add_argument("--http-error-rate", type=float, default=0.0, help="part de HTTP 500")
+    parser.add_argument("--devices-latency-ms", type=float, default=0)
+    args = parser.parse_args(argv)
+
+    gw = FakeGateway(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        devices=args.devices,
+        error_rate=args.error_rate,
+        http_error_rate=args.http_error_rate,
+        devices_latency_ms=args.devices_latency_ms,
+    )
+    web.run_app(gw.make_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Test de charge de l'envoi gateway : sync (requests) vs async (gateway_async).
+
+    python -m bench.fake_gateway --latency-ms 200 &
+    python -m bench.load_gateway --url http://127.0.0.1:8099 --messages 2000 --devices 4
+"""
+import argparse
+import time
+
+from gateway_async import AsyncGateway
+
+
+def _payload(i, devices):
+    return {
+        "number": f"+3360000{i:05d}",
+        "message": "bench",
+        "devices": str(1 + i % devices),
+        "type": "sms",
+        "prioritize": 1,
+        "key": "bench",
+    }
+
+
+def run_sync(url, messages, devices):
+    import requests
+    session = requests.Session()
+    start = time.perf_counter()
+    for i in range(messages):
+        session.post(url, data=_payload(i, devices)).json()
+    return time.perf_counter() - start
+
+
+def run_async(url, messages, devices, device_concurrency):
+    gw = AsyncGateway(device_concurrency=device_concurrency, max_inflight=device_concurrency * devices)
+    start = time.perf_counter()
+    for i in range(messages):
+        gw.submit(url, _payload(i, devices))
+    gw.drain(timeout=3600)
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Charge gateway sync vs async")
+    parser.add_argument("--url", default="http://127.0.0.1:8099")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--devices", type=int, default=4)
+    parser.add_argument("--device-concurrency", type=int, default=50)
+    parser.add_argument("--sync-messages", type=int, default=50,
+                        help="messages envoyés en mode sync (plus lent)")
+    args = parser.parse_args(argv)
+
+    url = f"{args.url.rstrip('/')}/services/send.php"
+
+    if args.sync_messages > 0:
+        elapsed = run_sync(url, args.sync_messages, args.devices)
+        print(f"sync  : {args.sync_messages} msgs en {elapsed:.2f}s → {args.sync_messages / elapsed:.1f} msg/s")
+
+    elapsed = run_async(url, args.messages, args.devices, args.device_concurrency)
+    print(f"async : {args.messages} msgs en {elapsed:.2f}s → {args.messages / elapsed:.1f} msg/s")
+
+
+if __name__ == "__main__":
+    main()
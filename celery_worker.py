@@ -1,15 +1,78 @@
 import os
 from celery import Celery
+from kombu import Queue
+from celery.signals import worker_ready, worker_process_init
 from logger import log
+from redis_pool import (
+    redis_ssl_options,
+    REDIS_MAX_CONNECTIONS,
+    REDIS_SOCKET_TIMEOUT,
+    REDIS_CONNECT_TIMEOUT,
+    REDIS_HEALTH_CHECK_INTERVAL,
+)
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 
-# 🔒 Gérer SSL si rediss:// est utilisé
-ssl_options = {}
-if REDIS_URL.startswith("rediss://"):
-    ssl_options = {
-        "ssl_cert_reqs": "none"  # Pour Upstash, aucun certificat requis
-    }
+# 🔒 Gérer SSL si rediss:// est utilisé (mêmes options que redis_pool pour l'app)
+ssl_options = redis_ssl_options(REDIS_URL)
+
+# -----------------------
+# FILES / PRIORITÉS
+# -----------------------
+# replies   : process_message (sensible au délai)
+# campaigns : envois de lots
+# imports   : import numlist, compaction / restore d'archives
+QUEUE_REPLIES = "replies"
+QUEUE_CAMPAIGNS = "campaigns"
+QUEUE_IMPORTS = "imports"
+
+# transport Redis : 0 = plus prioritaire
+PRIORITY_REPLY = 0
+PRIORITY_CAMPAIGN = 5
+PRIORITY_IMPORT = 9
+
+TASK_ROUTES = {
+    "process_message": {"queue": QUEUE_REPLIES, "priority": PRIORITY_REPLY},
+    "dispatch_batch": {"queue": QUEUE_CAMPAIGNS, "priority": PRIORITY_CAMPAIGN},
+    "send_campaign_chunk": {"queue": QUEUE_CAMPAIGNS, "priority": PRIORITY_CAMPAIGN},
+    "send_device_chunk": {"queue": QUEUE_CAMPAIGNS, "priority": PRIORITY_CAMPAIGN},
+    "import_numlist": {"queue": QUEUE_IMPORTS, "priority": PRIORITY_IMPORT},
+    "compact_archives": {"queue": QUEUE_IMPORTS, "priority": PRIORITY_IMPORT},
+    "restore_batch": {"queue": QUEUE_IMPORTS, "priority": PRIORITY_IMPORT},
+    "refresh_devices": {"queue": QUEUE_REPLIES, "priority": PRIORITY_IMPORT},
+    "sweep_conversations": {"queue": QUEUE_IMPORTS, "priority": PRIORITY_IMPORT},
+}
+
+# -----------------------
+# EXÉCUTION DES TÂCHES / RÉSULTATS
+# -----------------------
+# Personne ne lit les résultats Celery : sans réglage, chaque tâche écrit STARTED puis
+# SUCCESS (celery-task-meta-*) dans Redis. Les tâches sont "fire-and-forget" et exposent
+# leur progression via des clés dédiées (nl:batch:progress:*, nl:import:*, task:status:*).
+# CELERY_TASK_RESULTS=on rétablit l'ancien comportement (debug, bench avant/après).
+TASK_RESULTS = os.getenv("CELERY_TASK_RESULTS", "off").lower() in ("on", "true", "1")
+
+TASK_EXECUTION = {
+    "process_message": {"ignore_result": True},
+    "dispatch_batch": {"ignore_result": True},
+    "send_campaign_chunk": {"ignore_result": True},
+    "send_device_chunk": {"ignore_result": True},
+    "import_numlist": {"ignore_result": True},      # statut : nl:import:<id>
+    "compact_archives": {"ignore_result": True},    # statut : task:status:compact_archives
+    "restore_batch": {"ignore_result": True},       # statut : task:status:restore_batch:<id>
+    "refresh_devices": {"ignore_result": True},
+    "sweep_conversations": {"ignore_result": True},  # statut : task:status:sweep_conversations
+}
+
+# Réglages par type de worker (WORKER_QUEUE, voir Procfile), surchargeables par env
+WORKER_PROFILES = {
+    QUEUE_REPLIES: {"concurrency": 8, "prefetch": 4, "acks_late": False},
+    QUEUE_CAMPAIGNS: {"concurrency": 4, "prefetch": 1, "acks_late": True},
+    QUEUE_IMPORTS: {"concurrency": 1, "prefetch": 1, "acks_late": True},
+}
+WORKER_QUEUE = os.getenv("WORKER_QUEUE", QUEUE_REPLIES)
+_profile = WORKER_PROFILES.get(WORKER_QUEUE, WORKER_PROFILES[QUEUE_REPLIES])
+_env_prefix = WORKER_QUEUE.upper()
 
 # ✅ Initialisation de Celery
 celery = Celery(
@@ -22,16 +85,70 @@ celery = Celery(
 celery.conf.update(
     timezone="UTC",
     enable_utc=True,
-    task_track_started=True,
+    task_track_started=TASK_RESULTS,
+    task_ignore_result=not TASK_RESULTS,
+    task_annotations={} if TASK_RESULTS else TASK_EXECUTION,
+    task_store_errors_even_if_ignored=False,
+    result_expires=int(os.getenv("CELERY_RESULT_EXPIRES", "3600")),
+    # bench / dev : exécution synchrone dans le process appelant
+    task_always_eager=os.getenv("CELERY_EAGER", "false").lower() == "true",
+    task_queues=[Queue(QUEUE_REPLIES), Queue(QUEUE_CAMPAIGNS), Queue(QUEUE_IMPORTS)],
+    task_default_queue=QUEUE_REPLIES,
+    task_routes=TASK_ROUTES,
+    task_default_priority=PRIORITY_CAMPAIGN,
+    worker_concurrency=int(os.getenv(f"{_env_prefix}_CONCURRENCY", _profile["concurrency"])),
+    worker_prefetch_multiplier=int(os.getenv(f"{_env_prefix}_PREFETCH", _profile["prefetch"])),
+    task_acks_late=_profile["acks_late"],
     task_serializer="json",
     accept_content=["json"],
     result_serializer="json",
     broker_use_ssl=ssl_options if REDIS_URL.startswith("rediss://") else None,
     redis_backend_use_ssl=ssl_options if REDIS_URL.startswith("rediss://") else None,
+    # 🔌 connexions bornées + timeouts + health checks (broker & backend)
+    broker_pool_limit=int(os.getenv("CELERY_BROKER_POOL_LIMIT", "10")),
+    broker_transport_options={
+        "queue_order_strategy": "priority",
+        "priority_steps": list(range(10)),
+        "sep": ":",
+        "socket_timeout": REDIS_SOCKET_TIMEOUT,
+        "socket_connect_timeout": REDIS_CONNECT_TIMEOUT,
+        "health_check_interval": REDIS_HEALTH_CHECK_INTERVAL,
+    },
+    broker_connection_retry_on_startup=True,
+    redis_max_connections=REDIS_MAX_CONNECTIONS,
+    redis_socket_timeout=REDIS_SOCKET_TIMEOUT,
+    redis_socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+    redis_backend_health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+    beat_schedule={
+        # 🧊 lots anciens + nl:archive -> fichiers gzip (cold_storage.py)
+        "compact-archives": {
+            "task": "compact_archives",
+            "schedule": float(os.getenv("ARCHIVE_COMPACT_EVERY", "21600")),
+        },
+        # 🧹 conversations sans TTL / inactives (sweeper.py), par petits lots SCAN
+        "sweep-conversations": {
+            "task": "sweep_conversations",
+            "schedule": float(os.getenv("CONV_SWEEP_EVERY", "300")),
+        },
+        # 🔌 liste get-devices.php -> device_health (circuit des devices désactivés)
+        "refresh-devices": {
+            "task": "refresh_devices",
+            "schedule": float(os.getenv("HEALTH_DEVICES_TTL", "60")),
+        },
+    },
 )
 
-# ✅ Log au démarrage
-try:
-    log("✅ Celery initialisé avec succès (broker & backend Redis)")
-except Exception as e:
-    print(f"❌ Erreur init Celery : {e}")
+# 🔁 Chaque process enfant (prefork) recrée ses clients Redis
+@worker_process_init.connect
+def _reset_redis_after_fork(**kwargs):
+    from keyspace import reset_clients
+    reset_clients()
+
+
+# ✅ Log au démarrage du worker (pas à l'import : le web importe aussi ce module)
+@worker_ready.connect
+def _log_ready(**kwargs):
+    try:
+        log("✅ Celery initialisé avec succès (broker & backend Redis)")
+    except Exception as e:
+        print(f"❌ Erreur init Celery : {e}")
@@ -0,0 +1,254 @@
+import os
+import gzip
+import json
+import time
+import tempfile
+from datetime import datetime, timezone
+
+from logger import log
+from keyspace import (
+    NL_ARCHIVE_LIST,
+    BATCH_ZINDEX,
+    BATCH_ITEMS_PREFIX,
+    BATCH_POS_PREFIX,
+    COLD_INDEX,
+    COLD_LOCK,
+    BATCH_DISPATCHED_PREFIX,
+    main_redis,
+)
+from numlist import iter_batch_items, load_batch_meta, save_batch_meta
+import allocation
+
+# ⚠️ Volume persistant ET partagé web/worker obligatoire : la compaction supprime la
+# copie Redis. Non configuré (ou disque temporaire du dyno) => pas de compaction.
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "").strip()
+COLD_AFTER_DAYS = int(os.getenv("ARCHIVE_COLD_AFTER_DAYS", "30"))
+COMPACT_CHUNK = 1000
+
+
+def _utc(ts):
+    return datetime.fromtimestamp(int(ts or 0), tz=timezone.utc)
+
+
+def _write_gzip_jsonl(path, records):
+    """Écrit dans path.tmp puis rename : pas de fichier partiel visible."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    n = 0
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        for rec in records:
+            f.write(json.dumps(rec, ensure_ascii=False))
+            f.write("\n")
+            n += 1
+    os.replace(tmp, path)
+    return n
+
+
+def iter_gzip_jsonl(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def _append_file_index(entry):
+    # index fichier (lisible hors Redis) en plus de nl:cold:index
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    with open(os.path.join(ARCHIVE_DIR, "index.jsonl"), "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def archive_dir_error():
+    """Raison de refuser la compaction (None si ARCHIVE_DIR est utilisable)."""
+    if not ARCHIVE_DIR:
+        return "ARCHIVE_DIR non configuré"
+    real = os.path.realpath(ARCHIVE_DIR)
+    tmp = os.path.realpath(tempfile.gettempdir())
+    if real == tmp or real.startswith(tmp + os.sep):
+        return f"ARCHIVE_DIR sur disque temporaire ({ARCHIVE_DIR})"
+    return None
+
+
+def batch_path(meta):
+    d = _utc(meta.get("created_at"))
+    return os.path.join(ARCHIVE_DIR, "batches", f"{d:%Y}", f"{d:%m}", f"batch-{meta['batch_id']}.jsonl.gz")
+
+
+def cold_entry(batch_id, redis_conn=None):
+    r = redis_conn or main_redis()
+    raw = r.hget(COLD_INDEX, str(batch_id))
+    if not raw:
+        return None
+    try:
+        return json.loads(raw.decode("utf-8"))
+    except Exception:
+        return None
+
+
+# -----------------------
+# COMPACTION
+# -----------------------
+def _in_flight(batch_id, meta, dispatched):
+    """Raison de garder un lot dans Redis malgré son âge (campagne en cours), sinon None."""
+    sched = meta.get("schedule") or {}
+    if sched and not dispatched:
+        return "campagne planifiée non lancée"
+    if sched.get("end_at") and float(sched["end_at"]) > time.time():
+        return "fin de campagne à venir"
+    left = sum(allocation.remaining(batch_id, list(meta.get("allocation") or {})).values())
+    if left:
+        return f"{left} envoi(s) en attente"
+    return None
+
+
+def compact_batch(batch_id, redis_conn=None, restored_before=None):
+    """restored_before : lot restauré après ce timestamp => laissé dans Redis."""
+    r = redis_conn or main_redis()
+    meta = load_batch_meta(batch_id, r)
+    if not meta or meta.get("cold"):
+        return 0
+    if restored_before is not None and int(meta.get("restored_at") or 0) > restored_before:
+        return 0
+    dispatched = meta.get("dispatched_at") or r.exists(BATCH_DISPATCHED_PREFIX + str(batch_id))
+    busy = _in_flight(batch_id, meta, dispatched)
+    if busy:
+        log(f"⏭️ Compaction lot #{batch_id} ignorée : {busy}")
+        return 0
+
+    items_key = BATCH_ITEMS_PREFIX + str(batch_id)
+    expected = int(r.llen(items_key) or 0)
+    path = batch_path(meta)
+    written = _write_gzip_jsonl(path, iter_batch_items(batch_id, chunk=COMPACT_CHUNK, redis_conn=r))
+    if written != expected:
+        # le lot a bougé pendant l'écriture -> on garde Redis, prochain passage
+        log(f"⚠️ Compaction lot #{batch_id} : {written}/{expected} items, annulée")
+        os.remove(path)
+        return 0
+
+    entry = {
+        "batch_id": str(batch_id),
+        "path": path,
+        "count": written,
+        "created_at": meta.get("created_at"),
+        "archived_at": int(time.time()),
+    }
+    meta["cold"] = True
+    meta["cold_path"] = path
+    meta["cold_at"] = entry["archived_at"]
+
+    pipe = r.pipeline()
+    pipe.hset(COLD_INDEX, str(batch_id), json.dumps(entry, ensure_ascii=False))
+    pipe.delete(items_key, BATCH_POS_PREFIX + str(batch_id))
+    pipe.execute()
+    # sous-listes supprimées : leurs positions sortent du backlog (s'il a été compté)
+    allocation.drop(batch_id, meta.get("allocation") or {}, backlog=bool(dispatched))
+    save_batch_meta(meta, r)
+    _append_file_index(entry)
+
+    log(f"🧊 Lot #{batch_id} compacté → {path} ({written} items)")
+    return written
+
+
+def compact_archive_list(redis_conn=None, chunk=COMPACT_CHUNK):
+    """
+    Vide nl:archive dans un fichier gzip daté, par tranches LRANGE + LTRIM.
+    """
+    r = redis_conn or main_redis()
+    total = int(r.llen(NL_ARCHIVE_LIST) or 0)
+    if total <= 0:
+        return 0
+
+    now = datetime.now(timezone.utc)
+    path = os.path.join(ARCHIVE_DIR, "nl-archive", f"{now:%Y}", f"{now:%m}",
+                        f"archive-{now:%Y%m%dT%H%M%S}.jsonl.gz")
+
+    def _records():
+        pos = 0
+        while pos < total:
+            raws = r.lrange(NL_ARCHIVE_LIST, pos, min(total, pos + chunk) - 1)
+            if not raws:
+                return
+            for raw in raws:
+                try:
+                    yield json.loads(raw.decode("utf-8"))
+                except Exception:
+                    yield {"_raw": raw.decode("utf-8", errors="replace")}
+            pos += len(raws)
+
+    written = _write_gzip_jsonl(path, _records())
+    # RPUSH ajoute en fin : on ne retire que la tête déjà écrite
+    r.ltrim(NL_ARCHIVE_LIST, written, -1)
+    _append_file_index({"kind": "nl_archive", "path": path, "count": written, "archived_at": int(now.timestamp())})
+
+    log(f"🧊 nl:archive compacté → {path} ({written} items)")
+    return written
+
+
+def compact(older_than_days=COLD_AFTER_DAYS, redis_conn=None):
+    r = redis_conn or main_redis()
+    refused = archive_dir_error()
+    if refused:
+        log(f"⛔️ Compaction désactivée : {refused}")
+        return {"batches": 0, "items": 0, "archive": 0, "error": refused}
+    if not r.set(COLD_LOCK, 1, nx=True, ex=3600):
+        log("⏭️ Compaction déjà en cours")
+        return {"batches": 0, "items": 0, "archive": 0}
+
+    try:
+        cutoff = int(time.time()) - older_than_days * 86400
+        batches = 0
+        items = 0
+        for raw in r.zrangebyscore(BATCH_ZINDEX, "-inf", cutoff):
+            batch_id = raw.decode("utf-8")
+            # lot restauré récemment : même délai que depuis sa création
+            n = compact_batch(batch_id, r, restored_before=cutoff)
+            if n:
+                batches += 1
+                items += n
+        archive = compact_archive_list(r)
+        log(f"🧊 Compaction : {batches} lot(s), {items} items, {archive} archive")
+        return {"batches": batches, "items": items, "archive": archive}
+    finally:
+        r.delete(COLD_LOCK)
+
+
+# -----------------------
+# RESTORE
+# -----------------------
+def restore_batch(batch_id, redis_conn=None, chunk=COMPACT_CHUNK):
+    r = redis_conn or main_redis()
+    meta = load_batch_meta(batch_id, r)
+    entry = cold_entry(batch_id, r)
+    if not meta or not entry:
+        return 0
+
+    path = entry["path"]
+    if not os.path.exists(path):
+        log(f"❌ Restore lot #{batch_id} : fichier absent {path}")
+        return 0
+
+    items_key = BATCH_ITEMS_PREFIX + str(batch_id)
+    pos_key = BATCH_POS_PREFIX + str(batch_id)
+    number_col = meta.get("number_col")
+
+    r.delete(items_key, pos_key)
+    pipe = r.pipeline()
+    n = 0
+    for rec in iter_gzip_jsonl(path):
+        pipe.rpush(items_key, json.dumps(rec, ensure_ascii=False))
+        number = str(rec.get(number_col) or "").strip() if number_col else ""
+        if number:
+            pipe.hsetnx(pos_key, number, n)
+        n += 1
+        if n % chunk == 0:
+            pipe.execute()
+    pipe.execute()
+
+    meta.pop("cold", None)
+    meta["restored_at"] = int(time.time())
+    save_batch_meta(meta, r)
+    r.hdel(COLD_INDEX, str(batch_id))
+
+    log(f"♻️ Lot #{batch_id} restauré depuis {path} ({n} items)")
+    return n
@@ -0,0 +1,167 @@
+"""
+Tableau de bord en direct (SSE) : les compteurs publient des deltas sur un canal
+pub/sub Redis ; chaque process web a UN abonnement (DashboardHub) qui agrège les
+deltas et les diffuse à tous les navigateurs connectés. La charge Redis ne dépend
+pas du nombre d'opérateurs.
+"""
+import os
+import json
+import time
+import queue
+import threading
+
+from logger import log
+import nl_pool
+from keyspace import DASH_CHANNEL, main_redis
+
+DASH_EVENTS = os.getenv("DASH_EVENTS", "true").lower() == "true"
+DASH_FLUSH_MS = int(os.getenv("DASH_FLUSH_MS", "500"))         # agrégation avant diffusion
+DASH_HEARTBEAT = int(os.getenv("DASH_HEARTBEAT", "15"))        # commentaire SSE keep-alive
+DASH_CLIENT_QUEUE = int(os.getenv("DASH_CLIENT_QUEUE", "100"))
+
+
+# -----------------------
+# PUBLICATION (workers / web)
+# -----------------------
+def _publish(redis_or_pipe, event):
+    if DASH_EVENTS:
+        redis_or_pipe.publish(DASH_CHANNEL, json.dumps(event, separators=(",", ":")))
+
+
+def publish_device(redis_or_pipe, device_id, field, delta=1):
+    """Compteur device (received/sent/errors) ; à ajouter au pipeline de l'incrément."""
+    _publish(redis_or_pipe, {"t": "device", "d": str(device_id), "f": field, "n": int(delta)})
+
+
+def publish_batch(redis_or_pipe, batch_id, **deltas):
+    _publish(redis_or_pipe, {"t": "batch", "b": str(batch_id), "n": {k: int(v) for k, v in deltas.items() if v}})
+
+
+def publish_pool(redis_or_pipe):
+    """Taille du pool modifiée : le hub la relit une fois pour tous ses clients."""
+    _publish(redis_or_pipe, {"t": "pool"})
+
+
+# -----------------------
+# HUB (un par process web)
+# -----------------------
+class DashboardHub:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = set()
+        self._pending = None
+        self._thread = None
+
+    # clients SSE
+    def subscribe(self):
+        q = queue.Queue(maxsize=DASH_CLIENT_QUEUE)
+        with self._lock:
+            self._clients.add(q)
+            self._ensure_thread()
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._clients.discard(q)
+
+    def _broadcast(self, payload):
+        with self._lock:
+            clients = list(self._clients)
+        for q in clients:
+            try:
+                q.put_nowait(payload)
+            except queue.Full:
+                # client lent : on jette le plus ancien, il recevra les suivants
+                try:
+                    q.get_nowait()
+                    q.put_nowait(payload)
+                except (queue.Empty, queue.Full):
+                    pass
+
+    # abonnement Redis
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="dashboard-hub", daemon=True)
+            self._thread.start()
+
+    @staticmethod
+    def _empty():
+        return {"devices": {}, "batches": {}, "pool": False}
+
+    def _merge(self, event):
+        p = self._pending
+        kind = event.get("t")
+        if kind == "device":
+            dev = p["devices"].setdefault(event["d"], {})
+            dev[event["f"]] = dev.get(event["f"], 0) + int(event.get("n") or 0)
+        elif kind == "batch":
+            b = p["batches"].setdefault(event["b"], {})
+            for k, v in (event.get("n") or {}).items():
+                b[k] = b.get(k, 0) + int(v)
+        elif kind == "pool":
+            p["pool"] = True
+
+    def _flush(self, redis_conn):
+        p, self._pending = self._pending, self._empty()
+        if not (p["devices"] or p["batches"] or p["pool"]):
+            return
+        delta = {"devices": p["devices"], "batches": p["batches"]}
+        if p["pool"]:
+            delta["remaining"] = nl_pool.remaining(redis_conn)
+        self._broadcast(json.dumps(delta, separators=(",", ":")))
+
+    def _run(self):
+        while True:
+            try:
+                redis_conn = main_redis()
+                pubsub = redis_conn.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(DASH_CHANNEL)
+                self._pending = self._empty()
+                next_flush = time.monotonic() + DASH_FLUSH_MS / 1000.0
+                while True:
+                    with self._lock:
+                        if not self._clients:
+                            # plus personne : on libère l'abonnement
+                            self._thread = None
+                            pubsub.close()
+                            return
+                    msg = pubsub.get_message(timeout=max(0.0, next_flush - time.monotonic()))
+                    if msg and msg.get("type") == "message":
+                        try:
+                            self._merge(json.loads(msg["data"]))
+                        except (ValueError, KeyError, TypeError):
+                            pass
+                    if time.monotonic() >= next_flush:
+                        self._flush(redis_conn)
+                        next_flush = time.monotonic() + DASH_FLUSH_MS / 1000.0
+            except Exception as e:
+                log(f"💥 Dashboard hub : {e}")
+                time.sleep(1)
+
+
+_hubs = {}
+
+
+def hub():
+    # un hub par process (après fork gunicorn : nouveau thread, nouvelle connexion)
+    pid = os.getpid()
+    h = _hubs.get(pid)
+    if h is None:
+        h = _hubs[pid] = DashboardHub()
+    return h
+
+
+def sse_stream(client_queue):
+    """Générateur SSE pour un client abonné au hub."""
+    h = hub()
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            try:
+                payload = client_queue.get(timeout=DASH_HEARTBEAT)
+            except queue.Empty:
+                yield ": ping\n\n"
+                continue
+            yield f"event: delta\ndata: {payload}\n\n"
+    finally:
+        h.unsubscribe(client_queue)
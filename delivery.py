@@ -0,0 +1,164 @@
+"""
+Accusés de livraison : à l'envoi, chaque ID de message renvoyé par le gateway est
+indexé (dlv:ref:<id> -> device, lot) ; le webhook /delivery_status reçoit les statuts
+en masse, relit les références en un pipeline puis applique compteurs et statuts
+en un second pipeline (stats:device:*:delivered|failed, progression du lot).
+
+La référence est écrite dès la réponse du gateway (tout de suite après un envoi
+synchrone, dans le callback du Future en mode GATEWAY_ASYNC), avant que le statut
+puisse arriver. Une écriture en échec reste en attente et repart avec la suivante.
+"""
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from logger import log
+from keyspace import DELIVERY_REF_PREFIX, BATCH_PROGRESS_PREFIX, device_stat_key, lazy_main_redis
+from dashboard import publish_device, publish_batch
+
+DELIVERY_TRACKING = os.getenv("DELIVERY_TRACKING", "true").lower() == "true"
+DELIVERY_REF_TTL = int(os.getenv("DELIVERY_REF_TTL", str(7 * 86400)))
+
+# statut gateway -> compteur ; les autres (Pending, Queued, Sent...) sont intermédiaires
+FINAL_STATUSES = {"delivered": "delivered", "failed": "failed"}
+
+redis_conn = lazy_main_redis()
+
+_lock = threading.Lock()
+_pending = []      # références dont l'écriture a échoué (rejouées à la suivante)
+_writer = None     # callbacks async : écriture hors de la boucle asyncio du gateway
+
+
+# -----------------------
+# INDEX À L'ENVOI
+# -----------------------
+def gateway_ids(data):
+    """IDs des messages dans la réponse de send.php (data.messages ou liste)."""
+    if isinstance(data, dict):
+        data = data.get("messages") or ([data] if data.get("ID") else [])
+    if not isinstance(data, list):
+        return []
+    return [str(m["ID"]) for m in data if isinstance(m, dict) and m.get("ID")]
+
+
+def _write(refs):
+    with _lock:
+        refs = _pending[:] + list(refs)
+        del _pending[:]
+    if not refs:
+        return 0
+    try:
+        pipe = redis_conn.pipeline(transaction=False)
+        for gid, device, batch in refs:
+            key = DELIVERY_REF_PREFIX + gid
+            fields = {"d": device, "s": "sent"}
+            if batch:
+                fields["b"] = batch
+            pipe.hset(key, mapping=fields)
+            pipe.expire(key, DELIVERY_REF_TTL)
+        pipe.execute()
+    except Exception as e:
+        # gardées pour la prochaine écriture (ou flush() en fin de process)
+        with _lock:
+            _pending[:0] = refs
+        log(f"❌ Index livraison : {len(refs)} référence(s) en attente : {e}")
+        return 0
+    return len(refs)
+
+
+def _refs(data, device_id, batch_id):
+    return [(gid, str(device_id), str(batch_id or "")) for gid in gateway_ids(data)]
+
+
+def _submit_write(refs):
+    global _writer
+    with _lock:
+        if _writer is None:
+            _writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="delivery-index")
+    return _writer.submit(_write, refs)
+
+
+def track(result, device_id, batch_id=None):
+    """
+    Résultat de send_request : data (écriture immédiate) ou Future en mode
+    GATEWAY_ASYNC (écriture à la réponse du gateway, hors boucle asyncio).
+    """
+    if not DELIVERY_TRACKING or result is None:
+        return
+    if isinstance(result, Future):
+        def _done(fut):
+            if not fut.cancelled() and fut.exception() is None:
+                refs = _refs(fut.result(), device_id, batch_id)
+                if refs:
+                    _submit_write(refs)
+        result.add_done_callback(_done)
+        return
+    refs = _refs(result, device_id, batch_id)
+    if refs:
+        _write(refs)
+
+
+def flush():
+    """Fin de process : attend les écritures async et rejoue les références en attente."""
+    global _writer
+    with _lock:
+        writer, _writer = _writer, None
+    if writer is not None:
+        writer.shutdown(wait=True)
+    return _write([])
+
+
+# -----------------------
+# STATUTS (webhook)
+# -----------------------
+def apply_statuses(redis_conn, updates):
+    """
+    updates : [(id gateway, statut)]. Deux pipelines pour tout le lot.
+    Retourne {"matched", "unknown", "delivered", "failed"}.
+    """
+    latest = {}
+    for gid, status in updates:
+        if gid:
+            latest[str(gid)] = str(status or "").strip().lower()
+    ids = list(latest)
+    result = {"matched": 0, "unknown": 0, "delivered": 0, "failed": 0}
+    if not ids:
+        return result
+
+    pipe = redis_conn.pipeline(transaction=False)
+    for gid in ids:
+        pipe.hmget(DELIVERY_REF_PREFIX + gid, "d", "b", "s")
+    refs = pipe.execute()
+
+    pipe = redis_conn.pipeline(transaction=False)
+    device_deltas, batch_deltas = {}, {}
+    for gid, (device, batch, current) in zip(ids, refs):
+        if not device:
+            result["unknown"] += 1
+            continue
+        result["matched"] += 1
+        status = latest[gid]
+        current = (current or b"").decode("utf-8")
+        if current in FINAL_STATUSES or status == current:
+            continue  # déjà compté (webhook rejoué) ou rien de nouveau
+        pipe.hset(DELIVERY_REF_PREFIX + gid, "s", status)
+        counter = FINAL_STATUSES.get(status)
+        if not counter:
+            continue
+        result[counter] += 1
+        d = device_deltas.setdefault(device.decode("utf-8"), {})
+        d[counter] = d.get(counter, 0) + 1
+        if batch:
+            b = batch_deltas.setdefault(batch.decode("utf-8"), {})
+            b[counter] = b.get(counter, 0) + 1
+
+    for device, deltas in device_deltas.items():
+        for field, n in deltas.items():
+            pipe.incrby(device_stat_key(device, field), n)
+            publish_device(pipe, device, field, n)
+    for batch, deltas in batch_deltas.items():
+        for field, n in deltas.items():
+            pipe.hincrby(BATCH_PROGRESS_PREFIX + batch, field, n)
+        publish_batch(pipe, batch, **deltas)
+    pipe.execute()
+    return result
@@ -0,0 +1,229 @@
+import os
+import json
+import time
+
+from logger import log
+from keyspace import (
+    HEALTH_PREFIX,
+    HEALTH_PROBE_PREFIX,
+    HEALTH_DEVICES_KEY,
+    lazy_main_redis,
+    device_stat_key,
+)
+from dashboard import publish_device
+
+# -----------------------
+# CIRCUIT BREAKER PAR DEVICE
+# -----------------------
+# closed    : envois normaux
+# open      : device en échec -> plus d'envoi pendant HEALTH_COOLDOWN
+# half_open : après cooldown, un seul envoi "sonde" ; succès -> closed, échec -> open
+HEALTH_FAILURE_THRESHOLD = int(os.getenv("HEALTH_FAILURE_THRESHOLD", "5"))
+HEALTH_COOLDOWN = int(os.getenv("HEALTH_COOLDOWN", "120"))
+HEALTH_LOCAL_TTL = float(os.getenv("HEALTH_LOCAL_TTL", "2"))
+HEALTH_DEVICES_TTL = int(os.getenv("HEALTH_DEVICES_TTL", "60"))
+# refus du gateway imputables au device (success:false) ; les autres (numéro invalide,
+# crédit, contenu...) ne comptent pas comme échec. Erreurs réseau / HTTP / timeouts : toujours.
+HEALTH_DEVICE_ERRORS = [
+    s.strip().lower()
+    for s in os.getenv(
+        "HEALTH_DEVICE_ERRORS", "device,offline,disconnected,unreachable,sim card,timeout,timed out"
+    ).split(",")
+    if s.strip()
+]
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+redis_conn = lazy_main_redis()
+
+# cache local (process) : device -> (disponible, expire_at)
+_local = {}
+
+
+def _decode(raw):
+    return {k.decode("utf-8"): v.decode("utf-8", errors="ignore") for k, v in (raw or {}).items()}
+
+
+def device_state(device_id):
+    data = _decode(redis_conn.hgetall(HEALTH_PREFIX + str(device_id)))
+    data.setdefault("state", STATE_CLOSED)
+    return data
+
+
+def record_success(device_id):
+    device_id = str(device_id)
+    pipe = redis_conn.pipeline()
+    pipe.hset(HEALTH_PREFIX + device_id, mapping={"state": STATE_CLOSED, "failures": 0, "last_ok": int(time.time())})
+    pipe.delete(HEALTH_PROBE_PREFIX + device_id)
+    pipe.execute()
+    _local.pop(device_id, None)
+
+
+def record_failure(device_id, error=""):
+    device_id = str(device_id)
+    key = HEALTH_PREFIX + device_id
+    pipe = redis_conn.pipeline()
+    pipe.hincrby(key, "failures", 1)
+    pipe.hget(key, "state")
+    pipe.incrby(device_stat_key(device_id, "errors"), 1)
+    publish_device(pipe, device_id, "errors")
+    failures, state = pipe.execute()[:2]
+    state = (state or b"").decode("utf-8") or STATE_CLOSED
+
+    # sonde half_open ratée, ou seuil atteint -> open
+    if state == STATE_HALF_OPEN or int(failures or 0) >= HEALTH_FAILURE_THRESHOLD:
+        open_device(device_id, error)
+    else:
+        redis_conn.hset(key, "last_error", str(error)[:200])
+
+
+def open_device(device_id, reason=""):
+    device_id = str(device_id)
+    pipe = redis_conn.pipeline()
+    pipe.hset(HEALTH_PREFIX + device_id, mapping={
+        "state": STATE_OPEN,
+        "opened_at": int(time.time()),
+        "last_error": str(reason)[:200],
+    })
+    pipe.delete(HEALTH_PROBE_PREFIX + device_id)
+    pipe.execute()
+    _local[device_id] = (False, time.time() + HEALTH_LOCAL_TTL)
+    log(f"🔌 Device {device_id} → circuit ouvert ({reason})")
+
+
+def is_device_error(error):
+    """Exception (transport, timeout compris) ou refus gateway dont le message désigne le device."""
+    if isinstance(error, Exception):
+        return True
+    text = str(error or "").lower()
+    return any(word in text for word in HEALTH_DEVICE_ERRORS)
+
+
+def release_probe(device_id):
+    """Sonde sans verdict (refus du message, pas du device) : la suivante peut sonder."""
+    redis_conn.delete(HEALTH_PROBE_PREFIX + str(device_id))
+
+
+def record_outcome(device_id, ok, error=""):
+    if not device_id:
+        return
+    try:
+        if ok:
+            record_success(device_id)
+        elif is_device_error(error):
+            record_failure(device_id, error)
+        else:
+            log(f"⚠️ Device {device_id} : envoi refusé, device non mis en cause ({str(error)[:120]})")
+            release_probe(device_id)
+    except Exception as e:
+        log(f"❌ device_health error: {e}")
+
+
+def is_available(device_id, probe=True):
+    """
+    True si on peut envoyer via ce device maintenant.
+    En half_open, un seul appelant obtient la sonde (probe=False : jamais).
+    """
+    device_id = str(device_id)
+    cached = _local.get(device_id)
+    if cached and cached[1] > time.time():
+        return cached[0]
+
+    try:
+        data = device_state(device_id)
+    except Exception:
+        return True  # Redis KO : on ne bloque pas les envois
+
+    state = data.get("state")
+    if state == STATE_CLOSED:
+        _local[device_id] = (True, time.time() + HEALTH_LOCAL_TTL)
+        return True
+
+    opened_at = int(data.get("opened_at") or 0)
+    if time.time() - opened_at < HEALTH_COOLDOWN:
+        _local[device_id] = (False, min(opened_at + HEALTH_COOLDOWN, time.time() + HEALTH_LOCAL_TTL))
+        return False
+
+    # cooldown écoulé -> une sonde
+    if probe and redis_conn.set(HEALTH_PROBE_PREFIX + device_id, 1, nx=True, ex=HEALTH_COOLDOWN):
+        redis_conn.hset(HEALTH_PREFIX + device_id, "state", STATE_HALF_OPEN)
+        return True
+    return False
+
+
+def is_probing(device_id):
+    """True si le device est en half_open (sonde en cours ou à faire)."""
+    return device_state(device_id).get("state") == STATE_HALF_OPEN
+
+
+def is_open(device_id):
+    """True si le circuit est ouvert (cooldown en cours). Ne prend jamais la sonde."""
+    device_id = str(device_id)
+    cached = _local.get(device_id)
+    if cached and cached[1] > time.time():
+        return not cached[0]
+    data = device_state(device_id)
+    return data.get("state") == STATE_OPEN and time.time() - int(data.get("opened_at") or 0) < HEALTH_COOLDOWN
+
+
+# -----------------------
+# LISTE DES DEVICES (get-devices.php)
+# -----------------------
+SERVER = os.getenv("SERVER")
+API_KEY = os.getenv("API_KEY")
+
+
+def fetch_gateway_devices():
+    import requests
+    if not SERVER or not API_KEY:
+        return []
+    url = f"{SERVER}/services/get-devices.php"
+    try:
+        r = requests.get(url, params={"key": API_KEY}, timeout=12)
+        data = r.json()
+        if not data.get("success"):
+            return []
+        devices = (data.get("data") or {}).get("devices") or []
+        sync_gateway_devices(devices)
+        return devices
+    except Exception as e:
+        log(f"❌ fetch_gateway_devices error: {e}")
+        return []
+
+
+def cached_gateway_devices():
+    raw = redis_conn.get(HEALTH_DEVICES_KEY)
+    if not raw:
+        return None
+    try:
+        return json.loads(raw.decode("utf-8"))
+    except Exception:
+        return None
+
+
+def _device_enabled(d):
+    # champ optionnel côté gateway : absent = actif
+    return str(d.get("enabled", 1)).lower() not in ("0", "false", "")
+
+
+def sync_gateway_devices(devices):
+    """
+    Met en cache la liste du gateway et ouvre le circuit des devices désactivés.
+    """
+    redis_conn.set(HEALTH_DEVICES_KEY, json.dumps(devices, ensure_ascii=False), ex=HEALTH_DEVICES_TTL * 5)
+    for d in devices:
+        did = str(d.get("id"))
+        if not _device_enabled(d) and device_state(did).get("state") != STATE_OPEN:
+            open_device(did, "désactivé côté gateway")
+
+
+def known_devices():
+    devices = cached_gateway_devices() or []
+    return [str(d.get("id")) for d in devices if _device_enabled(d)]
+
+
+def healthy_devices(exclude=None):
+    exclude = {str(x) for x in (exclude or [])}
+    return [d for d in known_devices() if d not in exclude and is_available(d, probe=False)]
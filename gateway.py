@@ -0,0 +1,79 @@
+import os
+
+from logger import log
+from tracing import traced
+from device_health import record_outcome
+
+SERVER = os.getenv("SERVER")
+API_KEY = os.getenv("API_KEY")
+
+# ⚡ Mode async : les POST gateway partent sur une boucle asyncio (gateway_async)
+GATEWAY_ASYNC = os.getenv("GATEWAY_ASYNC", "false").lower() == "true"
+# ⏱️ un device qui ne répond pas ne bloque pas le worker : timeout = échec device
+GATEWAY_CONNECT_TIMEOUT = float(os.getenv("GATEWAY_CONNECT_TIMEOUT", "5"))
+GATEWAY_TIMEOUT = float(os.getenv("GATEWAY_TIMEOUT", "30"))   # lecture (sync) / total (async)
+
+_http = None
+_http_pid = None
+
+
+def _http_session():
+    # requests importé une fois, session keep-alive par process (après fork)
+    global _http, _http_pid
+    if _http is None or _http_pid != os.getpid():
+        import requests
+        _http = requests.Session()
+        _http_pid = os.getpid()
+    return _http
+
+
+def post_gateway(url, post_data):
+    """POST synchrone : retourne (ok, data) et alimente device_health."""
+    device_id = post_data.get("devices")
+    log(f"🌐 POST → {url} | data: {post_data}")
+    try:
+        response = _http_session().post(url, data=post_data,
+                                         timeout=(GATEWAY_CONNECT_TIMEOUT, GATEWAY_TIMEOUT))
+        data = response.json()
+        log(f"📨 Réponse : {data}")
+        ok = data.get("success") is not False
+        record_outcome(device_id, ok, data.get("error"))
+        return ok, data.get("data")
+    except Exception as e:
+        # requests.Timeout compris : compté comme échec du device (circuit)
+        log(f"❌ Erreur POST : {e}")
+        record_outcome(device_id, False, e)
+        return False, None
+
+
+@traced("send_request")
+def send_request(url, post_data):
+    """data de la réponse gateway (Future en mode async : résultat à venir)."""
+    if GATEWAY_ASYNC:
+        from gateway_async import gateway
+        return gateway.submit(url, post_data)
+    return post_gateway(url, post_data)[1]
+
+
+def send_payload(number, message, device_slot, msg_type, prioritize=1):
+    return {
+        "number": number,
+        "message": message,
+        "devices": device_slot,
+        "type": msg_type,
+        "prioritize": prioritize,
+        "key": API_KEY,
+    }
+
+
+def send_url():
+    return f"{SERVER}/services/send.php"
+
+
+def send_single_message(number, message, device_slot, msg_type, prioritize=1):
+    if not (message or "").strip():
+        log(f"⛔️ Message vide → aucun envoi vers {number} (type={msg_type})")
+        return None
+
+    log(f"📦 Envoi à {number} via device {device_slot} (type={msg_type})")
+    return send_request(send_url(), send_payload(number, message, device_slot, msg_type, prioritize))
@@ -0,0 +1,118 @@
+import os
+import asyncio
+import threading
+from concurrent.futures import wait as futures_wait
+
+from logger import log
+from device_health import record_outcome
+from gateway import GATEWAY_CONNECT_TIMEOUT, GATEWAY_TIMEOUT
+
+GATEWAY_DEVICE_CONCURRENCY = int(os.getenv("GATEWAY_DEVICE_CONCURRENCY", "20"))
+GATEWAY_MAX_INFLIGHT = int(os.getenv("GATEWAY_MAX_INFLIGHT", "500"))
+
+
+class AsyncGateway:
+    """
+    Pipeline d'envoi asyncio : une boucle dans un thread dédié par process,
+    un client aiohttp partagé et un sémaphore par device.
+    Les tâches Celery soumettent l'envoi et rendent la main tout de suite.
+    """
+
+    def __init__(self, device_concurrency=GATEWAY_DEVICE_CONCURRENCY,
+                 max_inflight=GATEWAY_MAX_INFLIGHT, timeout=GATEWAY_TIMEOUT):
+        self.device_concurrency = max(1, int(device_concurrency))
+        self.max_inflight = max(1, int(max_inflight))
+        self.timeout = float(timeout)
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._loop = None
+        self._thread = None
+        self._session = None
+        self._semaphores = {}
+        self._pending = set()
+
+    # -----------------------
+    # LOOP (démarrée après fork, à la première soumission)
+    # -----------------------
+    def _ensure_started(self):
+        with self._lock:
+            if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._session = None
+            self._semaphores = {}
+            self._pending = set()
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._run, name="gateway-async", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    async def _get_session(self):
+        if self._session is None:
+            import aiohttp
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_inflight),
+                timeout=aiohttp.ClientTimeout(total=self.timeout, connect=GATEWAY_CONNECT_TIMEOUT),
+            )
+        return self._session
+
+    def _semaphore(self, device):
+        sem = self._semaphores.get(device)
+        if sem is None:
+            sem = asyncio.Semaphore(self.device_concurrency)
+            self._semaphores[device] = sem
+        return sem
+
+    # -----------------------
+    # ENVOI
+    # -----------------------
+    async def post(self, url, post_data):
+        device = str(post_data.get("devices") or "")
+        async with self._semaphore(device):
+            session = await self._get_session()
+            log(f"🌐 POST async → {url} | data: {post_data}")
+            try:
+                async with session.post(url, data=post_data) as response:
+                    data = await response.json(content_type=None)
+                log(f"📨 Réponse : {data}")
+                await asyncio.to_thread(record_outcome, device, data.get("success") is not False, data.get("error"))
+                return data.get("data")
+            except Exception as e:
+                log(f"❌ Erreur POST : {e}")
+                await asyncio.to_thread(record_outcome, device, False, e)
+                return None
+
+    def submit(self, url, post_data):
+        self._ensure_started()
+        fut = asyncio.run_coroutine_threadsafe(self.post(url, dict(post_data)), self._loop)
+        with self._lock:
+            self._pending.add(fut)
+        fut.add_done_callback(self._discard)
+        return fut
+
+    def _discard(self, fut):
+        with self._lock:
+            self._pending.discard(fut)
+
+    def inflight(self):
+        with self._lock:
+            return len(self._pending)
+
+    def drain(self, timeout=30):
+        """Attend la fin des envois en cours (arrêt du worker)."""
+        with self._lock:
+            pending = list(self._pending)
+        if not pending:
+            return 0
+        log(f"⏳ Gateway async : {len(pending)} envoi(s) en cours, attente…")
+        _, not_done = futures_wait(pending, timeout=timeout)
+        if not_done:
+            log(f"⚠️ Gateway async : {len(not_done)} envoi(s) non terminés")
+        return len(not_done)
+
+
+gateway = AsyncGateway()
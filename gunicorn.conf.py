@@ -0,0 +1,15 @@
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+
+# 📡 gthread : une connexion SSE (/admin/api/events) occupe un thread, pas un worker
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+
+
+def post_fork(server, worker):
+    # 🔁 pas de socket Redis partagée avec le master
+    from keyspace import reset_clients
+    reset_clients()
@@ -0,0 +1,58 @@
+"""
+Historique des conversations : un stream Redis plafonné par numéro (hist:{number}),
+écrit dans le même pipeline / la même transaction que la transition d'état
+(aucun aller-retour en plus). Encodage compact : champs d'une lettre, vides omis ;
+l'horodatage est celui de l'ID du stream.
+
+    d : i (entrant) | o (sortant)     b : texte
+    v : device                        t : sms|mms (sortant)
+    s : step de la conversation       k : c (campagne) + lot
+"""
+import os
+
+from keyspace import history_key, redis_for_number
+
+HISTORY_ENABLED = os.getenv("HISTORY_ENABLED", "true").lower() == "true"
+HISTORY_MAXLEN = int(os.getenv("HISTORY_MAXLEN", "50"))           # événements gardés par numéro
+HISTORY_TTL = int(os.getenv("HISTORY_TTL", str(90 * 86400)))       # rétention après dernier événement
+HISTORY_BODY_MAX = int(os.getenv("HISTORY_BODY_MAX", "1000"))
+
+_NAMES = {"d": "direction", "b": "body", "v": "device", "t": "type", "s": "step", "k": "batch"}
+_DIRECTIONS = {"i": "in", "o": "out"}
+
+
+def append(pipe, number, direction, body, device=None, msg_type=None, step=None, batch=None):
+    """Ajoute un événement au pipeline fourni (direction : "in" | "out")."""
+    if not HISTORY_ENABLED:
+        return
+    fields = {"d": "i" if direction == "in" else "o", "b": str(body or "")[:HISTORY_BODY_MAX]}
+    if device:
+        fields["v"] = str(device)
+    if msg_type and msg_type != "sms":
+        fields["t"] = msg_type
+    if step is not None:
+        fields["s"] = step
+    if batch:
+        fields["k"] = str(batch)
+    key = history_key(number)
+    pipe.xadd(key, fields, maxlen=HISTORY_MAXLEN, approximate=True)
+    pipe.expire(key, HISTORY_TTL)
+
+
+def _decode(entry_id, fields):
+    entry_id = entry_id.decode("utf-8")
+    out = {"id": entry_id, "ts": int(entry_id.split("-", 1)[0]) / 1000.0}
+    for k, v in fields.items():
+        name = _NAMES.get(k.decode("utf-8"), k.decode("utf-8"))
+        out[name] = v.decode("utf-8", errors="ignore")
+    out["direction"] = _DIRECTIONS.get(out.get("direction"), out.get("direction"))
+    out.setdefault("type", "sms")
+    return out
+
+
+def read(number, limit=50, before=None):
+    """Événements du numéro, du plus récent au plus ancien ; before = id exclusif (pagination)."""
+    client = redis_for_number(number)
+    max_id = f"({before}" if before else "+"
+    entries = client.xrevrange(history_key(number), max=max_id, min="-", count=max(1, int(limit)))
+    return [_decode(entry_id, fields) for entry_id, fields in entries]
@@ -0,0 +1,196 @@
+"""
+Ingestion des messages entrants par Redis Streams (INGEST_MODE=stream), alternative
+légère à Celery : le webhook ajoute les messages à un ZSET d'échéances (délai aléatoire),
+ce consumer les promeut dans un stream, les lit par lots via un consumer group et
+groupe toutes les opérations Redis d'un lot en quelques pipelines.
+
+    INGEST_MODE=stream python ingest.py
+"""
+import os
+import json
+import time
+import socket
+
+from logger import log
+from keyspace import INGEST_STREAM, INGEST_DELAYED, main_redis, redis_for_number, transaction
+
+# celery (défaut) : une tâche process_message par message ; stream : ce consumer
+INGEST_MODE = os.getenv("INGEST_MODE", "celery").strip().lower()
+
+INGEST_GROUP = "replies"
+INGEST_BATCH = int(os.getenv("INGEST_BATCH", "100"))
+INGEST_BLOCK_MS = int(os.getenv("INGEST_BLOCK_MS", "1000"))
+INGEST_CLAIM_IDLE_MS = int(os.getenv("INGEST_CLAIM_IDLE_MS", "60000"))
+INGEST_MAXLEN = int(os.getenv("INGEST_MAXLEN", "1000000"))
+
+# promotion atomique des échéances dues -> stream (plusieurs consumers sans doublon)
+_PROMOTE_LUA = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, p in ipairs(due) do
+  redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[3], '*', 'p', p)
+  redis.call('ZREM', KEYS[1], p)
+end
+return #due
+"""
+
+
+def enqueue(redis_conn, messages):
+    """messages : [(msg dict, délai en secondes)] — un seul aller-retour."""
+    now = time.time()
+    pipe = redis_conn.pipeline(transaction=False)
+    for msg, delay in messages:
+        pipe.zadd(INGEST_DELAYED, {_payload(msg, 0): now + max(0, delay)})
+    pipe.execute()
+
+
+def _payload(msg, attempt):
+    return json.dumps({"m": msg, "a": attempt}, separators=(",", ":"), sort_keys=True)
+
+
+class IngestWorker:
+    def __init__(self, consumer=None):
+        self.redis = main_redis()
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.promote_script = self.redis.register_script(_PROMOTE_LUA)
+        self._last_claim = 0.0
+
+    def ensure_group(self):
+        try:
+            self.redis.xgroup_create(INGEST_STREAM, INGEST_GROUP, id="0", mkstream=True)
+        except Exception as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def promote(self):
+        return int(self.promote_script(keys=[INGEST_DELAYED, INGEST_STREAM],
+                                       args=[time.time(), INGEST_BATCH * 10, INGEST_MAXLEN]) or 0)
+
+    def requeue(self, payloads, delay):
+        if not payloads:
+            return
+        due = time.time() + delay
+        self.redis.zadd(INGEST_DELAYED, {_payload(m, a): due for m, a in payloads})
+
+    # -----------------------
+    # TRAITEMENT D'UN LOT
+    # -----------------------
+    def process_batch(self, entries):
+        from tasks import (
+            load_config, parse_message, record_received, record_replies, queue_state_reads,
+            handle_message, ReplyHeld, HOLD_RETRY_DELAY, _stat_incr,
+        )
+        import attribution
+
+        cfg = load_config()
+        items, later, seen = [], [], set()
+        for _entry_id, fields in entries:
+            try:
+                payload = json.loads(fields[b"p"])
+            except Exception as e:
+                log(f"❌ Ingestion : payload invalide : {e}")
+                continue
+            if not cfg.get("enabled", True):
+                continue
+            parsed = parse_message(payload.get("m") or {})
+            if not parsed:
+                continue
+            # même numéro deux fois dans le lot : l'état lu d'avance serait périmé -> lot suivant
+            if parsed[0] in seen:
+                later.append((payload.get("m"), int(payload.get("a") or 0)))
+                continue
+            seen.add(parsed[0])
+            items.append((parsed, int(payload.get("a") or 0)))
+
+        # 1) stats reçus (+ attribution campagne) + lectures d'état : un pipeline par client Redis
+        stats = self.redis.pipeline(transaction=False)
+        reads, lookups = {}, []
+        size = attribution.lookup_size()
+        for i, ((number, msg_id, device_id, _body), attempt) in enumerate(items):
+            if not attempt:
+                record_received(device_id, stats, number=number)
+                lookups.append((number, len(stats.command_stack) - size))
+            client = redis_for_number(number)
+            reads.setdefault(id(client), (client, client.pipeline(transaction=False), []))
+            _, pipe, idx = reads[id(client)]
+            queue_state_reads(pipe, number, msg_id)
+            idx.append(i)
+        res = stats.execute()
+        if size:
+            record_replies([(batch_id, number) for number, start in lookups
+                            for batch_id in [attribution.resolve(res[start:start + size])] if batch_id])
+
+        states = [None] * len(items)
+        for _client, pipe, idx in reads.values():
+            res = pipe.execute()
+            for n, i in enumerate(idx):
+                states[i] = res[n * 3:n * 3 + 3]
+
+        # 2) transitions : écritures d'état groupées par client, exécutées en fin de lot
+        writes = {}
+        held = []
+        for ((number, msg_id, device_id, body), attempt), state in zip(items, states):
+            client = redis_for_number(number)
+            if id(client) not in writes:
+                writes[id(client)] = transaction(client)
+            try:
+                handle_message(number, msg_id, device_id, cfg, attempt=attempt, state=state,
+                               pipe=writes[id(client)], body=body)
+            except ReplyHeld:
+                held.append(({"number": number, "ID": msg_id, "deviceID": device_id, "message": body}, attempt + 1))
+            except Exception as e:
+                log(f"💥 [{str(msg_id)[-5:]}] Erreur interne : {e}")
+                try:
+                    _stat_incr(device_id, "errors", 1)
+                except Exception:
+                    pass
+        for pipe in writes.values():
+            pipe.execute()
+
+        self.requeue(later, 0)
+        self.requeue(held, HOLD_RETRY_DELAY)
+
+        # 3) acquittement du lot
+        if entries:
+            ids = [entry_id for entry_id, _ in entries]
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.xack(INGEST_STREAM, INGEST_GROUP, *ids)
+            pipe.xdel(INGEST_STREAM, *ids)
+            pipe.execute()
+        return len(items)
+
+    # -----------------------
+    # BOUCLE
+    # -----------------------
+    def read(self):
+        now = time.time()
+        if now - self._last_claim >= INGEST_CLAIM_IDLE_MS / 1000.0 / 2:
+            self._last_claim = now
+            # entrées lues par un consumer mort avant acquittement
+            _, entries, *_ = self.redis.xautoclaim(INGEST_STREAM, INGEST_GROUP, self.consumer,
+                                                   min_idle_time=INGEST_CLAIM_IDLE_MS, start_id="0-0",
+                                                   count=INGEST_BATCH)
+            entries = [(i, f) for i, f in entries if f]
+            if entries:
+                log(f"♻️ Ingestion : {len(entries)} message(s) repris")
+                return entries
+        resp = self.redis.xreadgroup(INGEST_GROUP, self.consumer, {INGEST_STREAM: ">"},
+                                     count=INGEST_BATCH, block=INGEST_BLOCK_MS)
+        return [e for _stream, entries in resp or [] for e in entries]
+
+    def run(self):
+        self.ensure_group()
+        log(f"📥 Ingestion stream : consumer {self.consumer} démarré")
+        while True:
+            try:
+                self.promote()
+                entries = self.read()
+                if entries:
+                    n = self.process_batch(entries)
+                    log(f"📥 Lot traité : {n}/{len(entries)} message(s)")
+            except Exception as e:
+                log(f"💥 Ingestion : {e}")
+                time.sleep(1)
+
+
+if __name__ == "__main__":
+    IngestWorker().run()
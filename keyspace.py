@@ -0,0 +1,325 @@
+import os
+import zlib
+
+from redis_pool import create_client
+
+# -----------------------
+# LAYOUT DES CLÉS REDIS
+# -----------------------
+# legacy  : noms historiques (conv:{number}, processed:{number}, archived_numbers)
+# sharded : clés par numéro hash-taggées par bucket ({b}) → même slot sur Redis Cluster,
+#           et archived_numbers découpé en un set par bucket (plus de clé chaude globale)
+# Passage legacy -> sharded : workers arrêtés, `KEY_LAYOUT=sharded python migrate_keys.py`.
+# Tant que des clés legacy restent, l'accès aux clés par numéro est refusé (check_layout).
+KEY_LAYOUT = os.getenv("KEY_LAYOUT", "legacy").strip().lower()
+KEY_BUCKETS = max(1, int(os.getenv("KEY_BUCKETS", "64")))
+
+REDIS_URL = os.getenv("REDIS_URL")
+# Plusieurs instances Redis pour les clés par numéro (séparées par des virgules).
+# Vide => tout reste sur REDIS_URL (nœud désigné).
+REDIS_SHARD_URLS = [u.strip() for u in os.getenv("REDIS_SHARD_URLS", "").split(",") if u.strip()]
+REDIS_CLUSTER = os.getenv("REDIS_CLUSTER", "false").lower() == "true"
+
+# Clés du nœud désigné (config + numlist)
+CONFIG_KEY = "config:autoreply"
+
+NL_META_KEY = "nl:meta"              # json meta
+NL_POOL_LIST = "nl:pool"             # legacy : LIST of JSON records (migrée vers le store ci-dessous)
+# Pool indexé (nl_pool.py) : même hash tag -> réservation atomique (Lua) aussi en cluster
+NL_POOL_IDS = "nl:{pool}:ids"        # ZSET id -> id (ordre d'import, restants)
+NL_POOL_RECORDS = "nl:{pool}:rec"    # HASH id -> JSON record
+NL_POOL_SEQ = "nl:{pool}:seq"        # compteur d'ids
+NL_POOL_COLS = "nl:{pool}:cols"      # SET colonnes indexées
+NL_POOL_VALS_PREFIX = "nl:{pool}:vals:"  # +col -> HASH valeur normalisée -> valeur affichée
+NL_POOL_IDX_PREFIX = "nl:{pool}:idx:"    # +col:valeur -> SET ids (index secondaire)
+NL_POOL_TMP_PREFIX = "nl:{pool}:tmp:"    # +uuid -> ZSET intersection temporaire
+NL_ARCHIVE_LIST = "nl:archive"       # optional: consumed history
+NL_MESSAGE_KEY = "nl:message"        # message template (UI)
+NL_TYPE_KEY = "nl:type"              # sms|mms (UI)
+
+BATCH_INDEX = "nl:batch:index"       # incr counter
+BATCH_ZINDEX = "nl:batch:zindex"     # ZSET batch_id -> created_at
+BATCH_META_PREFIX = "nl:batch:meta:" # +id -> json
+BATCH_ITEMS_PREFIX = "nl:batch:items:"  # +id -> LIST of JSON records
+BATCH_POS_PREFIX = "nl:batch:pos:"   # +id -> HASH number -> position in items
+
+BATCH_PROGRESS_PREFIX = "nl:batch:progress:"  # +id -> HASH total/sent/errors (campagne)
+BATCH_DEVICE_PREFIX = "nl:batch:dev:"         # +id:device -> LIST positions restant à envoyer
+BATCH_DISPATCHED_PREFIX = "nl:batch:dispatched:"  # +id -> timestamp du lancement (SET NX : une seule fois)
+ALLOC_BACKLOG_PREFIX = "alloc:backlog:"       # +device -> envois alloués non encore faits
+BATCH_REPLIES_PREFIX = "nl:batch:replies:"    # +id -> HASH replies/last_at (réponses attribuées)
+BATCH_REPLIERS_PREFIX = "nl:batch:repliers:"  # +id -> HyperLogLog des numéros ayant répondu
+ATTR_PREFIX = "attr:"                         # +génération:bucket -> HASH number -> batch_id
+
+NL_UPLOAD_PREFIX = "nl:upload:"      # +import_id -> HASH fichiers en attente (TTL)
+NL_IMPORT_PREFIX = "nl:import:"      # +import_id -> HASH statut d'import (TTL)
+
+COLD_INDEX = "nl:cold:index"         # HASH batch_id -> json (fichier gzip, date, count)
+COLD_LOCK = "nl:cold:lock"           # verrou compaction
+
+TASK_STATUS_PREFIX = "task:status:"  # +nom[:id] -> HASH état de la dernière exécution (TTL)
+
+DELIVERY_REF_PREFIX = "dlv:ref:"     # +id message gateway -> HASH d(evice)/b(atch)/s(tatut) (TTL)
+
+LAYOUT_KEY = "keyspace:layout"       # "sharded" une fois les clés legacy migrées (migrate_keys.py)
+LEGACY_ARCHIVED_KEY = "archived_numbers"
+
+# Devices (device_health.py, allocation.py)
+HEALTH_PREFIX = "health:device:"           # +id -> HASH state/failures/opened_at/last_error
+HEALTH_PROBE_PREFIX = "health:probe:"      # +id -> verrou de sonde half_open
+HEALTH_DEVICES_KEY = "health:devices"      # JSON liste get-devices.php (cache)
+ALLOC_RUN_PREFIX = "alloc:run:"            # +batch:device -> chaîne send_device_chunk en cours
+
+# Outbox (outbox.py) : streams par numéro -> outbox_key() ; le reste sur le nœud désigné
+OUTBOX_STREAM = "outbox:sends"             # stream unique (layout legacy)
+OUTBOX_DEAD = "outbox:dead"                # envois abandonnés
+OUTBOX_DONE_PREFIX = "outbox:done:"        # +idem -> déjà livré
+OUTBOX_LOCK_PREFIX = "outbox:lock:"        # +idem -> livraison en cours
+
+DASH_CHANNEL = "dash:events"               # pub/sub tableau de bord (dashboard.py)
+TRACE_STREAM = os.getenv("TRACE_STREAM", "trace:slow")  # spans lents (tracing.py)
+
+# Planification (scheduler.py)
+SCHED_DUE = "sched:due"              # ZSET job -> échéance (timestamp)
+SCHED_WAKE = "sched:wake"            # LIST réveil du scheduler (job plus proche ajouté)
+SCHED_DAILY_PREFIX = "sched:daily:"  # +device:AAAAMMJJ -> envois campagne du jour (TTL)
+
+# Ingestion par stream (INGEST_MODE=stream) : même hash tag -> même slot en cluster
+INGEST_STREAM = "ingest:{inbound}:stream"    # STREAM messages entrants prêts
+INGEST_DELAYED = "ingest:{inbound}:delayed"  # ZSET payload -> échéance (délai aléatoire)
+
+
+def is_sharded():
+    return KEY_LAYOUT == "sharded"
+
+
+def number_bucket(number) -> int:
+    return zlib.crc32(str(number).encode("utf-8")) % KEY_BUCKETS
+
+
+def number_tag(number) -> str:
+    return "{%d}" % number_bucket(number)
+
+
+# -----------------------
+# CLÉS PAR NUMÉRO (shardables)
+# -----------------------
+def conv_key(number):
+    if is_sharded():
+        return f"conv:{number_tag(number)}:{number}"
+    return f"conv:{number}"
+
+
+def processed_key(number):
+    if is_sharded():
+        return f"processed:{number_tag(number)}:{number}"
+    return f"processed:{number}"
+
+
+def history_key(number):
+    # même bucket que conv -> écrit dans la transaction de la transition
+    if is_sharded():
+        return f"hist:{number_tag(number)}:{number}"
+    return f"hist:{number}"
+
+
+def archived_key(number):
+    if is_sharded():
+        return f"{LEGACY_ARCHIVED_KEY}:{number_tag(number)}"
+    return LEGACY_ARCHIVED_KEY
+
+
+def outbox_key(number):
+    # même bucket que conv/processed -> écrit dans la même transaction
+    if is_sharded():
+        return f"outbox:{number_tag(number)}"
+    return OUTBOX_STREAM
+
+
+def outbox_keys():
+    """Tous les streams outbox : [(client, key)]."""
+    if is_sharded():
+        return [(redis_for_bucket(b), "outbox:{%d}" % b) for b in range(KEY_BUCKETS)]
+    return [(redis_for_bucket(0), OUTBOX_STREAM)]
+
+
+def conv_key_pattern():
+    return "conv:{*}:*" if is_sharded() else "conv:*"
+
+
+# -----------------------
+# CLÉS DEVICE (nœud désigné)
+# -----------------------
+def device_stat_key(device_id, field):
+    return f"stats:device:{device_id}:{field}"
+
+
+def device_cycle_key(device_id, field):
+    return f"cycle:device:{device_id}:{field}"
+
+
+def batch_device_key(batch_id, device_id):
+    return f"{BATCH_DEVICE_PREFIX}{batch_id}:{device_id}"
+
+
+# -----------------------
+# CLIENTS (un jeu par process : recréés après fork)
+# -----------------------
+_clients = {}
+_clients_pid = None
+
+
+def _client(url):
+    global _clients_pid
+    if _clients_pid != os.getpid():
+        _clients.clear()
+        _clients_pid = os.getpid()
+
+    client = _clients.get(url)
+    if client is None:
+        client = create_client(url, cluster=REDIS_CLUSTER)
+        _clients[url] = client
+    return client
+
+
+def reset_clients():
+    """
+    Après fork (gunicorn post_fork, Celery worker_process_init) : on oublie les
+    clients hérités du parent sans fermer leurs sockets (elles appartiennent au parent).
+    """
+    global _clients_pid
+    _clients.clear()
+    _clients_pid = os.getpid()
+
+
+def set_client(url, client):
+    """Injecte un client (bench : fakeredis) pour ce process."""
+    _client(url)
+    _clients[url] = client
+
+
+class LazyRedis:
+    """
+    Proxy module-level : le vrai client est résolu à l'usage, dans le process
+    courant (pas de socket créée à l'import ni partagée entre parent et enfants).
+    """
+
+    def __init__(self, resolve):
+        self._resolve = resolve
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+
+def main_redis():
+    """Nœud désigné : config, numlist, batchs, stats device."""
+    return _client(REDIS_URL)
+
+
+def lazy_main_redis():
+    return LazyRedis(main_redis)
+
+
+def redis_for_bucket(bucket):
+    if not REDIS_SHARD_URLS:
+        return main_redis()
+    return _client(REDIS_SHARD_URLS[bucket % len(REDIS_SHARD_URLS)])
+
+
+def redis_for_number(number):
+    """Client qui porte les clés conv/processed/archive de ce numéro."""
+    if not _layout_ok:
+        check_layout()
+    return redis_for_bucket(number_bucket(number))
+
+
+def transaction(client):
+    """MULTI/EXEC ; RedisCluster n'en a pas -> pipeline simple (clés du même slot)."""
+    return client.pipeline(transaction=not REDIS_CLUSTER)
+
+
+def get_many(client, keys):
+    """
+    GET de plusieurs clés en un aller-retour. Pipeline non transactionnel plutôt que
+    MGET : en cluster, MGET sur des slots différents est refusé (CROSSSLOT).
+    """
+    if not keys:
+        return []
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.get(key)
+    return pipe.execute()
+
+
+def number_shards():
+    """Tous les clients qui portent des clés par numéro (pour SCAN & co)."""
+    if not REDIS_SHARD_URLS:
+        return [main_redis()]
+    return [_client(url) for url in REDIS_SHARD_URLS]
+
+
+def scan_targets():
+    """(nom, client) à parcourir par SCAN : chaque shard, ou chaque primaire en cluster."""
+    targets = []
+    for i, client in enumerate(number_shards()):
+        if REDIS_CLUSTER:
+            for node in client.get_primaries():
+                targets.append((f"{i}:{node.name}", client.get_redis_connection(node)))
+        else:
+            targets.append((str(i), client))
+    return targets
+
+
+# -----------------------
+# GARDE DU LAYOUT (legacy -> sharded)
+# -----------------------
+LEGACY_NUMBER_PREFIXES = ("conv", "processed", "hist")
+LAYOUT_SAMPLE = 1000     # clés examinées par shard pour détecter des clés legacy
+
+_layout_ok = False
+
+
+def legacy_number(key, prefix):
+    """Numéro d'une clé legacy "<prefix>:<numéro>" ; None pour une clé sharded / autre."""
+    rest = key.decode("utf-8", errors="ignore")[len(prefix) + 1:]
+    if not rest or rest.startswith("{") or ":" in rest:
+        return None
+    return rest
+
+
+def legacy_keys_present():
+    """archived_numbers, ou conv:/processed:/hist:<numéro> dans un échantillon SCAN par shard."""
+    if any(client.exists(LEGACY_ARCHIVED_KEY) for client in number_shards()):
+        return True
+    for _, client in scan_targets():
+        for prefix in LEGACY_NUMBER_PREFIXES:
+            _, keys = client.scan(cursor=0, match=f"{prefix}:*", count=LAYOUT_SAMPLE)
+            if any(legacy_number(k, prefix) for k in keys):
+                return True
+    return False
+
+
+def check_layout():
+    """
+    KEY_LAYOUT=sharded : les clés legacy seraient ignorées (contacts relancés en
+    Step 1, numéros archivés recontactés). Refus tant qu'elles n'ont pas été migrées ;
+    une installation neuve est marquée sharded directement. Vérifié une fois par process.
+    """
+    global _layout_ok
+    if not is_sharded():
+        _layout_ok = True
+        return
+    main = main_redis()
+    if main.get(LAYOUT_KEY) != b"sharded":
+        if legacy_keys_present():
+            raise RuntimeError(
+                "KEY_LAYOUT=sharded : clés legacy présentes, lancer `KEY_LAYOUT=sharded python migrate_keys.py`"
+            )
+        main.set(LAYOUT_KEY, "sharded")
+    _layout_ok = True
+
+
+def mark_layout_ok():
+    """Migration en cours (migrate_keys.py) : accès aux clés sharded sans la garde."""
+    global _layout_ok
+    _layout_ok = True
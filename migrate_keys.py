@@ -0,0 +1,128 @@
+"""
+Migration des clés par numéro legacy -> sharded (KEY_LAYOUT, keyspace.py) :
+conv:<n>, processed:<n>, hist:<n> -> <prefix>:{bucket}:<n> (DUMP/RESTORE, TTL conservé)
+et archived_numbers -> archived_numbers:{bucket}. Reprenable : une clé sharded déjà
+présente (plus récente) est gardée, la legacy supprimée.
+
+Workers et web arrêtés, outbox vidée, puis :
+
+    KEY_LAYOUT=sharded python migrate_keys.py
+
+En fin de migration, keyspace:layout = sharded lève la garde (check_layout).
+"""
+import os
+import sys
+
+from redis.exceptions import ResponseError
+
+from logger import log
+from keyspace import (
+    LAYOUT_KEY,
+    LEGACY_ARCHIVED_KEY,
+    LEGACY_NUMBER_PREFIXES,
+    OUTBOX_STREAM,
+    archived_key,
+    conv_key,
+    history_key,
+    is_sharded,
+    legacy_number,
+    main_redis,
+    mark_layout_ok,
+    number_shards,
+    processed_key,
+    redis_for_number,
+    scan_targets,
+)
+
+MIGRATE_SCAN_COUNT = int(os.getenv("MIGRATE_SCAN_COUNT", "500"))
+
+_NEW_KEY = {"conv": conv_key, "processed": processed_key, "hist": history_key}
+
+
+def _move_keys(client, prefix, keys):
+    """Un lot de clés legacy d'un shard : DUMP+PTTL en un pipeline, RESTORE, DELETE."""
+    keys = [(k, legacy_number(k, prefix)) for k in keys]
+    keys = [(k, n) for k, n in keys if n]
+    if not keys:
+        return 0
+    pipe = client.pipeline(transaction=False)
+    for key, _ in keys:
+        pipe.dump(key)
+        pipe.pttl(key)
+    res = pipe.execute()
+
+    moved = 0
+    for i, (key, number) in enumerate(keys):
+        payload, pttl = res[i * 2], res[i * 2 + 1]
+        if payload is None:
+            continue
+        try:
+            redis_for_number(number).restore(_NEW_KEY[prefix](number), max(0, pttl), payload)
+            moved += 1
+        except ResponseError as e:
+            # BUSYKEY : clé sharded déjà écrite -> elle fait foi
+            if "BUSYKEY" not in str(e):
+                raise
+    # une suppression par clé : en cluster, les clés d'un lot sont sur des slots différents
+    pipe = client.pipeline(transaction=False)
+    for key, _ in keys:
+        pipe.delete(key)
+    pipe.execute()
+    return moved
+
+
+def _move_archived(client):
+    """archived_numbers d'un shard -> un set par bucket (pipelines par client cible)."""
+    moved = 0
+    batch = []
+    for raw in client.sscan_iter(LEGACY_ARCHIVED_KEY, count=MIGRATE_SCAN_COUNT):
+        batch.append(raw.decode("utf-8"))
+        if len(batch) >= MIGRATE_SCAN_COUNT:
+            moved += _add_archived(batch)
+            batch = []
+    moved += _add_archived(batch)
+    client.delete(LEGACY_ARCHIVED_KEY)
+    return moved
+
+
+def _add_archived(numbers):
+    pipes = {}
+    for number in numbers:
+        target = redis_for_number(number)
+        pipe = pipes.get(id(target))
+        if pipe is None:
+            pipe = pipes[id(target)] = target.pipeline(transaction=False)
+        pipe.sadd(archived_key(number), number)
+    for pipe in pipes.values():
+        pipe.execute()
+    return len(numbers)
+
+
+def migrate():
+    if not is_sharded():
+        sys.exit("KEY_LAYOUT=sharded requis (clés cibles)")
+    pending = sum(int(c.xlen(OUTBOX_STREAM) or 0) for c in number_shards())
+    if pending:
+        sys.exit(f"{OUTBOX_STREAM} contient {pending} envoi(s) : les livrer en legacy avant de migrer")
+    mark_layout_ok()
+
+    result = {}
+    for name, client in scan_targets():
+        for prefix in LEGACY_NUMBER_PREFIXES:
+            batch = []
+            for key in client.scan_iter(match=f"{prefix}:*", count=MIGRATE_SCAN_COUNT):
+                batch.append(key)
+                if len(batch) >= MIGRATE_SCAN_COUNT:
+                    result[prefix] = result.get(prefix, 0) + _move_keys(client, prefix, batch)
+                    batch = []
+            result[prefix] = result.get(prefix, 0) + _move_keys(client, prefix, batch)
+        log(f"🔀 Migration shard {name} : {result}")
+    result["archived"] = sum(_move_archived(c) for c in number_shards())
+
+    main_redis().set(LAYOUT_KEY, "sharded")
+    log(f"✅ Migration legacy -> sharded terminée : {result}")
+    return result
+
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,198 @@
+import io
+import csv
+import json
+import time
+
+from keyspace import NL_META_KEY, main_redis
+from dashboard import publish_pool
+import nl_pool
+
+
+# -----------------------
+# PARSING
+# -----------------------
+def norm_col(name: str) -> str:
+    return (name or "").strip().lower()
+
+
+def pick_number_column(columns):
+    if not columns:
+        return None
+    candidates = {"number", "num", "phone", "telephone", "tel", "mobile", "msisdn", "numero", "numéro"}
+    for c in columns:
+        if norm_col(c) in candidates:
+            return c
+    return columns[0]
+
+
+def read_csv(file_bytes: bytes):
+    text = None
+    for enc in ("utf-8-sig", "utf-8", "latin-1"):
+        try:
+            text = file_bytes.decode(enc)
+            break
+        except Exception:
+            continue
+    if text is None:
+        raise Exception("Encodage CSV non supporté")
+
+    sample = text[:4096]
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=";,|\t,")
+        delimiter = dialect.delimiter
+    except Exception:
+        delimiter = ","
+
+    reader = csv.reader(io.StringIO(text), delimiter=delimiter)
+    rows = list(reader)
+    if not rows:
+        return [], []
+
+    header = rows[0]
+    data_rows = rows[1:] if any(h.strip() for h in header) else rows
+
+    if not any(h.strip() for h in header):
+        max_len = max(len(r) for r in rows)
+        header = [f"col{i+1}" for i in range(max_len)]
+        data_rows = rows
+
+    cleaned = []
+    for r in data_rows:
+        rr = list(r) + [""] * (len(header) - len(r))
+        cleaned.append(rr[:len(header)])
+
+    return header, cleaned
+
+
+def read_xlsx(file_bytes: bytes):
+    from openpyxl import load_workbook  # lourd : chargé seulement à l'import xlsx
+    wb = load_workbook(filename=io.BytesIO(file_bytes), read_only=True, data_only=True)
+    ws = wb.active
+    rows = []
+    for row in ws.iter_rows(values_only=True):
+        rows.append([("" if v is None else str(v)) for v in row])
+
+    if not rows:
+        return [], []
+
+    header = rows[0]
+    data_rows = rows[1:]
+
+    if not any(str(h).strip() for h in header):
+        max_len = max(len(r) for r in rows)
+        header = [f"col{i+1}" for i in range(max_len)]
+        data_rows = rows
+
+    header = [str(h).strip() if str(h).strip() else f"col{i+1}" for i, h in enumerate(header)]
+
+    cleaned = []
+    for r in data_rows:
+        rr = list(r) + [""] * (len(header) - len(r))
+        cleaned.append(rr[:len(header)])
+
+    return header, cleaned
+
+
+def dedupe_header(header):
+    seen = {}
+    final_header = []
+    for h in header:
+        base = (h or "").strip() or "col"
+        if base in seen:
+            seen[base] += 1
+            base = f"{base}_{seen[base]}"
+        else:
+            seen[base] = 1
+        final_header.append(base)
+    return final_header
+
+
+def build_records(header, rows, number_col):
+    idx = header.index(number_col)
+    records = []
+    for r in rows:
+        if idx >= len(r):
+            continue
+        number = str(r[idx]).strip()
+        if not number:
+            continue
+        rec = {}
+        for i, col in enumerate(header):
+            rec[col] = str(r[i]).strip() if i < len(r) else ""
+        records.append(rec)
+    return records
+
+
+def push_records(records, redis_conn=None, number_col=None):
+    # push into pool (remaining) WITHOUT clearing existing ; index par valeur de colonne
+    r = redis_conn or main_redis()
+    indexed = nl_pool.add_records(r, records, number_col)
+    publish_pool(r)
+    return indexed
+
+
+# -----------------------
+# IMPORT (web ou tâche imports)
+# -----------------------
+def import_files(files, redis_conn=None):
+    """
+    files : liste de (filename, bytes). Ajoute les records au pool et met à jour nl:meta.
+    Retourne (meta, nb_records) ; ValueError si rien d'importable.
+    """
+    r = redis_conn or main_redis()
+    all_records = []
+    all_columns = None
+    number_col_global = None
+
+    for filename, file_bytes in files:
+        filename = (filename or "").lower().strip()
+        if not file_bytes:
+            continue
+
+        if filename.endswith(".csv"):
+            header, rows = read_csv(file_bytes)
+        elif filename.endswith(".xlsx"):
+            header, rows = read_xlsx(file_bytes)
+        else:
+            continue
+
+        header = dedupe_header(header)
+        number_col = pick_number_column(header)
+        if not number_col:
+            continue
+
+        records = build_records(header, rows, number_col)
+
+        if all_columns is None:
+            all_columns = header
+            number_col_global = number_col
+        else:
+            for c in header:
+                if c not in all_columns:
+                    all_columns.append(c)
+
+        # normalise records sur all_columns
+        for rec in records:
+            for c in all_columns:
+                rec.setdefault(c, "")
+            all_records.append(rec)
+
+    if not all_records or not all_columns:
+        raise ValueError("Aucun numéro importé")
+
+    if number_col_global not in all_columns:
+        number_col_global = pick_number_column(all_columns)
+
+    # push into pool (remaining) WITHOUT clearing existing (tu peux importer plusieurs fois)
+    indexed = push_records(all_records, r, number_col_global)
+
+    variables = [c for c in all_columns if c != number_col_global]
+    meta = {
+        "columns": all_columns,
+        "number_col": number_col_global,
+        "variables": variables,
+        "indexed": indexed,
+        "updated_at": int(time.time()),
+    }
+    r.set(NL_META_KEY, json.dumps(meta, ensure_ascii=False))
+    return meta, len(all_records)
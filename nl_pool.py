@@ -0,0 +1,244 @@
+"""
+Pool de numéros indexé : records stockés par id (HASH), ordre d'import dans un ZSET,
+et un index secondaire par valeur de colonne (SET d'ids) construit à l'import.
+
+Réserver un segment (ex. city=Paris + segment=VIP) = ZINTERSTORE du pool avec les
+index concernés puis ZRANGE, dans un script Lua (atomique, pas de double réservation).
+Les ids consommés sont retirés des index après coup : le pool filtre de toute façon.
+"""
+import os
+import json
+import uuid
+
+from keyspace import (
+    NL_POOL_LIST, NL_POOL_IDS, NL_POOL_RECORDS, NL_POOL_SEQ, NL_POOL_COLS,
+    NL_POOL_VALS_PREFIX, NL_POOL_IDX_PREFIX, NL_POOL_TMP_PREFIX,
+)
+
+# colonnes indexées : liste explicite, sinon toutes celles à faible cardinalité
+NL_INDEX_COLUMNS = [c.strip().lower() for c in os.getenv("NL_INDEX_COLUMNS", "").split(",") if c.strip()]
+NL_INDEX_MAX_VALUES = int(os.getenv("NL_INDEX_MAX_VALUES", "200"))
+# auto-index seulement sur un import assez grand pour juger, et si les valeurs se
+# répètent (distinctes / lignes) : sinon nom, email... = un SET par ligne
+NL_INDEX_MIN_ROWS = int(os.getenv("NL_INDEX_MIN_ROWS", "500"))
+NL_INDEX_MAX_RATIO = float(os.getenv("NL_INDEX_MAX_RATIO", "0.05"))
+NL_POOL_CHUNK = 1000
+
+# KEYS : ids, records, tmp, index... ; ARGV : count, mode (take|count)
+# take -> [id1, rec1, id2, rec2, ...]
+_RESERVE_LUA = """
+local src = KEYS[1]
+if #KEYS > 3 then
+  local args = {KEYS[3], #KEYS - 2, KEYS[1]}
+  for i = 4, #KEYS do args[#args + 1] = KEYS[i] end
+  args[#args + 1] = 'WEIGHTS'
+  args[#args + 1] = 1
+  for i = 4, #KEYS do args[#args + 1] = 0 end
+  redis.call('ZINTERSTORE', unpack(args))
+  src = KEYS[3]
+end
+if ARGV[2] == 'count' then
+  local n = redis.call('ZCARD', src)
+  if src ~= KEYS[1] then redis.call('DEL', src) end
+  return n
+end
+local ids = redis.call('ZRANGE', src, 0, tonumber(ARGV[1]) - 1)
+if src ~= KEYS[1] then redis.call('DEL', src) end
+local out = {}
+for i = 1, #ids, 500 do
+  local chunk = {unpack(ids, i, math.min(i + 499, #ids))}
+  redis.call('ZREM', KEYS[1], unpack(chunk))
+  local recs = redis.call('HMGET', KEYS[2], unpack(chunk))
+  redis.call('HDEL', KEYS[2], unpack(chunk))
+  for j = 1, #chunk do
+    if recs[j] then
+      out[#out + 1] = chunk[j]
+      out[#out + 1] = recs[j]
+    end
+  end
+end
+return out
+"""
+
+_scripts = {}
+
+
+def _norm(value) -> str:
+    return str(value or "").strip().lower()
+
+
+def _idx_key(col, value):
+    return f"{NL_POOL_IDX_PREFIX}{_norm(col)}:{_norm(value)}"
+
+
+def _reserve_script(redis_conn):
+    script = _scripts.get(id(redis_conn))
+    if script is None:
+        script = _scripts[id(redis_conn)] = redis_conn.register_script(_RESERVE_LUA)
+    return script
+
+
+def normalize_filters(filters):
+    """{col: valeur} -> {col normalisée: valeur normalisée}, vides retirés."""
+    return {_norm(c): _norm(v) for c, v in (filters or {}).items() if _norm(c) and _norm(v)}
+
+
+# -----------------------
+# ÉCRITURE (import)
+# -----------------------
+def _indexed_columns(records, number_col):
+    columns = [c for c in (records[0].keys() if records else []) if c != number_col]
+    if NL_INDEX_COLUMNS:
+        return [c for c in columns if _norm(c) in NL_INDEX_COLUMNS]
+    if len(records) < NL_INDEX_MIN_ROWS:
+        return []
+    limit = min(NL_INDEX_MAX_VALUES, int(len(records) * NL_INDEX_MAX_RATIO))
+    out = []
+    for c in columns:
+        values = set()
+        for rec in records:
+            v = _norm(rec.get(c))
+            if v:
+                values.add(v)
+                if len(values) > limit:
+                    break
+        if 0 < len(values) <= limit:
+            out.append(c)
+    return out
+
+
+def add_records(redis_conn, records, number_col=None):
+    """Ajoute les records au pool (ids consécutifs) + index secondaires. Retourne les colonnes indexées."""
+    if not records:
+        return []
+    indexed = _indexed_columns(records, number_col)
+    # colonnes déjà indexées par un import précédent : on reste cohérent
+    known = {c.decode("utf-8") for c in redis_conn.smembers(NL_POOL_COLS)}
+    indexed += [c for c in records[0] if c != number_col and c not in indexed and _norm(c) in known]
+    last = int(redis_conn.incrby(NL_POOL_SEQ, len(records)))
+    first = last - len(records) + 1
+    labels = {}
+    for i in range(0, len(records), NL_POOL_CHUNK):
+        pipe = redis_conn.pipeline(transaction=False)
+        for n, rec in enumerate(records[i:i + NL_POOL_CHUNK], start=first + i):
+            pipe.hset(NL_POOL_RECORDS, n, json.dumps(rec, ensure_ascii=False))
+            pipe.zadd(NL_POOL_IDS, {n: n})
+            for col in indexed:
+                value = str(rec.get(col) or "").strip()
+                if value:
+                    pipe.sadd(_idx_key(col, value), n)
+                    labels.setdefault(col, {}).setdefault(_norm(value), value)
+        pipe.execute()
+    if labels:
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.sadd(NL_POOL_COLS, *[_norm(c) for c in labels])
+        for col, values in labels.items():
+            pipe.hset(NL_POOL_VALS_PREFIX + _norm(col), mapping=values)
+        pipe.execute()
+    return indexed
+
+
+def migrate_legacy(redis_conn, number_col=None):
+    """Vide l'ancienne LIST nl:pool dans le store indexé (une fois, par paquets)."""
+    moved = 0
+    while True:
+        raws = redis_conn.lpop(NL_POOL_LIST, NL_POOL_CHUNK)
+        if not raws:
+            return moved
+        records = []
+        for raw in raws:
+            try:
+                records.append(json.loads(raw.decode("utf-8")))
+            except Exception:
+                continue
+        add_records(redis_conn, records, number_col)
+        moved += len(records)
+
+
+def ensure_migrated(redis_conn, number_col=None):
+    """Pool encore (en partie) en LIST legacy : migré avant tout comptage filtré / réservation."""
+    if redis_conn.exists(NL_POOL_LIST):
+        return migrate_legacy(redis_conn, number_col)
+    return 0
+
+
+# -----------------------
+# LECTURE / RÉSERVATION
+# -----------------------
+def _run(redis_conn, count, filters, mode):
+    filters = normalize_filters(filters)
+    keys = [NL_POOL_IDS, NL_POOL_RECORDS, NL_POOL_TMP_PREFIX + uuid.uuid4().hex]
+    keys += [_idx_key(c, v) for c, v in sorted(filters.items())]
+    return _reserve_script(redis_conn)(keys=keys, args=[int(count), mode])
+
+
+def remaining(redis_conn):
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.zcard(NL_POOL_IDS)
+    pipe.llen(NL_POOL_LIST)
+    return sum(int(n or 0) for n in pipe.execute())
+
+
+def count(redis_conn, filters=None, number_col=None):
+    if not normalize_filters(filters):
+        return remaining(redis_conn)
+    # les records legacy ne sont pas indexés : un segment les ignorerait
+    ensure_migrated(redis_conn, number_col)
+    return int(_run(redis_conn, 0, filters, "count") or 0)
+
+
+def reserve(redis_conn, count, filters=None, number_col=None):
+    """Retire jusqu'à 'count' records (ordre d'import) correspondant aux filtres."""
+    if count <= 0:
+        return []
+    ensure_migrated(redis_conn, number_col)
+    res = _run(redis_conn, count, filters, "take") or []
+    taken = []
+    for i in range(0, len(res) - 1, 2):
+        try:
+            taken.append((res[i].decode("utf-8"), json.loads(res[i + 1].decode("utf-8"))))
+        except Exception:
+            continue
+    _unindex(redis_conn, taken)
+    return [rec for _id, rec in taken]
+
+
+def _unindex(redis_conn, taken):
+    # ménage des index hors script (le ZSET du pool fait foi pour la réservation)
+    if not taken:
+        return
+    cols = {c.decode("utf-8") for c in redis_conn.smembers(NL_POOL_COLS)}
+    if not cols:
+        return
+    for i in range(0, len(taken), NL_POOL_CHUNK):
+        pipe = redis_conn.pipeline(transaction=False)
+        for rec_id, rec in taken[i:i + NL_POOL_CHUNK]:
+            for col, value in rec.items():
+                if _norm(col) in cols and _norm(value):
+                    pipe.srem(_idx_key(col, value), rec_id)
+        pipe.execute()
+
+
+def segments(redis_conn):
+    """{colonne: {valeur normalisée: valeur affichée}} des colonnes indexées."""
+    cols = sorted(c.decode("utf-8") for c in redis_conn.smembers(NL_POOL_COLS))
+    pipe = redis_conn.pipeline(transaction=False)
+    for col in cols:
+        pipe.hgetall(NL_POOL_VALS_PREFIX + col)
+    out = {}
+    for col, raw in zip(cols, pipe.execute()):
+        out[col] = dict(sorted((k.decode("utf-8"), v.decode("utf-8", errors="ignore")) for k, v in raw.items()))
+    return out
+
+
+def clear(redis_conn):
+    """Vide le pool (store, index, ancienne LIST) ; le compteur d'ids est conservé."""
+    cols = [c.decode("utf-8") for c in redis_conn.smembers(NL_POOL_COLS)]
+    keys = [NL_POOL_IDS, NL_POOL_RECORDS, NL_POOL_LIST, NL_POOL_COLS]
+    for col in cols:
+        keys.append(NL_POOL_VALS_PREFIX + col)
+        keys += [_idx_key(col, v.decode("utf-8")) for v in redis_conn.hkeys(NL_POOL_VALS_PREFIX + col)]
+    pipe = redis_conn.pipeline(transaction=False)
+    for key in keys:
+        pipe.delete(key)
+    pipe.execute()
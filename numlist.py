@@ -0,0 +1,59 @@
+import re
+import json
+
+from keyspace import BATCH_ITEMS_PREFIX, BATCH_META_PREFIX, main_redis
+
+# {{variable}} dans le message (insérées depuis l'UI)
+_VAR_RE = re.compile(r"\{\{\s*([^{}]+?)\s*\}\}")
+
+
+def render_message(template: str, rec: dict) -> str:
+    if not template:
+        return ""
+    return _VAR_RE.sub(lambda m: str(rec.get(m.group(1).strip(), "") or ""), template)
+
+
+def iter_batch_items(batch_id, chunk=1000, start=0, redis_conn=None):
+    """
+    Parcourt nl:batch:items:<id> par tranches LRANGE (mémoire constante).
+    """
+    r = redis_conn or main_redis()
+    key = BATCH_ITEMS_PREFIX + str(batch_id)
+    pos = max(0, int(start or 0))
+    while True:
+        raws = r.lrange(key, pos, pos + chunk - 1)
+        if not raws:
+            return
+        for raw in raws:
+            try:
+                yield json.loads(raw.decode("utf-8"))
+            except Exception:
+                continue
+        if len(raws) < chunk:
+            return
+        pos += len(raws)
+
+
+def batch_columns(batch_meta, nl_meta=None, first_rec=None):
+    """Ordre des colonnes : celui du lot, sinon nl:meta, sinon le premier record."""
+    for source in (batch_meta or {}, nl_meta or {}):
+        cols = source.get("columns")
+        if cols:
+            return list(cols)
+    return list((first_rec or {}).keys())
+
+
+def load_batch_meta(batch_id, redis_conn=None):
+    r = redis_conn or main_redis()
+    raw = r.get(BATCH_META_PREFIX + str(batch_id))
+    if not raw:
+        return None
+    try:
+        return json.loads(raw.decode("utf-8"))
+    except Exception:
+        return None
+
+
+def save_batch_meta(meta: dict, redis_conn=None):
+    r = redis_conn or main_redis()
+    r.set(BATCH_META_PREFIX + str(meta["batch_id"]), json.dumps(meta, ensure_ascii=False))
@@ -0,0 +1,236 @@
+"""
+Outbox de livraison : les transitions de process_message écrivent l'envoi à faire
+dans un stream Redis (même transaction que l'état), ce consumer livre au gateway,
+acquitte et retente. Livraison au moins une fois, dédoublonnée par clé d'idempotence.
+
+    DELIVERY_MODE=outbox python outbox.py
+"""
+import os
+import time
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+from logger import log
+from dashboard import publish_device
+import delivery
+from keyspace import (
+    OUTBOX_DEAD,
+    OUTBOX_DONE_PREFIX,
+    OUTBOX_LOCK_PREFIX,
+    REDIS_CLUSTER,
+    outbox_keys,
+    outbox_key,
+    main_redis,
+    device_stat_key,
+    device_cycle_key,
+)
+
+# direct (défaut) : envoi dans la tâche ; outbox : envoi par ce consumer
+DELIVERY_MODE = os.getenv("DELIVERY_MODE", "direct").strip().lower()
+
+OUTBOX_GROUP = "delivery"
+OUTBOX_DONE_TTL = int(os.getenv("OUTBOX_DONE_TTL", str(7 * 86400)))
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "50"))
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "16"))
+OUTBOX_RETRY_IDLE_MS = int(os.getenv("OUTBOX_RETRY_IDLE_MS", "60000"))
+OUTBOX_MAX_DELIVERIES = int(os.getenv("OUTBOX_MAX_DELIVERIES", "10"))
+OUTBOX_BLOCK_MS = int(os.getenv("OUTBOX_BLOCK_MS", "2000"))
+# entrées reprises par passage (pages XAUTOCLAIM) ; le curseur reprend au passage suivant
+OUTBOX_CLAIM_MAX = int(os.getenv("OUTBOX_CLAIM_MAX", str(OUTBOX_BATCH * 20)))
+
+
+def enqueue(pipe, number, message, device, msg_type, idem, prioritize=1):
+    """À appeler dans la transaction qui écrit l'état de la conversation."""
+    pipe.xadd(outbox_key(number), {
+        "idem": idem,
+        "number": number,
+        "message": message,
+        "device": str(device),
+        "type": msg_type,
+        "prioritize": prioritize,
+        "created": int(time.time()),
+    })
+
+
+def _decode(fields):
+    return {k.decode("utf-8"): v.decode("utf-8", errors="ignore") for k, v in fields.items()}
+
+
+def _next_id(entry_id):
+    """ID de stream suivant (borne basse exclusive pour paginer XPENDING)."""
+    ms, _, seq = (entry_id.decode("utf-8") if isinstance(entry_id, bytes) else str(entry_id)).partition("-")
+    return f"{ms}-{int(seq or 0) + 1}"
+
+
+class DeliveryWorker:
+    def __init__(self, consumer=None, concurrency=OUTBOX_CONCURRENCY):
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.pool = ThreadPoolExecutor(max_workers=max(1, concurrency))
+        self.streams = outbox_keys()
+        self._last_claim = 0.0
+        self._claim_cursor = {}
+
+    def ensure_groups(self):
+        for client, key in self.streams:
+            try:
+                client.xgroup_create(key, OUTBOX_GROUP, id="0", mkstream=True)
+            except Exception as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+    # -----------------------
+    # LIVRAISON D'UNE ENTRÉE
+    # -----------------------
+    def deliver(self, client, key, entry_id, fields, deliveries=1):
+        from gateway import post_gateway, send_url, send_payload
+        from device_health import is_available
+
+        main = main_redis()
+        entry = _decode(fields)
+        idem = entry.get("idem") or entry_id.decode("utf-8")
+
+        if main.exists(OUTBOX_DONE_PREFIX + idem):
+            self._ack(client, key, entry_id)
+            return "dup"
+
+        if deliveries > OUTBOX_MAX_DELIVERIES:
+            main.xadd(OUTBOX_DEAD, dict(entry, stream=key, entry=entry_id.decode("utf-8")), maxlen=10000, approximate=True)
+            self._ack(client, key, entry_id)
+            log(f"☠️ Outbox {idem} abandonné après {deliveries - 1} tentatives")
+            return "dead"
+
+        # verrou d'abord : une entrée "busy" ne consomme pas la sonde half_open du device
+        if not main.set(OUTBOX_LOCK_PREFIX + idem, self.consumer, nx=True, ex=max(1, OUTBOX_RETRY_IDLE_MS // 1000)):
+            self._uncount(client, key, entry_id, deliveries)
+            return "busy"
+
+        device = entry.get("device")
+        if device and not is_available(device):
+            # retenue jusqu'au retour du device : pas une tentative de livraison
+            main.delete(OUTBOX_LOCK_PREFIX + idem)
+            self._uncount(client, key, entry_id, deliveries)
+            return "held"
+
+        ok, data = post_gateway(send_url(), send_payload(
+            entry.get("number"), entry.get("message"), device, entry.get("type") or "sms",
+            int(entry.get("prioritize") or 1),
+        ))
+        if not ok:
+            main.delete(OUTBOX_LOCK_PREFIX + idem)
+            return "failed"
+        delivery.track(data, device)
+
+        pipe = main.pipeline()
+        pipe.set(OUTBOX_DONE_PREFIX + idem, 1, ex=OUTBOX_DONE_TTL)
+        pipe.delete(OUTBOX_LOCK_PREFIX + idem)
+        pipe.incrby(device_stat_key(device, "sent"), 1)
+        pipe.incrby(device_cycle_key(device, "sent"), 1)
+        publish_device(pipe, device, "sent")
+        pipe.execute()
+        self._ack(client, key, entry_id)
+        return "sent"
+
+    def _uncount(self, client, key, entry_id, deliveries):
+        """
+        Remet le compteur de livraisons de l'entrée à sa valeur d'avant ce passage
+        (XCLAIM RETRYCOUNT) : retenir / laisser à un autre consumer ne rapproche pas
+        du dead letter. L'entrée reste en attente, reprise par XAUTOCLAIM.
+        """
+        client.xclaim(key, OUTBOX_GROUP, self.consumer, 0, [entry_id],
+                      retrycount=max(0, deliveries - 1), justid=True)
+
+    def _ack(self, client, key, entry_id):
+        pipe = client.pipeline()
+        pipe.xack(key, OUTBOX_GROUP, entry_id)
+        pipe.xdel(key, entry_id)
+        pipe.execute()
+
+    # -----------------------
+    # BOUCLE
+    # -----------------------
+    def _read_new(self):
+        """Nouvelles entrées, groupées par client (un appel bloquant par client hors cluster)."""
+        out = []
+        by_client = {}
+        for client, key in self.streams:
+            # en cluster les streams n'ont pas de slot commun : une lecture par stream
+            group = key if REDIS_CLUSTER else id(client)
+            by_client.setdefault(group, (client, []))[1].append(key)
+        block = max(1, OUTBOX_BLOCK_MS // max(1, len(by_client)))
+        for client, keys in by_client.values():
+            resp = client.xreadgroup(OUTBOX_GROUP, self.consumer, {k: ">" for k in keys},
+                                     count=OUTBOX_BATCH, block=block)
+            for stream, entries in resp or []:
+                key = stream.decode("utf-8") if isinstance(stream, bytes) else stream
+                for entry_id, fields in entries:
+                    out.append((client, key, entry_id, fields, 1))
+        return out
+
+    def _claim_stale(self):
+        """
+        Entrées non acquittées depuis OUTBOX_RETRY_IDLE_MS : échec, crash, device retenu.
+        XAUTOCLAIM page par page avec son curseur, jusqu'au bout du PEL (ou OUTBOX_CLAIM_MAX :
+        le curseur est gardé et le passage suivant reprend là).
+        """
+        out = []
+        for client, key in self.streams:
+            cursor = self._claim_cursor.get(key, "0-0")
+            claimed = []
+            while len(claimed) < OUTBOX_CLAIM_MAX:
+                cursor, entries, *_ = client.xautoclaim(key, OUTBOX_GROUP, self.consumer,
+                                                        min_idle_time=OUTBOX_RETRY_IDLE_MS,
+                                                        start_id=cursor, count=OUTBOX_BATCH)
+                cursor = cursor.decode("utf-8") if isinstance(cursor, bytes) else str(cursor)
+                claimed += [(entry_id, fields) for entry_id, fields in entries if fields]
+                if cursor == "0-0":
+                    break
+            self._claim_cursor[key] = cursor
+            if not claimed:
+                continue
+            counts = self._delivery_counts(client, key, claimed[0][0], claimed[-1][0])
+            for entry_id, fields in claimed:
+                out.append((client, key, entry_id, fields, counts.get(entry_id, 1)))
+        return out
+
+    def _delivery_counts(self, client, key, first, last):
+        """times_delivered des entrées de ce consumer entre first et last (XPENDING paginé)."""
+        counts = {}
+        start = first
+        while True:
+            page = client.xpending_range(key, OUTBOX_GROUP, min=start, max=last,
+                                         count=OUTBOX_BATCH, consumername=self.consumer)
+            for p in page:
+                counts[p["message_id"]] = p["times_delivered"]
+            if len(page) < OUTBOX_BATCH:
+                return counts
+            start = _next_id(page[-1]["message_id"])
+
+
+    def run_once(self):
+        work = []
+        now = time.time()
+        if now - self._last_claim >= OUTBOX_RETRY_IDLE_MS / 1000.0 / 2:
+            self._last_claim = now
+            work.extend(self._claim_stale())
+        work.extend(self._read_new())
+
+        results = {}
+        for status in self.pool.map(lambda w: self.deliver(*w), work):
+            results[status] = results.get(status, 0) + 1
+        return results
+
+    def run(self):
+        self.ensure_groups()
+        log(f"📬 Outbox consumer {self.consumer} démarré ({len(self.streams)} stream(s))")
+        while True:
+            try:
+                results = self.run_once()
+                if results:
+                    log(f"📬 Outbox : {results}")
+            except Exception as e:
+                log(f"💥 Outbox consumer : {e}")
+                time.sleep(1)
+
+
+if __name__ == "__main__":
+    DeliveryWorker().run()
@@ -0,0 +1,45 @@
+import os
+
+# -----------------------
+# CONNEXIONS REDIS (un pool borné par process et par URL)
+# -----------------------
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "20"))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "10"))          # attente d'une connexion libre
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "5"))
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", "5"))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30"))
+# rediss:// : pas de vérif de certificat par défaut (Upstash), comme celery_worker
+REDIS_SSL_CERT_REQS = os.getenv("REDIS_SSL_CERT_REQS", "none")
+
+
+def redis_ssl_options(url):
+    if (url or "").startswith("rediss://"):
+        return {"ssl_cert_reqs": REDIS_SSL_CERT_REQS}
+    return {}
+
+
+def client_options(url):
+    opts = {
+        "socket_timeout": REDIS_SOCKET_TIMEOUT,
+        "socket_connect_timeout": REDIS_CONNECT_TIMEOUT,
+        "socket_keepalive": True,
+        "health_check_interval": REDIS_HEALTH_CHECK_INTERVAL,
+        "retry_on_timeout": True,
+    }
+    opts.update(redis_ssl_options(url))
+    return opts
+
+
+def create_client(url, cluster=False):
+    if cluster:
+        from redis.cluster import RedisCluster
+        return RedisCluster.from_url(url, max_connections=REDIS_MAX_CONNECTIONS, **client_options(url))
+
+    from redis import Redis, BlockingConnectionPool
+    pool = BlockingConnectionPool.from_url(
+        url,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+        **client_options(url),
+    )
+    return Redis(connection_pool=pool)
@@ -0,0 +1,261 @@
+"""
+Planification des envois : début / fin de campagne, plages horaires par fuseau,
+plafond quotidien par device, plages de réponse de l'auto-reply.
+
+Ordonnanceur central : un ZSET (membre = job, score = échéance). Le process dort
+jusqu'à la prochaine échéance (ou jusqu'à un réveil quand un job plus proche est
+ajouté) puis libère les jobs dus d'un coup : aucun polling job par job.
+
+    python scheduler.py
+
+Jobs : dispatch:<lot> | chunk:<lot>:<device> | reply:<message json>
+"""
+import os
+import time
+import datetime
+from zoneinfo import ZoneInfo
+
+from logger import log
+from keyspace import SCHED_DUE, SCHED_WAKE, SCHED_DAILY_PREFIX, main_redis
+from redis_pool import REDIS_SOCKET_TIMEOUT
+
+SCHED_TZ = os.getenv("SCHED_TZ", "Europe/Paris")
+DEVICE_DAILY_CAP = int(os.getenv("DEVICE_DAILY_CAP", "0"))          # 0 = illimité
+SCHED_BATCH = int(os.getenv("SCHED_BATCH", "500"))                   # jobs libérés par passe
+# sommeil max sans réveil : le BLPOP doit rendre la main avant le socket_timeout du client
+SCHED_MAX_SLEEP = min(float(os.getenv("SCHED_MAX_SLEEP", "60")), max(0.5, REDIS_SOCKET_TIMEOUT - 1))
+SCHED_RETRY = int(os.getenv("SCHED_RETRY", "30"))                    # job en échec -> replanifié
+
+# libération atomique des jobs dus (plusieurs schedulers sans doublon)
+_POP_DUE_LUA = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #due > 0 then redis.call('ZREM', KEYS[1], unpack(due)) end
+return due
+"""
+
+# réservation atomique sur le plafond du jour : ARGV cap, voulu, ttl -> nombre réservé
+_RESERVE_DAILY_LUA = """
+local used = tonumber(redis.call('GET', KEYS[1]) or '0')
+local n = math.min(tonumber(ARGV[2]), tonumber(ARGV[1]) - used)
+if n <= 0 then return 0 end
+redis.call('INCRBY', KEYS[1], n)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return n
+"""
+_scripts = {}
+
+
+# -----------------------
+# PLAGES HORAIRES
+# -----------------------
+def _tz(name):
+    try:
+        return ZoneInfo(name or SCHED_TZ)
+    except Exception:
+        return ZoneInfo(SCHED_TZ)
+
+
+def _minutes(hhmm):
+    h, _, m = str(hhmm).strip().partition(":")
+    return max(0, min(24 * 60, int(h) * 60 + int(m or 0)))
+
+
+def parse_windows(spec):
+    """"09:00-12:00,14:00-20:00" -> [(540, 720), (840, 1200)] ; plage de nuit découpée."""
+    out = []
+    for part in str(spec or "").split(","):
+        if "-" not in part:
+            continue
+        a, b = part.split("-", 1)
+        try:
+            start, end = _minutes(a), _minutes(b)
+        except ValueError:
+            continue
+        if start < end:
+            out.append((start, end))
+        elif start > end:
+            out += [(start, 24 * 60), (0, end)]
+    return sorted(out)
+
+
+def format_windows(spec):
+    """Plages normalisées ("9-12, 14:00-20" -> "09:00-12:00,14:00-20:00") ; "" si aucune."""
+    return ",".join(f"{a // 60:02d}:{a % 60:02d}-{b // 60:02d}:{b % 60:02d}" for a, b in parse_windows(spec))
+
+
+def next_allowed(ts, tz=None, windows=None):
+    """Premier instant >= ts dans une plage (ts lui-même si déjà dedans)."""
+    windows = parse_windows(windows) if isinstance(windows, str) else windows
+    if not windows:
+        return ts
+    zone = _tz(tz)
+    local = datetime.datetime.fromtimestamp(ts, zone)
+    for day in range(8):
+        date = (local + datetime.timedelta(days=day)).date()
+        midnight = datetime.datetime.combine(date, datetime.time(), zone)
+        for start, end in windows:
+            begin = (midnight + datetime.timedelta(minutes=start)).timestamp()
+            stop = (midnight + datetime.timedelta(minutes=end)).timestamp()
+            if ts < stop:
+                return max(ts, begin)
+    return ts
+
+
+def next_day(ts, tz=None):
+    zone = _tz(tz)
+    date = datetime.datetime.fromtimestamp(ts, zone).date() + datetime.timedelta(days=1)
+    return datetime.datetime.combine(date, datetime.time(), zone).timestamp()
+
+
+def parse_local(value, tz=None):
+    """Champ datetime-local ("2024-05-01T09:30") dans le fuseau -> timestamp ; None si vide."""
+    value = (value or "").strip()
+    if not value:
+        return None
+    try:
+        dt = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    return int(dt.replace(tzinfo=_tz(tz)).timestamp() if dt.tzinfo is None else dt.timestamp())
+
+
+def campaign_next(schedule, now=None):
+    """Instant d'envoi autorisé pour la campagne (now si tout de suite) ; None si terminée."""
+    now = now or time.time()
+    schedule = schedule or {}
+    due = max(now, float(schedule.get("start_at") or 0))
+    due = next_allowed(due, schedule.get("tz"), schedule.get("windows"))
+    end_at = schedule.get("end_at")
+    if end_at and due >= float(end_at):
+        return None
+    return due
+
+
+# -----------------------
+# PLAFOND QUOTIDIEN PAR DEVICE
+# -----------------------
+def _daily_key(device_id, tz=None, now=None):
+    day = datetime.datetime.fromtimestamp(now or time.time(), _tz(tz)).strftime("%Y%m%d")
+    return f"{SCHED_DAILY_PREFIX}{device_id}:{day}"
+
+
+def daily_cap(schedule):
+    return int((schedule or {}).get("daily_cap") or DEVICE_DAILY_CAP)
+
+
+def count_daily(redis_conn, device_id, n, tz=None, now=None):
+    if n <= 0:
+        return
+    key = _daily_key(device_id, tz, now)
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.incrby(key, n)
+    pipe.expire(key, 2 * 86400)
+    pipe.execute()
+
+
+def _reserve_daily(redis_conn, key, cap, want):
+    script = _scripts.get(id(redis_conn))
+    if script is None:
+        script = _scripts[id(redis_conn)] = redis_conn.register_script(_RESERVE_DAILY_LUA)
+    return int(script(keys=[key], args=[cap, want, 2 * 86400]) or 0)
+
+
+def campaign_slot(redis_conn, schedule, device_id, want, now=None):
+    """
+    (échéance, nombre autorisé) pour la prochaine tranche d'un device :
+    (now, n) -> envoyer n ; (plus tard, 0) -> se garer ; (None, 0) -> campagne terminée.
+    Avec plafond, les n envois sont réservés d'avance (chaînes concurrentes d'autres
+    lots sur le même device) : settle_daily() rend ensuite ce qui n'est pas parti.
+    """
+    now = now or time.time()
+    due = campaign_next(schedule, now)
+    if due is None or due > now:
+        return due, 0
+    cap = daily_cap(schedule)
+    if not cap:
+        return now, want
+    tz = (schedule or {}).get("tz")
+    n = _reserve_daily(redis_conn, _daily_key(device_id, tz, now), cap, want)
+    if n <= 0:
+        return campaign_next(schedule, next_day(now, tz)), 0
+    return now, n
+
+
+def settle_daily(redis_conn, schedule, device_id, reserved, sent, now):
+    """
+    Fin de tranche (now = instant de campaign_slot) : avec plafond, rend la part
+    réservée non envoyée ; sans plafond, compte les envois (plafonds d'autres lots).
+    """
+    tz = (schedule or {}).get("tz")
+    if not daily_cap(schedule):
+        count_daily(redis_conn, device_id, sent, tz, now)
+    elif reserved > sent:
+        redis_conn.decrby(_daily_key(device_id, tz, now), reserved - sent)
+
+
+# -----------------------
+# ORDONNANCEUR (ZSET d'échéances)
+# -----------------------
+def add_job(redis_conn, job, due):
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.zadd(SCHED_DUE, {job: float(due)})
+    pipe.lpush(SCHED_WAKE, 1)
+    pipe.ltrim(SCHED_WAKE, 0, 0)
+    pipe.execute()
+
+
+class Scheduler:
+    def __init__(self):
+        self.redis = main_redis()
+        self.pop_due = self.redis.register_script(_POP_DUE_LUA)
+
+    def fire(self, job):
+        import tasks
+        import allocation
+
+        kind, _, rest = job.partition(":")
+        if kind == "dispatch":
+            tasks.dispatch_batch.delay(rest)
+        elif kind == "chunk":
+            batch_id, _, device_id = rest.partition(":")
+            if allocation.start_chain(batch_id, device_id):
+                tasks.send_device_chunk.delay(batch_id, device_id)
+        elif kind == "reply":
+            tasks.process_message.delay(rest)
+        else:
+            log(f"⚠️ Scheduler : job inconnu {job[:60]}")
+
+    def release(self):
+        jobs = [j.decode("utf-8") for j in self.pop_due(keys=[SCHED_DUE], args=[time.time(), SCHED_BATCH]) or []]
+        for job in jobs:
+            try:
+                self.fire(job)
+            except Exception as e:
+                log(f"💥 Scheduler : {job[:60]} : {e}")
+                self.redis.zadd(SCHED_DUE, {job: time.time() + SCHED_RETRY})
+        return len(jobs)
+
+    def wait(self):
+        head = self.redis.zrange(SCHED_DUE, 0, 0, withscores=True)
+        delay = SCHED_MAX_SLEEP if not head else min(SCHED_MAX_SLEEP, head[0][1] - time.time())
+        if delay > 0.01:
+            # réveillé plus tôt si un job est ajouté (LPUSH sched:wake)
+            self.redis.blpop(SCHED_WAKE, timeout=delay)
+
+    def run(self):
+        log("⏰ Scheduler démarré")
+        while True:
+            try:
+                n = self.release()
+                if n:
+                    log(f"⏰ {n} job(s) libéré(s)")
+                    if n >= SCHED_BATCH:
+                        continue
+                self.wait()
+            except Exception as e:
+                log(f"💥 Scheduler : {e}")
+                time.sleep(1)
+
+
+if __name__ == "__main__":
+    Scheduler().run()
@@ -0,0 +1,392 @@
+// Panneau de contrôle : la page est servie tout de suite, chaque section
+// se charge en parallèle depuis /admin/api/* (une section lente ne bloque pas les autres).
+(function () {
+  "use strict";
+
+  const params = new URLSearchParams(window.location.search);
+  const PAGE_SIZE = 25;
+
+  function pct(rate) {
+    return (Math.round((rate || 0) * 1000) / 10) + " %";
+  }
+
+  function esc(value) {
+    return String(value === undefined || value === null ? "" : value)
+      .replace(/&/g, "&amp;").replace(/</g, "&lt;").replace(/>/g, "&gt;")
+      .replace(/"/g, "&quot;").replace(/'/g, "&#39;");
+  }
+
+  function qs(obj) {
+    const p = new URLSearchParams();
+    Object.keys(obj).forEach(function (k) {
+      if (obj[k] !== undefined && obj[k] !== null && obj[k] !== "") p.set(k, obj[k]);
+    });
+    return p.toString();
+  }
+
+  function getJSON(url) {
+    return fetch(url, { credentials: "same-origin", headers: { Accept: "application/json" } })
+      .then(function (r) {
+        if (r.status === 401) { window.location = "/admin/login"; throw new Error("401"); }
+        if (!r.ok) throw new Error(r.status + " " + r.statusText);
+        return r.json();
+      });
+  }
+
+  function fail(el, colspan) {
+    return function (err) {
+      const msg = "Erreur de chargement (" + esc(err.message) + ")";
+      el.innerHTML = colspan ? '<tr><td colspan="' + colspan + '" class="muted">' + msg + "</td></tr>"
+        : '<div class="muted">' + msg + "</div>";
+    };
+  }
+
+  // -----------------------
+  // APPAREILS
+  // -----------------------
+  function loadDevices() {
+    const body = document.getElementById("devices");
+    const chips = document.getElementById("send-devices");
+    return getJSON("/admin/api/devices").then(function (data) {
+      const rows = data.devices || [];
+      if (!rows.length) {
+        body.innerHTML = '<tr><td colspan="10" class="muted">Aucun device (vérifie SERVER/API_KEY).</td></tr>';
+        chips.innerHTML = '<span class="muted">Aucun device.</span>';
+        return;
+      }
+      body.innerHTML = rows.map(function (r) {
+        return '<tr data-device="' + esc(r.device_id) + '">' +
+          '<td><div class="pill"><span class="dot ' + esc(r.health) + '"></span><span style="font-weight:900">#' + esc(r.device_id) + "</span></div></td>" +
+          '<td><div style="font-weight:900">' + esc(r.name) + '</div><div class="muted">' + esc(r.model) + "</div></td>" +
+          '<td data-stat="received">' + esc(r.received) + "</td>" +
+          '<td data-stat="sent">' + esc(r.sent) + "</td>" +
+          '<td data-stat="errors">' + esc(r.errors) + "</td>" +
+          '<td data-stat="delivered">' + esc(r.delivered) + "</td>" +
+          '<td data-stat="failed">' + esc(r.failed) + "</td>" +
+          "<td>" + esc(r.cycle) + "</td>" +
+          "<td>" + esc(r.cycle_received) + "</td>" +
+          "<td>" + esc(r.cycle_sent) + "</td>" +
+          "</tr>";
+      }).join("");
+      chips.innerHTML = rows.map(function (r) {
+        return '<label class="chip"><input type="checkbox" name="device_ids" value="' + esc(r.device_id) + '">#' + esc(r.device_id) + "</label>";
+      }).join("");
+    }).catch(function (err) {
+      fail(body, 10)(err);
+      fail(chips)(err);
+    });
+  }
+
+  // -----------------------
+  // SEGMENTS (filtres du formulaire d'envoi)
+  // -----------------------
+  function segmentQuery() {
+    const q = {};
+    document.querySelectorAll("#segment-filters select").forEach(function (sel) {
+      if (sel.value) q[sel.name] = sel.value;
+    });
+    return q;
+  }
+
+  function countSegment() {
+    const label = document.getElementById("segment-count");
+    return getJSON("/admin/api/segments?" + qs(segmentQuery())).then(function (data) {
+      label.textContent = data.count + " numéro(s) restant(s)";
+    }).catch(function (err) {
+      label.textContent = "erreur (" + err.message + ")";
+    });
+  }
+
+  function loadSegments() {
+    const box = document.getElementById("send-segments");
+    const filters = document.getElementById("segment-filters");
+    return getJSON("/admin/api/segments").then(function (data) {
+      const cols = Object.keys(data.columns || {});
+      if (!cols.length) return;
+      filters.innerHTML = cols.map(function (col) {
+        const values = data.columns[col];
+        return '<div style="min-width:160px;max-width:240px;flex:1"><label>' + esc(col) + "</label>" +
+          '<select name="seg_' + esc(col) + '"><option value="">(tous)</option>' +
+          Object.keys(values).map(function (v) {
+            return '<option value="' + esc(v) + '">' + esc(values[v]) + "</option>";
+          }).join("") + "</select></div>";
+      }).join("");
+      filters.addEventListener("change", countSegment);
+      document.getElementById("segment-count").textContent = data.count + " numéro(s) restant(s)";
+      box.style.display = "";
+    }).catch(fail(filters));
+  }
+
+  // -----------------------
+  // LOT SÉLECTIONNÉ
+  // -----------------------
+  function renderBatch(card, data) {
+    const meta = data.meta;
+    const progress = data.progress || {};
+    const id = esc(meta.batch_id);
+    const query = data.query || "";
+    const numberCol = meta.number_col || data.number_col || "";
+    let html = '<div class="title">Lot #' + id + "</div>" +
+      '<div class="muted">Pris: <b>' + esc(meta.taken_total) + "</b> / demandé: " + esc(meta.requested_total) +
+      " • Restants: <b>" + esc(meta.remaining_after) + "</b></div>";
+    const sched = meta.schedule;
+    if (sched) {
+      const when = function (ts) { return ts ? new Date(ts * 1000).toLocaleString() : "—"; };
+      html += '<div class="muted" style="margin-top:6px">⏰ Début ' + when(sched.start_at) + " • fin " + when(sched.end_at) +
+        " • plages " + esc(sched.windows || "24h/24") + " (" + esc(sched.tz) + ")" +
+        (sched.daily_cap ? " • max " + esc(sched.daily_cap) + "/appareil/jour" : "") +
+        (meta.scheduled_at && !meta.dispatched_at ? " • <b>lancement planifié " + when(meta.scheduled_at) + "</b>" : "") + "</div>";
+    }
+    const filters = meta.filters || {};
+    if (Object.keys(filters).length) {
+      html += '<div class="muted" style="margin-top:6px">Segment : ' + Object.keys(filters).map(function (c) {
+        return esc(c) + " = <b>" + esc(filters[c]) + "</b>";
+      }).join(" • ") + "</div>";
+    }
+
+    if (Object.keys(progress).length) {
+      html += '<div class="muted" style="margin-top:6px">Envoi : <b data-progress="sent">' + esc(progress.sent || 0) + "</b> / " + esc(progress.total || 0) +
+        ' • erreurs <span data-progress="errors">' + esc(progress.errors || 0) + '</span> • ignorés <span data-progress="skipped">' + esc(progress.skipped || 0) + "</span>" +
+        (progress.expired ? " • hors délai " + esc(progress.expired) : "") +
+        ' • livrés <span data-progress="delivered">' + esc(progress.delivered || 0) + '</span> • échecs <span data-progress="failed">' + esc(progress.failed || 0) + "</span></div>";
+    }
+    const rep = data.replies;
+    if (rep && (rep.replies || Object.keys(progress).length)) {
+      html += '<div class="muted" style="margin-top:6px">Réponses : <b data-progress="replies">' + esc(rep.replies) + "</b>" +
+        " • numéros distincts " + esc(rep.repliers) + " • taux de réponse <b>" + pct(rep.rate) + "</b></div>";
+    }
+    if (!Object.keys(progress).length && !meta.cold) {
+      html += '<form method="post" action="/admin/nl/batch/' + id + '/dispatch" class="actions">' +
+        '<button class="btn btn-primary" type="submit">Lancer l\'envoi du lot</button></form>';
+    }
+
+    const alloc = meta.allocation || {};
+    if (Object.keys(alloc).length) {
+      const left = data.allocation_left || {};
+      html += '<div class="muted" style="margin-top:6px">Allocation : ' + Object.keys(alloc).map(function (d) {
+        return "#" + esc(d) + " " + esc(alloc[d]) + (d in left && meta.dispatched_at ? " (reste " + esc(left[d]) + ")" : "");
+      }).join(" • ") + "</div>";
+    }
+
+    if (meta.cold) {
+      const rs = data.restore_status || {};
+      html += '<form method="post" action="/admin/nl/batch/' + id + '/restore" class="actions">' +
+        '<div class="muted" style="align-self:center">🧊 Lot archivé à froid (items hors Redis, export possible).</div>' +
+        '<button class="btn btn-secondary" type="submit">Restaurer dans Redis</button>' +
+        (rs.status ? '<div class="muted" style="align-self:center">Restauration : ' + esc(rs.status) + (rs.error ? " — " + esc(rs.error) : "") + "</div>" : "") +
+        "</form>";
+    }
+
+    html += '<form method="get" action="/admin/settings" class="row" style="margin-top:10px">' +
+      '<input type="hidden" name="batch" value="' + id + '">' +
+      '<div style="min-width:260px;max-width:320px;flex:1"><label>Rechercher un numéro</label>' +
+      '<input type="text" name="q" value="' + esc(query) + '"></div>' +
+      '<button class="btn btn-secondary" type="submit">Rechercher</button>' +
+      (query ? '<a class="btn btn-secondary" href="/admin/settings?batch=' + id + '">Tout afficher</a>' : "") +
+      "</form>";
+
+    const items = data.items || [];
+    html += '<div style="margin-top:10px" class="muted">Payload (' + PAGE_SIZE + ' lignes par page) :</div>' +
+      '<div class="scroll" style="margin-top:6px"><table><thead><tr><th>#</th><th>number</th><th>data</th></tr></thead><tbody>' +
+      (items.length ? items.map(function (it) {
+        return '<tr><td class="muted">' + (it.pos + 1) + "</td><td>" + esc((it.rec || {})[numberCol]) +
+          '</td><td class="muted">' + esc(JSON.stringify(it.rec)) + "</td></tr>";
+      }).join("") : '<tr><td colspan="3" class="muted">Aucun résultat.</td></tr>') +
+      "</tbody></table></div>";
+
+    html += '<div class="actions">';
+    if (data.cursor && !query) {
+      html += '<a class="btn btn-secondary" href="/admin/settings?' + qs({ batch: meta.batch_id, cursor: Math.max(data.cursor - PAGE_SIZE, 0) }) + '">← Précédent</a>';
+    }
+    if (data.next) {
+      html += '<a class="btn btn-secondary" href="/admin/settings?' + qs({ batch: meta.batch_id, cursor: data.next, q: query }) + '">Suivant →</a>';
+    }
+    html += "</div>";
+
+    html += '<div class="muted" style="margin-top:10px">Type: <code>' + esc(card.dataset.type) + "</code> • Message: enregistré (variables possible).</div>" +
+      '<div class="actions">' +
+      '<a class="btn btn-secondary" href="/admin/nl/batch/' + id + '/export?format=csv">Export CSV</a>' +
+      '<a class="btn btn-secondary" href="/admin/nl/batch/' + id + '/export?format=csv&message=1">CSV + message</a>' +
+      '<a class="btn btn-secondary" href="/admin/nl/batch/' + id + '/export?format=xlsx&message=1">XLSX + message</a>' +
+      "</div>";
+    card.innerHTML = html;
+  }
+
+  function loadBatch() {
+    const card = document.getElementById("batch");
+    if (!card) return Promise.resolve();
+    const url = "/admin/api/batch/" + encodeURIComponent(card.dataset.batch) + "?" +
+      qs({ cursor: params.get("cursor"), q: params.get("q") });
+    return getJSON(url).then(function (data) {
+      if (!data.meta) { card.style.display = "none"; return; }
+      renderBatch(card, data);
+    }).catch(fail(card));
+  }
+
+  // -----------------------
+  // DERNIERS LOTS
+  // -----------------------
+  function loadBatches() {
+    const card = document.getElementById("batches");
+    const page = parseInt(params.get("bpage") || "0", 10) || 0;
+    return getJSON("/admin/api/batches?" + qs({ page: page })).then(function (data) {
+      const batches = data.batches || [];
+      if (!batches.length) return;
+      const cs = data.compact_status || {};
+      const replies = data.replies || {};
+      let html = '<div class="title">Derniers lots</div><table><thead><tr>' +
+        "<th>ID</th><th>Pris</th><th>Demandé</th><th>Appareils</th><th>Restants après</th><th>Réponses</th><th>Voir</th><th>Export</th>" +
+        "</tr></thead><tbody>" +
+        batches.map(function (b) {
+          const id = esc(b.batch_id);
+          const r = replies[b.batch_id] || {};
+          return "<tr><td>#" + id + (b.cold ? " 🧊" : "") + "</td><td>" + esc(b.taken_total) + "</td><td>" + esc(b.requested_total) +
+            '</td><td class="muted">' + esc((b.devices || []).join(", ")) + "</td><td>" + esc(b.remaining_after) +
+            "</td><td>" + esc(r.replies || 0) + (r.sent ? ' <span class="muted">(' + pct(r.rate) + ")</span>" : "") +
+            '</td><td><a href="/admin/settings?batch=' + id + '">ouvrir</a></td>' +
+            '<td><a href="/admin/nl/batch/' + id + '/export?format=csv">csv</a></td></tr>';
+        }).join("") +
+        '</tbody></table><div class="actions">';
+      if (page > 0) html += '<a class="btn btn-secondary" href="/admin/settings?bpage=' + (page - 1) + '">← Plus récents</a>';
+      if ((page + 1) * data.page_size < data.total) html += '<a class="btn btn-secondary" href="/admin/settings?bpage=' + (page + 1) + '">Plus anciens →</a>';
+      html += '<form method="post" action="/admin/nl/compact" style="margin:0"><button class="btn btn-secondary" type="submit">Compacter les anciens lots</button></form>';
+      if (cs.status) {
+        html += '<div class="muted" style="align-self:center">Dernière compaction : ' + esc(cs.status) +
+          (cs.status === "done" ? " (" + esc(cs.batches) + " lot(s), " + esc(cs.items) + " item(s), " + esc(cs.archive) + " archive(s))" : "") +
+          (cs.error ? " — " + esc(cs.error) : "") + "</div>";
+      }
+      html += "</div>";
+      card.innerHTML = html;
+      card.style.display = "";
+    }).catch(function (err) {
+      card.style.display = "";
+      fail(card)(err);
+    });
+  }
+
+  // -----------------------
+  // TAUX DE RÉPONSE PAR TEMPLATE
+  // -----------------------
+  function loadReplyRates() {
+    const card = document.getElementById("reply-rates");
+    return getJSON("/admin/api/reply-rates").then(function (data) {
+      const rows = (data.templates || []).filter(function (t) { return t.sent || t.replies; });
+      if (!rows.length) return;
+      card.innerHTML = '<div class="title">Taux de réponse par message</div>' +
+        '<div class="muted">Sur les ' + esc(data.batches) + " derniers lots (numéros distincts / envoyés).</div>" +
+        '<table style="margin-top:6px"><thead><tr><th>Message</th><th>Lots</th><th>Envoyés</th><th>Réponses</th><th>Numéros</th><th>Taux</th></tr></thead><tbody>' +
+        rows.map(function (t) {
+          return '<tr><td class="muted">' + esc(t.message) + "</td><td>" + esc(t.batches) + "</td><td>" + esc(t.sent) +
+            "</td><td>" + esc(t.replies) + "</td><td>" + esc(t.repliers) + "</td><td><b>" + pct(t.rate) + "</b></td></tr>";
+        }).join("") +
+        "</tbody></table>";
+      card.style.display = "";
+    }).catch(function (err) {
+      card.style.display = "";
+      fail(card)(err);
+    });
+  }
+
+  // -----------------------
+  // HISTORIQUE
+  // -----------------------
+  function loadHistory(number, before, append) {
+    const box = document.getElementById("history");
+    return getJSON("/admin/api/history?" + qs({ number: number, before: before })).then(function (data) {
+      const rows = (data.events || []).map(function (e) {
+        return "<tr><td class=\"muted\">" + esc(new Date(e.ts * 1000).toLocaleString()) + "</td>" +
+          "<td>" + (e.direction === "in" ? "⬅️ reçu" : "➡️ envoyé") + "</td>" +
+          "<td>" + (e.device ? "#" + esc(e.device) : "") + "</td>" +
+          "<td class=\"muted\">" + esc(e.batch ? "lot #" + e.batch : (e.step !== undefined ? "step " + e.step : "")) + "</td>" +
+          "<td>" + esc(e.body) + "</td></tr>";
+      }).join("");
+      const more = data.next ? '<div class="actions"><a class="btn btn-secondary" href="#" data-more="' + esc(data.next) + '">Plus ancien →</a></div>' : "";
+      if (append) {
+        box.querySelector("tbody").insertAdjacentHTML("beforeend", rows);
+        const old = box.querySelector(".actions");
+        if (old) old.remove();
+        box.insertAdjacentHTML("beforeend", more);
+      } else {
+        box.innerHTML = rows ? '<div class="scroll"><table><thead><tr><th>Date</th><th>Sens</th><th>Device</th><th></th><th>Message</th></tr></thead><tbody>' +
+          rows + "</tbody></table></div>" + more : '<div class="muted">Aucun message.</div>';
+      }
+      const link = box.querySelector("[data-more]");
+      if (link) {
+        link.addEventListener("click", function (ev) {
+          ev.preventDefault();
+          loadHistory(number, link.dataset.more, true);
+        });
+      }
+    }).catch(fail(box));
+  }
+
+  document.getElementById("history-form").addEventListener("submit", function (ev) {
+    ev.preventDefault();
+    const number = ev.target.elements.number.value.trim();
+    if (number) loadHistory(number, null, false);
+  });
+
+  // -----------------------
+  // FORMULAIRES
+  // -----------------------
+  function insertVar(name) {
+    const el = document.getElementById("nl_message");
+    if (!el) return;
+    const token = "{{" + name + "}}";
+    const start = el.selectionStart || 0;
+    const end = el.selectionEnd || 0;
+    el.value = el.value.substring(0, start) + token + el.value.substring(end);
+    el.focus();
+    const pos = start + token.length;
+    el.setSelectionRange(pos, pos);
+  }
+
+  function toggleStep2() {
+    const mode = document.getElementById("reply_mode").value;
+    document.getElementById("step2_block").style.display = mode === "1" ? "none" : "block";
+  }
+
+  document.querySelectorAll("[data-var]").forEach(function (el) {
+    el.addEventListener("click", function () { insertVar(el.dataset.var); });
+  });
+  document.getElementById("reply_mode").addEventListener("change", toggleStep2);
+  toggleStep2();
+
+  // -----------------------
+  // DIRECT (SSE /admin/api/events) : deltas agrégés par le hub du process web
+  // -----------------------
+  function bump(el, delta) {
+    if (el) el.textContent = (parseInt(el.textContent, 10) || 0) + delta;
+  }
+
+  function applyDelta(delta) {
+    if (delta.remaining !== undefined) {
+      document.getElementById("remaining").textContent = delta.remaining;
+    }
+    Object.keys(delta.devices || {}).forEach(function (id) {
+      const row = document.querySelector('#devices tr[data-device="' + CSS.escape(id) + '"]');
+      if (!row) return;
+      const d = delta.devices[id];
+      Object.keys(d).forEach(function (field) {
+        bump(row.querySelector('[data-stat="' + field + '"]'), d[field]);
+      });
+    });
+    const card = document.getElementById("batch");
+    const b = card && (delta.batches || {})[card.dataset.batch];
+    if (b) {
+      Object.keys(b).forEach(function (field) {
+        bump(card.querySelector('[data-progress="' + field + '"]'), b[field]);
+      });
+    }
+  }
+
+  function live() {
+    if (!window.EventSource) return;
+    const source = new EventSource("/admin/api/events");
+    source.addEventListener("delta", function (e) {
+      try { applyDelta(JSON.parse(e.data)); } catch (err) { /* delta invalide : ignoré */ }
+    });
+  }
+
+  Promise.all([loadDevices(), loadSegments(), loadBatch(), loadBatches(), loadReplyRates()]).then(live, live);
+})();
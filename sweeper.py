@@ -0,0 +1,127 @@
+"""
+Expiration des conversations (conv:{number}) : chaque transition repose un TTL
+(par flow : conv_ttl_hours de la config auto-reply, CONV_TTL par défaut). Désactivée
+par défaut (CONV_TTL=0, conv_ttl_hours=0) : une conversation en cours ne repart
+jamais de Step 1, comme avant. Le sweeper
+parcourt les clés par SCAN, par petits lots et avec un curseur repris d'un
+passage à l'autre, pour :
+  - poser un TTL aux conversations créées avant (sans expiration) ;
+  - en mode archive, archiver les conversations inactives avant que Redis ne les expire.
+"""
+import os
+import time
+
+from logger import log
+from keyspace import (
+    TASK_STATUS_PREFIX,
+    archived_key,
+    conv_key_pattern,
+    scan_targets,
+    main_redis,
+)
+
+CONV_TTL = int(os.getenv("CONV_TTL", "0"))          # défaut des flows ; 0 = pas d'expiration
+# expire : Redis supprime la conversation (le contact repart de Step 1)
+# archive : le sweeper archive le numéro (plus jamais de réponse) ; TTL Redis = filet
+CONV_TTL_ACTION = os.getenv("CONV_TTL_ACTION", "expire").strip().lower()
+CONV_SWEEP_GRACE = int(os.getenv("CONV_SWEEP_GRACE", "86400"))
+SWEEP_SCAN_COUNT = int(os.getenv("SWEEP_SCAN_COUNT", "200"))
+SWEEP_MAX_KEYS = int(os.getenv("SWEEP_MAX_KEYS", "20000"))   # clés examinées par passage
+
+SWEEP_STATUS = TASK_STATUS_PREFIX + "sweep_conversations"
+
+
+def conv_ttl(cfg):
+    """TTL du flow (secondes) ; absent -> CONV_TTL ; 0 -> pas d'expiration (0)."""
+    try:
+        hours = float(cfg.get("conv_ttl_hours", CONV_TTL / 3600) or 0)
+    except (TypeError, ValueError):
+        hours = 0
+    return int(hours * 3600) if hours > 0 else 0
+
+
+def key_ttl(cfg):
+    """TTL posé sur la clé : en mode archive, marge pour laisser passer le sweeper ; 0 = aucun."""
+    ttl = conv_ttl(cfg)
+    if ttl and CONV_TTL_ACTION == "archive":
+        return ttl + CONV_SWEEP_GRACE
+    return ttl
+
+
+def _number_of(key):
+    return key.decode("utf-8").rsplit(":", 1)[-1]
+
+
+def _sweep_keys(client, keys, ttl, full_ttl, now):
+    """Un lot de clés : 2 pipelines. Retourne (ttl posés, conversations récoltées)."""
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.ttl(key)
+        pipe.hget(key, "updated")
+    res = pipe.execute()
+
+    fixed = reaped = 0
+    pipe = client.pipeline(transaction=False)
+    for i, key in enumerate(keys):
+        remaining, updated = res[i * 2], res[i * 2 + 1]
+        age = now - int(updated) if updated else None
+        if age is not None and age >= ttl and (CONV_TTL_ACTION == "archive" or remaining == -1):
+            if CONV_TTL_ACTION == "archive":
+                number = _number_of(key)
+                pipe.sadd(archived_key(number), number)
+            pipe.delete(key)
+            reaped += 1
+        elif remaining == -1:
+            # conversation d'avant les TTL : horodatée maintenant si inconnue
+            if age is None:
+                pipe.hset(key, "updated", now)
+            pipe.expire(key, full_ttl if age is None else max(1, full_ttl - age))
+            fixed += 1
+    if fixed or reaped:
+        pipe.execute()
+    return fixed, reaped
+
+
+def sweep(cfg, max_keys=SWEEP_MAX_KEYS, count=SWEEP_SCAN_COUNT):
+    """
+    Un passage borné (max_keys clés examinées au total), curseurs SCAN conservés
+    dans task:status:sweep_conversations. Retourne le bilan du passage.
+    """
+    status = main_redis()
+    ttl = conv_ttl(cfg)
+    full_ttl = key_ttl(cfg)
+    now = int(time.time())
+    if not ttl:
+        # expiration désactivée : rien à poser ni à récolter
+        result = {"scanned": 0, "ttl_set": 0, "reaped": 0, "action": "off"}
+        status.hset(SWEEP_STATUS, mapping=dict(result, status="disabled", updated_at=now))
+        return result
+    pattern = conv_key_pattern()
+    scanned = fixed = reaped = 0
+    cursors = {}
+
+    targets = scan_targets()
+    budget = max(count, max_keys // max(1, len(targets)))
+    for name, client in targets:
+        cursor = int(status.hget(SWEEP_STATUS, f"cursor:{name}") or 0)
+        seen = 0
+        while True:
+            # conv:{number} seulement (pas les éventuels sous-types conv:x:y en legacy)
+            cursor, keys = client.scan(cursor=cursor, match=pattern, count=count, _type="hash")
+            if keys:
+                f, r = _sweep_keys(client, keys, ttl, full_ttl, now)
+                fixed += f
+                reaped += r
+                seen += len(keys)
+            if cursor == 0 or seen >= budget:
+                break
+        scanned += seen
+        cursors[f"cursor:{name}"] = cursor
+
+    result = {"scanned": scanned, "ttl_set": fixed, "reaped": reaped, "action": CONV_TTL_ACTION}
+    pipe = status.pipeline()
+    pipe.hset(SWEEP_STATUS, mapping=dict(cursors, status="done", updated_at=now, **result))
+    pipe.hincrby(SWEEP_STATUS, "reaped_total", reaped)
+    pipe.execute()
+    log(f"🧹 Sweep conversations : {scanned} examinée(s), {fixed} TTL posé(s), {reaped} récoltée(s) ({CONV_TTL_ACTION})")
+    return result
@@ -1,17 +1,60 @@
 import os
 import json
 import time
-from redis import Redis
-from logger import log
+from celery.signals import worker_process_shutdown
+from logger import log as _log
 from celery_worker import celery
-
-SERVER = os.getenv("SERVER")
-API_KEY = os.getenv("API_KEY")
-
-REDIS_URL = os.getenv("REDIS_URL")
-redis_conn = Redis.from_url(REDIS_URL)
-
-CONFIG_KEY = "config:autoreply"
+from tracing import span, traced, trace_task
+from keyspace import (
+    CONFIG_KEY,
+    lazy_main_redis,
+    redis_for_number,
+    conv_key,
+    processed_key,
+    archived_key,
+    transaction,
+    device_stat_key,
+    device_cycle_key,
+    BATCH_ITEMS_PREFIX,
+    BATCH_PROGRESS_PREFIX,
+    BATCH_DISPATCHED_PREFIX,
+    NL_UPLOAD_PREFIX,
+    NL_IMPORT_PREFIX,
+    TASK_STATUS_PREFIX,
+)
+from numlist import render_message, load_batch_meta, save_batch_meta
+from device_health import is_available, is_open, is_probing, healthy_devices, fetch_gateway_devices
+from gateway import GATEWAY_ASYNC, send_request, send_single_message  # noqa: F401
+from outbox import DELIVERY_MODE, enqueue as outbox_enqueue
+from dashboard import publish_device, publish_batch
+import allocation
+import affinity
+from sweeper import CONV_TTL, key_ttl
+import history
+import attribution
+import scheduler
+import delivery
+
+# 📣 Campagnes : taille des tranches envoyées par tâche
+CAMPAIGN_CHUNK = int(os.getenv("CAMPAIGN_CHUNK", "200"))
+
+# 🔌 Device en panne (circuit ouvert) : bascule des réponses vers un device sain
+# si autorisé, sinon réponse retenue et retentée plus tard
+REPLY_FAILOVER = os.getenv("REPLY_FAILOVER", "false").lower() == "true"
+HOLD_RETRY_DELAY = int(os.getenv("HOLD_RETRY_DELAY", "60"))
+HOLD_MAX_RETRIES = int(os.getenv("HOLD_MAX_RETRIES", "30"))
+
+# ⚖️ Lots alloués (allocation.py) : device KO en cours de campagne -> sa part
+# est répartie sur les autres devices du lot (sinon retenue jusqu'à réouverture)
+ALLOC_REBALANCE = os.getenv("ALLOC_REBALANCE", "true").lower() == "true"
+
+# 📌 Statut des tâches sans résultat Celery (task:status:*)
+TASK_STATUS_TTL = int(os.getenv("TASK_STATUS_TTL", str(7 * 86400)))
+
+redis_conn = lazy_main_redis()
+
+# ⏱️ spans (tracing.py) : sans effet tant que TRACE_ENABLED n'est pas activé
+log = traced("log")(_log)
 
 
 def _config_defaults():
@@ -22,9 +65,11 @@ def _config_defaults():
         "step1_type": "sms",
         "step0_text": "",
         "step1_text": "",
+        "conv_ttl_hours": CONV_TTL / 3600,
     }
 
 
+@traced("load_config")
 def load_config():
     raw = redis_conn.get(CONFIG_KEY)
     defaults = _config_defaults()
@@ -55,72 +100,283 @@ def load_config():
 
 
 def get_conversation_key(number):
-    return f"conv:{number}"
+    return conv_key(number)
 
 
+@traced("redis.is_archived")
 def is_archived(number):
-    return redis_conn.sismember("archived_numbers", number)
+    return redis_for_number(number).sismember(archived_key(number), number)
 
 
+@traced("redis.archive_number")
 def archive_number(number):
-    redis_conn.sadd("archived_numbers", number)
+    redis_for_number(number).sadd(archived_key(number), number)
 
 
+@traced("redis.mark_processed")
 def mark_message_processed(number, msg_id):
-    redis_conn.sadd(f"processed:{number}", msg_id)
+    redis_for_number(number).sadd(processed_key(number), msg_id)
 
 
+@traced("redis.is_processed")
 def is_message_processed(number, msg_id):
-    return redis_conn.sismember(f"processed:{number}", msg_id)
+    return redis_for_number(number).sismember(processed_key(number), msg_id)
 
 
+@traced("redis.stats")
 def _stat_incr(device_id: str, key: str, amount: int = 1):
-    redis_conn.incrby(f"stats:device:{device_id}:{key}", amount)
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.incrby(device_stat_key(device_id, key), amount)
+    publish_device(pipe, device_id, key, amount)
+    pipe.execute()
 
 
+@traced("redis.stats")
 def _stat_last_seen(device_id: str):
-    redis_conn.set(f"stats:device:{device_id}:last_seen", int(time.time()))
+    redis_conn.set(device_stat_key(device_id, "last_seen"), int(time.time()))
 
 
+@traced("redis.stats")
 def _cycle_incr_received(device_id: str, amount: int = 1):
-    redis_conn.incrby(f"cycle:device:{device_id}:received", amount)
+    redis_conn.incrby(device_cycle_key(device_id, "received"), amount)
 
 
+@traced("redis.stats")
 def _cycle_incr_sent(device_id: str, amount: int = 1):
-    redis_conn.incrby(f"cycle:device:{device_id}:sent", amount)
-
-
-def send_request(url, post_data):
-    import requests
-    log(f"🌐 POST → {url} | data: {post_data}")
+    redis_conn.incrby(device_cycle_key(device_id, "sent"), amount)
+
+
+def _route_reply_device(number, device_id, attempt):
+    """
+    Device d'envoi de la réponse : celui du message entrant s'il est sain,
+    sinon un device sain (REPLY_FAILOVER), sinon None (= retenir).
+    """
+    if is_available(device_id):
+        return device_id
+    if REPLY_FAILOVER:
+        # device d'affinité du numéro parmi les sains : stable quand la flotte change
+        healthy = healthy_devices(exclude=[device_id])
+        if healthy:
+            return affinity.pick(number, {d: allocation.capacity(d) for d in healthy})
+    if attempt >= HOLD_MAX_RETRIES:
+        # trop attendu : on tente quand même le device d'origine
+        return device_id
+    return None
+
+
+def _set_ttl(pipe, key, ttl):
+    if ttl:
+        pipe.expire(key, ttl)
+    else:
+        pipe.persist(key)
+
+
+def _transition(number, msg_id, conv_redis, conv_key, step, next_step, archive,
+                reply=None, msg_type="sms", device=None, mark=True, inbound_device=None, pipe=None,
+                ttl=CONV_TTL, body=None):
+    """
+    Applique une transition de conversation.
+    direct : envoi gateway puis écriture d'état (une transaction).
+    outbox : écriture d'état + enregistrement d'envoi en attente dans la même transaction ;
+             la livraison est faite par le consumer outbox.py.
+    reply=None : pas de réponse pour cette transition.
+    pipe : écritures ajoutées à un pipeline fourni (exécuté par l'appelant, cf. ingest.py).
+    ttl : expiration reposée sur la conversation et son set de messages traités
+          (0 = pas d'expiration : un TTL posé auparavant est retiré).
+    body : texte entrant, ajouté à l'historique (history.py) avec la réponse.
+    """
+    has_reply = bool((reply or "").strip())
+    use_outbox = DELIVERY_MODE == "outbox"
+
+    if reply is not None and not (has_reply and use_outbox):
+        delivery.track(send_single_message(number, reply, device, msg_type), device)
+        # stats envoyés (l'index des IDs gateway est écrit par delivery.track)
+        if has_reply:
+            try:
+                _stat_incr(device, "sent", 1)
+                _cycle_incr_sent(device, 1)
+            except Exception:
+                pass
+
+    with span("redis.transition"):
+        own = pipe is None
+        if own:
+            pipe = transaction(conv_redis)
+        if mark:
+            pipe.sadd(processed_key(number), msg_id)
+            _set_ttl(pipe, processed_key(number), ttl)
+        if archive:
+            pipe.sadd(archived_key(number), number)
+        if next_step is None:
+            pipe.delete(conv_key)
+        else:
+            fields = {"step": next_step, "updated": int(time.time())}
+            if inbound_device:
+                fields["device"] = inbound_device
+            pipe.hset(conv_key, mapping=fields)
+            _set_ttl(pipe, conv_key, ttl)
+        if has_reply and use_outbox:
+            outbox_enqueue(pipe, number, reply, device, msg_type, idem=f"{number}:{msg_id}:{step}")
+        if body is not None:
+            history.append(pipe, number, "in", body, device=inbound_device, step=step)
+        if has_reply:
+            history.append(pipe, number, "out", reply, device=device, msg_type=msg_type, step=step)
+        if own:
+            pipe.execute()
+
+
+class ReplyHeld(Exception):
+    """Réponse retenue : device indisponible, à retenter plus tard."""
+
+
+def parse_message(msg_json):
+    """JSON du gateway -> (number, msg_id, device_id, texte) ou None si invalide."""
     try:
-        response = requests.post(url, data=post_data)
-        data = response.json()
-        log(f"📨 Réponse : {data}")
-        return data.get("data")
+        msg = json.loads(msg_json) if isinstance(msg_json, (str, bytes)) else msg_json
     except Exception as e:
-        log(f"❌ Erreur POST : {e}")
+        log(f"❌ JSON invalide : {e}")
         return None
 
+    number = msg.get("number")
+    msg_id = msg.get("ID")
+    device_id = msg.get("deviceID")
 
-def send_single_message(number, message, device_slot, msg_type):
-    if not (message or "").strip():
-        log(f"⛔️ Message vide → aucun envoi vers {number} (type={msg_type})")
+    if not number or not msg_id or not device_id:
+        msg_id_short = str(msg_id)[-5:] if msg_id else "?????"
+        log(f"⛔️ [{msg_id_short}] Champs manquants")
         return None
+    return str(number), msg_id, str(device_id), str(msg.get("message") or "")
+
+
+def record_received(device_id, pipe=None, number=None):
+    """
+    Stats reçus ; avec number, la recherche d'attribution (numéro -> lot de campagne)
+    part dans le même pipeline (résultats : les attribution.lookup_size() derniers).
+    """
+    own = pipe is None
+    if own:
+        pipe = redis_conn.pipeline(transaction=False)
+    pipe.set(device_stat_key(device_id, "last_seen"), int(time.time()))
+    pipe.incrby(device_stat_key(device_id, "received"), 1)
+    pipe.incrby(device_cycle_key(device_id, "received"), 1)
+    publish_device(pipe, device_id, "received")
+    if number:
+        attribution.queue_lookup(pipe, number)
+    if own:
+        res = pipe.execute()
+        if number:
+            size = attribution.lookup_size()
+            batch_id = attribution.resolve(res[len(res) - size:] if size else [])
+            if batch_id:
+                record_replies([(batch_id, number)])
+
+
+def record_replies(hits):
+    """Réponses attribuées [(batch_id, number)] : compteurs du lot en un pipeline."""
+    if not hits:
+        return
+    pipe = redis_conn.pipeline(transaction=False)
+    for batch_id, number in hits:
+        attribution.queue_reply(pipe, batch_id, number)
+    pipe.execute()
+
+
+def queue_state_reads(pipe, number, msg_id):
+    """(archivé, déjà traité ?, step) — à exécuter dans un pipeline."""
+    pipe.sismember(archived_key(number), number)
+    pipe.sismember(processed_key(number), msg_id or "")
+    pipe.hget(conv_key(number), "step")
+
+
+def handle_message(number, msg_id, device_id, cfg, attempt=0, state=None, pipe=None, body=""):
+    """
+    Cœur du traitement d'un message entrant (Celery ou ingestion par stream).
+    state : (archivé, traité, step) déjà lus ; pipe : écritures d'état groupées.
+    Lève ReplyHeld si la réponse doit être retenue.
+    """
+    msg_id_short = str(msg_id)[-5:]
+
+    conv_redis = redis_for_number(number)
+    conv_key = get_conversation_key(number)
+    if state is None:
+        with span("redis.conv"):
+            pipe_r = conv_redis.pipeline(transaction=False)
+            queue_state_reads(pipe_r, number, msg_id)
+            state = pipe_r.execute()
+    archived, processed, raw_step = state
+
+    if archived:
+        log(f"🗃️ [{msg_id_short}] Numéro archivé → ignoré.")
+        return
+
+    if processed:
+        log(f"🔁 [{msg_id_short}] Déjà traité → ignoré.")
+        return
+
+    step = int(raw_step or 0)
+
+    reply_mode = int(cfg.get("reply_mode", 2))
+    step0_text = cfg.get("step0_text") or ""
+    step1_text = cfg.get("step1_text") or ""
+    step0_type = cfg.get("step0_type", "sms")
+    step1_type = cfg.get("step1_type", "sms")
+
+    pending_reply = step0_text if step == 0 else (step1_text if step == 1 and reply_mode == 2 else "")
+    send_device = device_id
+    if pending_reply.strip():
+        send_device = _route_reply_device(number, device_id, attempt)
+        if send_device is None:
+            log(f"⏳ [{msg_id_short}] Device {device_id} indisponible → réponse retenue")
+            raise ReplyHeld(device_id)
+        if send_device != device_id:
+            log(f"🔀 [{msg_id_short}] Device {device_id} indisponible → envoi via {send_device}")
+
+    common = dict(inbound_device=device_id, pipe=pipe, ttl=key_ttl(cfg), body=body)
+
+    # ✅ IMPORTANT : après le message final → archive immédiatement
+    if step == 0:
+        # mode 1 : 1 réponse => stop direct ; mode 2 : on attend step1
+        final = reply_mode == 1
+        _transition(number, msg_id, conv_redis, conv_key, step=0,
+                    next_step=None if final else 1, archive=final,
+                    reply=step0_text, msg_type=step0_type, device=send_device, **common)
+        if final:
+            log(f"✅ [{msg_id_short}] Mode 1 réponse → archivé après Step0.")
+        else:
+            log(f"✅ [{msg_id_short}] Step0 envoyé, attente Step1.")
+        return
+
+    if step == 1:
+        if reply_mode == 1:
+            # sécurité : si repasse en mode1, on stop
+            _transition(number, msg_id, conv_redis, conv_key, step=1, next_step=None, archive=True, **common)
+            log(f"✅ [{msg_id_short}] Mode 1 → stop.")
+            return
+
+        # ✅ Step final => archive direct
+        _transition(number, msg_id, conv_redis, conv_key, step=1, next_step=None, archive=True,
+                    reply=step1_text, msg_type=step1_type, device=send_device, **common)
+        log(f"✅ [{msg_id_short}] Step1 envoyé → archivé, stop total.")
+        return
+
+    # Tout le reste => stop
+    _transition(number, msg_id, conv_redis, conv_key, step=step, next_step=None, archive=True,
+                mark=False, **common)
+    log(f"✅ [{msg_id_short}] Step inconnu/terminé → archivé.")
+
 
-    log(f"📦 Envoi à {number} via device {device_slot} (type={msg_type})")
-    return send_request(f"{SERVER}/services/send.php", {
-        "number": number,
-        "message": message,
-        "devices": device_slot,
-        "type": msg_type,
-        "prioritize": 1,
-        "key": API_KEY,
-    })
+@worker_process_shutdown.connect
+def _drain_gateway(**kwargs):
+    if GATEWAY_ASYNC:
+        from gateway_async import gateway
+        gateway.drain()
+    # références d'envoi encore en cours d'écriture / en attente
+    delivery.flush()
 
 
-@celery.task(name="process_message")
-def process_message(msg_json):
+@celery.task(name="process_message", bind=True, max_retries=HOLD_MAX_RETRIES)
+@trace_task("process_message")
+def process_message(self, msg_json):
     log("🔧 Début process_message")
     log(f"🛎️ Job brut : {msg_json}")
 
@@ -129,118 +385,346 @@ def process_message(msg_json):
         log("⏸️ Auto-reply désactivé.")
         return
 
-    try:
-        msg = json.loads(msg_json)
-    except Exception as e:
-        log(f"❌ JSON invalide : {e}")
+    parsed = parse_message(msg_json)
+    if not parsed:
         return
+    number, msg_id, device_id, body = parsed
 
-    number = msg.get("number")
-    msg_id = msg.get("ID")
-    device_id = msg.get("deviceID")
+    # ✅ Stats device (reçus) — une seule fois, pas à chaque retry
+    if not self.request.retries:
+        try:
+            with span("redis.stats"):
+                record_received(device_id, number=number)
+        except Exception:
+            pass
 
-    msg_id_short = str(msg_id)[-5:] if msg_id else "?????"
+    try:
+        handle_message(number, msg_id, device_id, cfg, attempt=self.request.retries, body=body)
+    except ReplyHeld:
+        raise self.retry(countdown=HOLD_RETRY_DELAY)
+    except Exception as e:
+        log(f"💥 [{str(msg_id)[-5:]}] Erreur interne : {e}")
+        try:
+            _stat_incr(device_id, "errors", 1)
+        except Exception:
+            pass
 
-    if not number or not msg_id or not device_id:
-        log(f"⛔️ [{msg_id_short}] Champs manquants")
-        return
 
-    device_id = str(device_id)
+def task_status(name, **fields):
+    """Progression / dernier résultat d'une tâche (remplace le backend de résultats Celery)."""
+    key = TASK_STATUS_PREFIX + name
+    fields["updated_at"] = int(time.time())
+    pipe = redis_conn.pipeline()
+    pipe.hset(key, mapping=fields)
+    pipe.expire(key, TASK_STATUS_TTL)
+    pipe.execute()
 
-    # ✅ Stats device (reçus)
-    try:
-        _stat_last_seen(device_id)
-        _stat_incr(device_id, "received", 1)
-        _cycle_incr_received(device_id, 1)
-    except Exception:
-        pass
 
+@celery.task(name="compact_archives")
+def compact_archives():
+    from cold_storage import compact
+    task_status("compact_archives", status="running")
     try:
-        if is_archived(number):
-            log(f"🗃️ [{msg_id_short}] Numéro archivé → ignoré.")
-            return
+        res = compact()
+    except Exception as e:
+        task_status("compact_archives", status="error", error=str(e)[:500])
+        raise
+    task_status("compact_archives", status="disabled" if res.get("error") else "done", **res)
+    return res
 
-        if is_message_processed(number, msg_id):
-            log(f"🔁 [{msg_id_short}] Déjà traité → ignoré.")
-            return
 
-        conv_key = get_conversation_key(number)
-        step = int(redis_conn.hget(conv_key, "step") or 0)
-        redis_conn.hset(conv_key, "device", device_id)
-
-        reply_mode = int(cfg.get("reply_mode", 2))
-        step0_text = cfg.get("step0_text") or ""
-        step1_text = cfg.get("step1_text") or ""
-        step0_type = cfg.get("step0_type", "sms")
-        step1_type = cfg.get("step1_type", "sms")
-
-        # ✅ IMPORTANT : après le message final → archive immédiatement
-        if step == 0:
-            reply = step0_text
-            msg_type = step0_type
-
-            send_single_message(number, reply, device_id, msg_type)
-
-            # stats envoyés
-            if (reply or "").strip():
-                try:
-                    _stat_incr(device_id, "sent", 1)
-                    _cycle_incr_sent(device_id, 1)
-                except Exception:
-                    pass
-
-            mark_message_processed(number, msg_id)
-
-            if reply_mode == 1:
-                # 1 réponse => stop direct
-                archive_number(number)
-                redis_conn.delete(conv_key)
-                log(f"✅ [{msg_id_short}] Mode 1 réponse → archivé après Step0.")
-                return
-
-            # mode 2 => on attend step1 au prochain message entrant
-            redis_conn.hset(conv_key, "step", 1)
-            log(f"✅ [{msg_id_short}] Step0 envoyé, attente Step1.")
-            return
+@celery.task(name="restore_batch")
+def restore_batch(batch_id):
+    from cold_storage import restore_batch as _restore
+    name = f"restore_batch:{batch_id}"
+    task_status(name, status="running")
+    try:
+        n = _restore(batch_id)
+    except Exception as e:
+        task_status(name, status="error", error=str(e)[:500])
+        raise
+    task_status(name, status="done", items=n)
+    return n
+
+
+# -----------------------
+# CAMPAGNES (file "campaigns")
+# -----------------------
+@celery.task(name="dispatch_batch")
+def dispatch_batch(batch_id):
+    batch_id = str(batch_id)
+    meta = load_batch_meta(batch_id)
+    if not meta or meta.get("cold"):
+        log(f"⛔️ Lot #{batch_id} introuvable ou archivé → pas d'envoi")
+        return 0
+    if not meta.get("devices"):
+        log(f"⛔️ Lot #{batch_id} sans appareil → pas d'envoi")
+        return 0
+
+    if meta.get("dispatched_at"):
+        log(f"⛔️ Lot #{batch_id} déjà lancé → ignoré")
+        return 0
+
+    sched = meta.get("schedule")
+    if sched:
+        due = scheduler.campaign_next(sched)
+        if due is None:
+            log(f"⛔️ Lot #{batch_id} : fin de campagne dépassée → pas d'envoi")
+            return 0
+        if due > time.time() + 1:
+            # ⏰ lancement différé : l'ordonnanceur rappellera dispatch_batch à l'échéance
+            scheduler.add_job(redis_conn, f"dispatch:{batch_id}", due)
+            meta["scheduled_at"] = int(due)
+            save_batch_meta(meta)
+            log(f"⏰ Lot #{batch_id} planifié pour {int(due)}")
+            return 0
+
+    # un seul lancement (double clic, job planifié + lancement manuel...) : sinon
+    # progression remise à zéro, backlog compté deux fois et chaînes en double
+    if not redis_conn.set(BATCH_DISPATCHED_PREFIX + batch_id, int(time.time()), nx=True):
+        log(f"⛔️ Lot #{batch_id} déjà lancé → ignoré")
+        return 0
+
+    total = int(redis_conn.llen(BATCH_ITEMS_PREFIX + batch_id) or 0)
+    redis_conn.hset(BATCH_PROGRESS_PREFIX + batch_id, mapping={"total": total, "sent": 0, "errors": 0, "skipped": 0})
+
+    if meta.get("allocation"):
+        # une chaîne de tranches par device, chacune consomme sa sous-liste
+        allocation.add_backlog(allocation.remaining(batch_id, list(meta["allocation"])))
+        started = [d for d in meta["allocation"] if allocation.start_chain(batch_id, d)]
+        for device_id in started:
+            send_device_chunk.delay(batch_id, device_id)
+        meta["dispatched_at"] = int(time.time())
+        save_batch_meta(meta)
+        log(f"📣 Lot #{batch_id} : {total} envois alloués sur {len(started)} device(s) {meta['allocation']}")
+        return len(started)
+
+    chunks = 0
+    for start in range(0, total, CAMPAIGN_CHUNK):
+        send_campaign_chunk.delay(batch_id, start, min(total, start + CAMPAIGN_CHUNK))
+        chunks += 1
+
+    meta["dispatched_at"] = int(time.time())
+    save_batch_meta(meta)
+    log(f"📣 Lot #{batch_id} : {total} envois en {chunks} tranche(s)")
+    return chunks
+
+
+def _campaign_items(batch_id, start, end, positions=None):
+    items_key = BATCH_ITEMS_PREFIX + batch_id
+    if positions is None:
+        return list(enumerate(redis_conn.lrange(items_key, start, end - 1), start))
+    pipe = redis_conn.pipeline()
+    for pos in positions:
+        pipe.lindex(items_key, pos)
+    return [(pos, raw) for pos, raw in zip(positions, pipe.execute()) if raw]
+
+
+def _send_campaign_item(rec, meta, device_id, hist):
+    """
+    Envoie un item de campagne ; False si rien à envoyer (numéro ou texte vide).
+    hist : pipelines d'historique par client Redis, exécutés en fin de tranche.
+    """
+    number = str(rec.get(meta.get("number_col")) or "").strip()
+    text = render_message(meta.get("message") or "", rec)
+    if not number or not text.strip():
+        return False
+    msg_type = meta.get("type") or "sms"
+    delivery.track(send_single_message(number, text, device_id, msg_type, prioritize=0),
+                   device_id, meta.get("batch_id"))
+    _stat_incr(device_id, "sent", 1)
+    _cycle_incr_sent(device_id, 1)
+    client = redis_for_number(number)
+    if id(client) not in hist:
+        hist[id(client)] = client.pipeline(transaction=False)
+    history.append(hist[id(client)], number, "out", text, device=device_id, msg_type=msg_type,
+                   batch=meta.get("batch_id"))
+    return True
+
+
+def _flush_history(hist):
+    for pipe in hist.values():
+        try:
+            pipe.execute()
+        except Exception as e:
+            log(f"❌ Historique campagne : {e}")
+
+
+def _record_progress(batch_id, sent, errors, skipped):
+    progress_key = BATCH_PROGRESS_PREFIX + batch_id
+    pipe = redis_conn.pipeline()
+    pipe.hincrby(progress_key, "sent", sent)
+    pipe.hincrby(progress_key, "errors", errors)
+    pipe.hincrby(progress_key, "skipped", skipped)
+    publish_batch(pipe, batch_id, sent=sent, errors=errors, skipped=skipped)
+    pipe.execute()
+
+
+@celery.task(name="send_device_chunk")
+def send_device_chunk(batch_id, device_id):
+    """
+    Tranche suivante de la sous-liste d'un device (lot alloué), puis se reprogramme
+    tant qu'il en reste. Device indisponible : rebalance vers les autres devices.
+    """
+    batch_id, device_id = str(batch_id), str(device_id)
+    meta = load_batch_meta(batch_id) or {}
+    devices = [str(d) for d in (meta.get("devices") or [])]
+    if not devices or not meta.get("number_col") or meta.get("cold"):
+        allocation.end_chain(batch_id, device_id, restart=False)
+        return 0
+
+    if not is_available(device_id):
+        if is_probing(device_id):
+            # sonde half_open en cours (autre chaîne / réponse async) : attendre son verdict
+            send_device_chunk.apply_async(args=[batch_id, device_id], countdown=HOLD_RETRY_DELAY)
+            return 0
+        moved = allocation.rebalance(batch_id, device_id, devices, meta.get("number_col")) if ALLOC_REBALANCE else {}
+        if moved:
+            for other in moved:
+                if allocation.start_chain(batch_id, other):
+                    send_device_chunk.delay(batch_id, other)
+            if allocation.end_chain(batch_id, device_id):
+                send_device_chunk.apply_async(args=[batch_id, device_id], countdown=HOLD_RETRY_DELAY)
+        else:
+            log(f"⏳ Lot #{batch_id} : device {device_id} indisponible → envois retenus")
+            send_device_chunk.apply_async(args=[batch_id, device_id], countdown=HOLD_RETRY_DELAY)
+        return 0
+
+    sched = meta.get("schedule") or {}
+    # sonde half_open obtenue : un seul message, la tranche suivante attend son verdict
+    want = 1 if is_probing(device_id) else CAMPAIGN_CHUNK
+    slot_at = time.time()
+    due, limit = scheduler.campaign_slot(redis_conn, sched, device_id, want, slot_at)
+    if not limit:
+        # hors plage / plafond du jour atteint : chaîne garée, reprise par l'ordonnanceur
+        allocation.end_chain(batch_id, device_id, restart=False)
+        if due is None:
+            # fin de campagne : le reste sort de la sous-liste (et du backlog du device)
+            expired = len(allocation.take(batch_id, device_id, 1 << 30))
+            redis_conn.hincrby(BATCH_PROGRESS_PREFIX + batch_id, "expired", expired)
+            log(f"⛔️ Lot #{batch_id} : fin de campagne → device {device_id} arrêté ({expired} non envoyé(s))")
+        else:
+            scheduler.add_job(redis_conn, f"chunk:{batch_id}:{device_id}", due)
+            log(f"⏰ Lot #{batch_id} : device {device_id} en pause jusqu'à {int(due)}")
+        return 0
+
+    sent = errors = skipped = 0
+    try:
+        positions = allocation.take(batch_id, device_id, limit)
+        items = _campaign_items(batch_id, 0, 0, positions)
+        hist = {}
+        for i, (pos, raw) in enumerate(items):
+            if is_open(device_id):
+                # circuit ouvert en cours de tranche : le reste repart dans la sous-liste
+                allocation.give_back(batch_id, device_id, [p for p, _ in items[i:]])
+                break
+            try:
+                if _send_campaign_item(json.loads(raw.decode("utf-8")), meta, device_id, hist):
+                    sent += 1
+                else:
+                    skipped += 1
+            except Exception as e:
+                log(f"💥 Lot #{batch_id} item {pos} : {e}")
+                errors += 1
+        _flush_history(hist)
+        _record_progress(batch_id, sent, errors, skipped)
+    finally:
+        # plafond du jour : la part réservée non envoyée est rendue
+        scheduler.settle_daily(redis_conn, sched, device_id, limit, sent, slot_at)
+
+    if positions and allocation.pending(batch_id, device_id):
+        send_device_chunk.delay(batch_id, device_id)
+    elif allocation.end_chain(batch_id, device_id):
+        # positions ajoutées par un rebalance pendant la fin de chaîne
+        send_device_chunk.delay(batch_id, device_id)
+    return sent
+
+
+@celery.task(name="send_campaign_chunk")
+def send_campaign_chunk(batch_id, start, end, positions=None):
+    """
+    Envoie les items [start, end) du lot (ou seulement `positions` : items retenus).
+    Les items d'un device au circuit ouvert sont retenus et reprogrammés.
+    """
+    batch_id = str(batch_id)
+    meta = load_batch_meta(batch_id) or {}
+    devices = [str(d) for d in (meta.get("devices") or [])]
+    if not devices or not meta.get("number_col"):
+        return 0
+
+    due = scheduler.campaign_next(meta.get("schedule"))
+    if due is None:
+        return 0
+    if due > time.time() + 1:
+        send_campaign_chunk.apply_async(args=[batch_id, start, end, positions], countdown=int(due - time.time()))
+        return 0
+
+    sent = errors = skipped = 0
+    held = []
+    hist = {}
+    for pos, raw in _campaign_items(batch_id, start, end, positions):
+        try:
+            device_id = devices[pos % len(devices)]
+            if not is_available(device_id):
+                held.append(pos)
+                continue
+            if _send_campaign_item(json.loads(raw.decode("utf-8")), meta, device_id, hist):
+                sent += 1
+            else:
+                skipped += 1
+        except Exception as e:
+            log(f"💥 Lot #{batch_id} item {pos} : {e}")
+            errors += 1
+
+    if held:
+        # device(s) KO : on retient jusqu'à réouverture du circuit
+        log(f"⏳ Lot #{batch_id} : {len(held)} envoi(s) retenu(s) (device indisponible)")
+        send_campaign_chunk.apply_async(args=[batch_id, 0, 0, held], countdown=HOLD_RETRY_DELAY)
+
+    _flush_history(hist)
+    _record_progress(batch_id, sent, errors, skipped)
+    return sent
+
+
+# -----------------------
+# IMPORT NUMLIST (file "imports")
+# -----------------------
+@celery.task(name="import_numlist")
+def import_numlist(import_id):
+    from nl_import import import_files
+
+    upload_key = NL_UPLOAD_PREFIX + str(import_id)
+    status_key = NL_IMPORT_PREFIX + str(import_id)
+    raw = redis_conn.hgetall(upload_key)
+    files = []
+    i = 0
+    while f"{i}:data".encode() in raw:
+        files.append((raw.get(f"{i}:name".encode(), b"").decode("utf-8", errors="ignore"), raw[f"{i}:data".encode()]))
+        i += 1
+
+    redis_conn.hset(status_key, "status", "running")
+    try:
+        _, count = import_files(files, redis_conn)
+        redis_conn.hset(status_key, mapping={"status": "done", "records": count})
+        log(f"📥 Import {import_id} : {count} numéros")
+        return count
+    except Exception as e:
+        redis_conn.hset(status_key, mapping={"status": "error", "error": str(e)})
+        log(f"❌ Import {import_id} : {e}")
+        return 0
+    finally:
+        redis_conn.delete(upload_key)
 
-        if step == 1:
-            if reply_mode == 1:
-                # sécurité : si repasse en mode1, on stop
-                archive_number(number)
-                redis_conn.delete(conv_key)
-                mark_message_processed(number, msg_id)
-                log(f"✅ [{msg_id_short}] Mode 1 → stop.")
-                return
-
-            reply = step1_text
-            msg_type = step1_type
-
-            send_single_message(number, reply, device_id, msg_type)
-
-            if (reply or "").strip():
-                try:
-                    _stat_incr(device_id, "sent", 1)
-                    _cycle_incr_sent(device_id, 1)
-                except Exception:
-                    pass
-
-            mark_message_processed(number, msg_id)
-
-            # ✅ Step final => archive direct
-            archive_number(number)
-            redis_conn.delete(conv_key)
-            log(f"✅ [{msg_id_short}] Step1 envoyé → archivé, stop total.")
-            return
 
-        # Tout le reste => stop
-        archive_number(number)
-        redis_conn.delete(conv_key)
-        log(f"✅ [{msg_id_short}] Step inconnu/terminé → archivé.")
-        return
+# -----------------------
+# SANTÉ DES DEVICES
+# -----------------------
+@celery.task(name="sweep_conversations")
+def sweep_conversations():
+    from sweeper import sweep
+    return sweep(load_config())
 
-    except Exception as e:
-        log(f"💥 [{msg_id_short}] Erreur interne : {e}")
-        try:
-            _stat_incr(device_id, "errors", 1)
-        except Exception:
-            pass
+
+@celery.task(name="refresh_devices")
+def refresh_devices():
+    return len(fetch_gateway_devices())
@@ -0,0 +1,187 @@
+import os
+import sys
+import json
+import time
+import random
+import threading
+import functools
+import contextvars
+
+from logger import log
+from keyspace import TRACE_STREAM
+
+# -----------------------
+# CONFIG (tout est coupé par défaut : décorateurs = fonction d'origine)
+# -----------------------
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "false").lower() == "true"
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "1000"))
+TRACE_SINK = os.getenv("TRACE_SINK", "redis").strip().lower()   # redis | file
+TRACE_STREAM_MAXLEN = int(os.getenv("TRACE_STREAM_MAXLEN", "1000"))
+TRACE_FILE = os.getenv("TRACE_FILE", "/tmp/trace.jsonl")
+# profiler par échantillonnage : % de tâches profilées, période d'échantillonnage
+TRACE_PROFILE_RATE = float(os.getenv("TRACE_PROFILE_RATE", "0"))
+TRACE_PROFILE_INTERVAL_MS = float(os.getenv("TRACE_PROFILE_INTERVAL_MS", "5"))
+
+_current = contextvars.ContextVar("trace", default=None)
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+class Trace:
+    def __init__(self, task):
+        self.task = task
+        self.spans = []
+        self.depth = 0
+        self.t0 = time.perf_counter()
+        self.started_at = time.time()
+        self.stacks = None
+
+    def breakdown(self):
+        out = {}
+        for s in self.spans:
+            agg = out.setdefault(s["name"], {"ms": 0.0, "count": 0})
+            agg["ms"] += s["ms"]
+            agg["count"] += 1
+        return {k: {"ms": round(v["ms"], 3), "count": v["count"]} for k, v in out.items()}
+
+
+class _Span:
+    __slots__ = ("trace", "name", "t0", "depth")
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.depth = self.trace.depth
+        self.trace.depth += 1
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        ms = (time.perf_counter() - self.t0) * 1000.0
+        self.trace.depth -= 1
+        self.trace.spans.append({"name": self.name, "ms": round(ms, 3), "depth": self.depth})
+        return False
+
+
+def span(name):
+    if not TRACE_ENABLED:
+        return _NOOP
+    trace = _current.get()
+    if trace is None:
+        return _NOOP
+    return _Span(trace, name)
+
+
+def traced(name):
+    """Décorateur de span ; sans effet (fonction d'origine) si le tracing est coupé."""
+    def decorator(fn):
+        if not TRACE_ENABLED:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# -----------------------
+# PROFILER PAR ÉCHANTILLONNAGE
+# -----------------------
+class _Sampler(threading.Thread):
+    """Échantillonne la pile du thread de la tâche (format 'collapsed')."""
+
+    def __init__(self, thread_id, interval_ms):
+        super().__init__(name="trace-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = max(0.001, interval_ms / 1000.0)
+        self.counts = {}
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join(timeout=1)
+        return sorted(self.counts.items(), key=lambda kv: -kv[1])[:50]
+
+
+# -----------------------
+# SINK
+# -----------------------
+def _dump(record):
+    try:
+        if TRACE_SINK == "file":
+            with open(TRACE_FILE, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            return
+        from keyspace import main_redis
+        main_redis().xadd(
+            TRACE_STREAM,
+            {"task": record["task"], "ms": record["ms"], "data": json.dumps(record, ensure_ascii=False)},
+            maxlen=TRACE_STREAM_MAXLEN,
+            approximate=True,
+        )
+    except Exception as e:
+        log(f"❌ Trace dump error: {e}")
+
+
+def trace_task(name):
+    """
+    Décorateur de tâche : chronomètre la tâche et ses spans, et dump la trace si
+    elle dépasse TRACE_SLOW_MS (ou si elle a été profilée).
+    """
+    def decorator(fn):
+        if not TRACE_ENABLED:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            trace = Trace(name)
+            token = _current.set(trace)
+            sampler = None
+            if TRACE_PROFILE_RATE > 0 and random.random() * 100 < TRACE_PROFILE_RATE:
+                sampler = _Sampler(threading.get_ident(), TRACE_PROFILE_INTERVAL_MS)
+                sampler.start()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _current.reset(token)
+                total_ms = (time.perf_counter() - trace.t0) * 1000.0
+                if sampler is not None:
+                    trace.stacks = sampler.stop()
+                if total_ms >= TRACE_SLOW_MS or trace.stacks:
+                    _dump({
+                        "task": name,
+                        "ms": round(total_ms, 3),
+                        "at": int(trace.started_at),
+                        "pid": os.getpid(),
+                        "slow": total_ms >= TRACE_SLOW_MS,
+                        "breakdown": trace.breakdown(),
+                        "spans": trace.spans,
+                        "stacks": trace.stacks,
+                    })
+        return wrapper
+    return decorator